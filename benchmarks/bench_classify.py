@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Compare the speed of line classification by the PRN reader with the former substring tests.
+
+Usage: python bench_classify.py [number of records]
+"""
+
+# Import required modules
+import io
+import re
+import sys
+import time
+from corpus import *
+from sami.marc_data import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def legacy_prn(reader, line):
+    """SAMIReaderPRN.new_record as it was before the classifier was precompiled"""
+    if any(s in line for s in ['<?xml version', '<title>', '<report>', '</report>', '<dateFormat>', '<catalog>']): return True
+    if re.search(r'^<dateCreated>[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}</dateCreated>$', line.strip()): return True
+    return False
+
+
+def timed(function, lines):
+    start = time.perf_counter()
+    decisions = [function(line) for line in lines]
+    return decisions, time.perf_counter() - start
+
+
+def main(argv=None):
+    n = int(argv[0]) if argv else 20000
+    print('{:<14}{:>12}{:>18}{:>18}{:>10}'.format('Format', 'Lines', 'Legacy lines/s', 'Compiled lines/s', 'Speed-up'))
+    for name, reader_type, target, text, legacy in [
+        ('prn', 'prn', 'report.prn', prn_report(n), legacy_prn),
+    ]:
+        reader = sami_factory(reader_type=reader_type, target=target)
+        lines = text.splitlines(True)
+        old, old_time = timed(lambda line: legacy(reader, line), lines)
+        new, new_time = timed(reader.new_record, lines)
+        if old != new:
+            print('{}: boundary decisions differ from the legacy classifier'.format(name))
+            sys.exit(1)
+        print('{:<14}{:>12}{:>18.0f}{:>18.0f}{:>9.1f}x'.format(
+            name, len(lines), len(lines) / old_time, len(lines) / new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
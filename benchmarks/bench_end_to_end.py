@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Run sami2marc_products and sami2marc_authorities end to end over a synthetic corpus,
+reporting records/sec, MB/s and peak RSS as JSON.
+
+Usage: python bench_end_to_end.py [-n <number of records>] [-r <repeats>] [-o <results file>]
+                                  [-b <baseline file>] [-t <tolerance>] [-j <jobs>] [--save]
+
+    -n    Number of records in each input file (default 5000)
+    -r    Number of times to repeat each run; the fastest is reported (default 3)
+    -o    Write results to this file as well as to the screen
+    -b    Compare results with this baseline file (default baseline.json, if it exists)
+    -t    Fraction by which records/sec may fall below the baseline before a run is reported as slower (default 0.1)
+    -j    Number of jobs to pass to the scripts with --jobs
+    --save    Save the results as the new baseline
+    -h    Show this message
+
+The exit status is 1 if any run is slower than the baseline.
+Peak RSS is that of the main process of each script (excluding any worker processes),
+and is not available on Windows.
+"""
+
+# Import required modules
+import getopt
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from corpus import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#     Constants
+# ====================
+
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_PATH = os.path.dirname(BENCHMARKS_PATH)
+BASELINE = os.path.join(BENCHMARKS_PATH, 'baseline.json')
+
+# Input files for sami2marc_products, by format: (file name, generator)
+PRODUCTS_INPUTS = [
+    ('prn', 'catalog.prn', lambda n: prn_report(n, 1)),
+    ('text', 'sami_export_WORK', lambda n: symphony_text(n, 2)),
+    ('xml', 'harvest.xml', lambda n: oai_marcxml(n, 3)),
+    ('xml_dels', 'harvest_dels.xml', lambda n: oai_marcxml(n, 4, deleted=True)),
+]
+
+# Output modes: (name, options for sami2marc_products, output file for sami2marc_authorities, options for sami2marc_authorities)
+MODES = [
+    ('lex', [], 'authorities.lex', []),
+    ('xml', ['-x'], 'authorities.xml', []),
+    ('header', ['-x', '--header'], 'authorities.xml', ['--header']),
+]
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def run(command, repeats=1):
+    """Run a command repeatedly, returning (seconds, CPU seconds, peak RSS in MB) for the fastest runs"""
+    results = [run_once(command) for _ in range(repeats)]
+    cpu = [r[1] for r in results if r[1] is not None]
+    peaks = [r[2] for r in results if r[2] is not None]
+    return min(r[0] for r in results), min(cpu) if cpu else None, max(peaks) if peaks else None
+
+
+def run_once(command):
+    """Run a command once, returning (seconds, CPU seconds, peak RSS in MB); CPU time and RSS are None if not available"""
+    start = time.perf_counter()
+    # Progress reports from the scripts are written to stderr, and are discarded with their other output
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if hasattr(os, 'wait4'):
+        pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        cpu = usage.ru_utime + usage.ru_stime
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        peak = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    else:
+        process.wait()
+        seconds, cpu, peak = time.perf_counter() - start, None, None
+    if process.returncode != 0:
+        print('Error: {} exited with status {}'.format(' '.join(command), process.returncode))
+        sys.exit(2)
+    return seconds, cpu, peak
+
+
+def result(records, size, seconds, cpu, peak):
+    return {
+        'records': records,
+        'mb': round(size / (1024 * 1024), 3),
+        'seconds': round(seconds, 3),
+        'cpu_seconds': round(cpu, 3) if cpu is not None else None,
+        'records_per_sec': round(records / seconds, 1),
+        'records_per_cpu_sec': round(records / cpu, 1) if cpu else None,
+        'mb_per_sec': round(size / (1024 * 1024) / seconds, 3),
+        'peak_rss_mb': round(peak, 1) if peak is not None else None,
+    }
+
+
+def benchmark(n, repeats=1, jobs=None):
+    """Return a dictionary of results for each script, input format and output mode"""
+    results = {}
+    extra = ['--jobs', str(jobs)] if jobs else []
+    work = tempfile.mkdtemp(prefix='sami_bench_')
+    try:
+        for name, file, generator in PRODUCTS_INPUTS:
+            input_path = os.path.join(work, 'in_' + name)
+            os.makedirs(input_path)
+            with open(os.path.join(input_path, file), mode='w', encoding='utf-8', newline='\n') as f:
+                f.write(generator(n))
+            size = os.path.getsize(os.path.join(input_path, file))
+            for mode, options, _, _ in MODES:
+                output_path = os.path.join(work, 'out_{}_{}'.format(name, mode))
+                timings = run([sys.executable, os.path.join(SCRIPTS_PATH, 'sami2marc_products.py'),
+                               '-i', input_path, '-o', output_path] + options + extra, repeats)
+                results['products {} {}'.format(name, mode)] = result(n, size, *timings)
+                shutil.rmtree(output_path, ignore_errors=True)
+
+        input_file = os.path.join(work, 'authorities.txt')
+        with open(input_file, mode='w', encoding='utf-8', newline='\n') as f:
+            f.write(authorities_text(n, 5))
+        size = os.path.getsize(input_file)
+        for mode, _, output, options in MODES:
+            output_file = os.path.join(work, output)
+            timings = run([sys.executable, os.path.join(SCRIPTS_PATH, 'sami2marc_authorities.py'),
+                           '-i', input_file, '-o', output_file] + options + extra, repeats)
+            results['authorities text {}'.format(mode)] = result(n, size, *timings)
+            os.remove(output_file)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance, cpu=True):
+    """Print a comparison of results with a baseline, returning the number of runs which are slower.
+
+    Records per CPU second are compared where available, since they vary less than records per second
+    when other programs are running. If cpu is False (e.g. with --jobs, since the CPU time of
+    worker processes is not counted), records per second are compared.
+    """
+    slower = 0
+    print('\n{:<28}{:>16}{:>16}{:>10}'.format('Run', 'Baseline rec/s', 'Current rec/s', 'Change'))
+    for run_name in results:
+        if run_name not in baseline: continue
+        key = 'records_per_sec'
+        if cpu and results[run_name].get('records_per_cpu_sec') and baseline[run_name].get('records_per_cpu_sec'):
+            key = 'records_per_cpu_sec'
+        old, new = baseline[run_name][key], results[run_name][key]
+        flag = ''
+        if new < old * (1 - tolerance):
+            flag = '  SLOWER'
+            slower += 1
+        print('{:<28}{:>16.1f}{:>16.1f}{:>+9.1%}{}'.format(run_name, old, new, new / old - 1, flag))
+    return slower
+
+
+def main(argv=None):
+    n, repeats, output, baseline, tolerance, jobs, save = 5000, 3, None, None, 0.1, None, False
+    try: opts, args = getopt.getopt(argv, 'hn:r:o:b:t:j:', ['save', 'help'])
+    except getopt.GetoptError as err:
+        print('Error: {}'.format(err))
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ['-h', '--help']:
+            print(__doc__)
+            sys.exit()
+        elif opt == '-n': n = int(arg)
+        elif opt == '-r': repeats = int(arg)
+        elif opt == '-o': output = arg
+        elif opt == '-b': baseline = arg
+        elif opt == '-t': tolerance = float(arg)
+        elif opt == '-j': jobs = int(arg)
+        elif opt == '--save': save = True
+    if baseline is None and os.path.isfile(BASELINE): baseline = BASELINE
+
+    report = {
+        'records': n,
+        'repeats': repeats,
+        'jobs': jobs,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': benchmark(n, repeats, jobs),
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if output:
+        with open(output, mode='w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+    slower = 0
+    if baseline and not save:
+        with open(baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('jobs') != jobs:
+            print('\nWarning: the baseline was run with --jobs {}'.format(baseline.get('jobs')))
+        slower = compare(report['results'], baseline['results'], tolerance, cpu=not jobs)
+    if save:
+        with open(BASELINE, mode='w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        print('\nBaseline saved to {}'.format(BASELINE))
+    if slower: sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Compare the speed of reading MARC 21 (.lex) files with MARCReader, in its different modes,
+with the former reader, which read each record with two read() calls and decoded every field.
+
+Usage: python bench_marc_reader.py [number of records]
+"""
+
+# Import required modules
+import io
+import os
+import sys
+import tempfile
+import time
+from corpus import *
+from sami.marc_data import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def legacy(file_handle):
+    """Records as read by MARCReader.__next__ before memory-mapping and lazy decoding"""
+    while True:
+        first5 = file_handle.read(5)
+        if not first5: return
+        yield MARCRecord(first5 + file_handle.read(int(first5) - 5))
+
+
+def timed(path, function):
+    with open(path, 'rb') as f:
+        start = time.perf_counter()
+        output = function(f)
+        return output, time.perf_counter() - start
+
+
+def main(argv=None):
+    n = int(argv[0]) if argv else 5000
+    records = [record.record for record in sami_factory(reader_type='prn', target=io.StringIO(prn_report(n, items=4)))]
+    handle, path = tempfile.mkstemp(suffix='.lex')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.writelines(record.as_marc() for record in records)
+
+        identifiers = [record['001'].data for record in records]
+        tags = [[field.tag for field in record.fields] for record in records]
+        runs = [
+            ('legacy, records', lambda f: [record.as_marc() for record in legacy(f)], None),
+            ('mmap, records', lambda f: [record.as_marc() for record in MARCReader(f)], None),
+            ('mmap lazy, records', lambda f: [record.as_marc() for record in MARCReader(f, lazy=True)], None),
+            ('legacy, 001', lambda f: [record['001'].data for record in legacy(f)], identifiers),
+            ('mmap lazy, 001', lambda f: [record['001'].data for record in MARCReader(f, lazy=True)], identifiers),
+            ('identifiers()', lambda f: list(MARCReader(f).identifiers()), identifiers),
+            ('tags()', lambda f: list(MARCReader(f).tags()), tags),
+        ]
+        # Records read back are compared with those read by the legacy reader, since decoding changes the leader
+        expected = None
+        print('{} records, {:.1f} MB\n'.format(n, os.path.getsize(path) / (1024 * 1024)))
+        # Speed-ups are relative to the last legacy run
+        print('{:<22}{:>14}{:>10}'.format('Run', 'Records/s', 'Speed-up'))
+        for name, function, result in runs:
+            output, seconds = timed(path, function)
+            if name.startswith('legacy'): base = seconds
+            if expected is None: expected = output
+            if output != (expected if result is None else result):
+                print('{}: output differs from the legacy reader'.format(name))
+                sys.exit(1)
+            print('{:<22}{:>14.0f}{:>9.1f}x'.format(name, n / seconds, base / seconds))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
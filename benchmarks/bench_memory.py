@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Measure the memory held by parsed records, in bytes per record,
+both for the MARC records alone and for the SAMI records which contain them.
+
+Usage: python bench_memory.py [number of records]
+"""
+
+# Import required modules
+import gc
+import io
+import sys
+import tracemalloc
+from corpus import *
+from sami.marc_data import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def held_records(reader_type, text, sami=False):
+    """Parse all the records in text, keeping the MARC records (or the SAMI records if sami is True),
+    and return (number of records, bytes allocated)"""
+    gc.collect()
+    tracemalloc.start()
+    reader = sami_factory(reader_type=reader_type, target=io.StringIO(text))
+    records = [record if sami else record.record for record in reader]
+    del reader
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return len(records), size
+
+
+def main(argv=None):
+    n = int(argv[0]) if argv else 5000
+    print('{:<14}{:>10}{:>12}{:>18}{:>18}'.format('Format', 'Records', 'Fields', 'MARC bytes/record', 'SAMI bytes/record'))
+    for name, reader_type, text in [
+        ('authorities', 'authorities', authorities_text(n)),
+        ('prn', 'prn', prn_report(n)),
+        ('xml', 'xml', oai_marcxml(n)),
+    ]:
+        fields = sum(len(record.record.fields) for record in sami_factory(reader_type=reader_type, target=io.StringIO(text)))
+        count, size = held_records(reader_type, text)
+        count, sami_size = held_records(reader_type, text, sami=True)
+        print('{:<14}{:>10}{:>12}{:>18.0f}{:>18.0f}'.format(name, count, fields, size / count, sami_size / count))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
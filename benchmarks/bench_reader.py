@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Compare the throughput of SAMIReader record chunking with the former line-by-line reader.
+
+XML files are not split into records line by line, so are not included.
+
+Usage: python bench_reader.py [number of records]
+"""
+
+# Import required modules
+import io
+import sys
+import time
+from corpus import *
+from sami.marc_data import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def legacy_chunks(reader):
+    """Record chunks as produced by SAMIReader.__next__ using readline() and string concatenation"""
+    while True:
+        chunk = ''
+        line = reader.file_handle.readline()
+        if not line: return
+        while chunk == '' and line and (reader.new_record(line) or reader.while_chunk(line)):
+            line = reader.file_handle.readline()
+            if not line: break
+        while line and not reader.new_record(line):
+            chunk += line
+            line = reader.file_handle.readline()
+            if not line: break
+        if not chunk: return
+        yield chunk
+
+
+def block_chunks(reader):
+    """Record chunks as produced by SAMIReader.next_chunk"""
+    while True:
+        try: yield reader.next_chunk()
+        except StopIteration: return
+
+
+def timed(function, reader_type, text):
+    reader = sami_factory(reader_type=reader_type, target=io.StringIO(text))
+    start = time.perf_counter()
+    chunks = list(function(reader))
+    return chunks, time.perf_counter() - start
+
+
+def main(argv=None):
+    n = int(argv[0]) if argv else 20000
+    print('{:<14}{:>10}{:>10}{:>14}{:>14}{:>10}'.format('Format', 'Records', 'MB', 'Legacy MB/s', 'Block MB/s', 'Speed-up'))
+    for name, reader_type, text in [
+        ('authorities', 'authorities', authorities_text(n)),
+        ('prn', 'prn', prn_report(n)),
+        ('text', 'txt', symphony_text(n)),
+    ]:
+        legacy, legacy_time = timed(legacy_chunks, reader_type, text)
+        block, block_time = timed(block_chunks, reader_type, text)
+        if legacy != block:
+            print('{}: chunks differ from the legacy reader'.format(name))
+            sys.exit(1)
+        mb = len(text) / (1024 * 1024)
+        print('{:<14}{:>10}{:>10.1f}{:>14.1f}{:>14.1f}{:>9.1f}x'.format(
+            name, len(block), mb, mb / legacy_time, mb / block_time, legacy_time / block_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Compare the speed of MARC XML serialization with the former implementation of MARCRecord.as_xml.
+
+Usage: python bench_serialize.py [number of records]
+"""
+
+# Import required modules
+import io
+import sys
+import time
+from corpus import *
+from sami.marc_data import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def legacy_field(field):
+    """Field.as_xml as it was before MARCXMLSerializer"""
+    if field.control:
+        return '\t\t<marc:controlfield tag="{}">{}</marc:controlfield>'.format(field.tag, clean_text(field.data))
+    xml = ['\t\t<marc:datafield tag="{}" ind1="{}" ind2="{}">'.format(field.tag, *field.indicators)]
+    for subfield in field:
+        xml.append('\n\t\t\t<marc:subfield code="{}">{}</marc:subfield>'.format(subfield[0], clean_text(subfield[1].strip())))
+    xml.append('\n\t\t</marc:datafield>')
+    return ''.join(xml)
+
+
+def legacy(record):
+    """MARCRecord.as_xml as it was before MARCXMLSerializer, which encoded the record as MARC 21 for the leader"""
+    record._marc = None
+    leader = record._encode()[1]
+    xml = [MARCXML_RECORD, '\n\t\t<marc:leader>{}</marc:leader>'.format(leader)]
+    for field in record.fields:
+        xml.append('\n' + legacy_field(field))
+    xml.append('\n\t</marc:record>')
+    return ''.join(xml)
+
+
+def current(record):
+    record._xml = None
+    return record.as_xml()
+
+
+def timed(function, records):
+    start = time.perf_counter()
+    output = [function(record) for record in records]
+    return output, time.perf_counter() - start
+
+
+def main(argv=None):
+    n = int(argv[0]) if argv else 2000
+    print('{:<14}{:>10}{:>12}{:>18}{:>18}{:>10}'.format('Format', 'Records', 'Fields', 'Legacy records/s', 'Current records/s', 'Speed-up'))
+    for name, reader_type, text in [
+        ('authorities', 'authorities', authorities_text(n)),
+        ('prn', 'prn', prn_report(n, items=20)),
+        ('xml', 'xml', oai_marcxml(n)),
+    ]:
+        records = [record.record for record in sami_factory(reader_type=reader_type, target=io.StringIO(text))]
+        old, old_time = timed(legacy, records)
+        new, new_time = timed(current, records)
+        if old != new:
+            print('{}: MARC XML differs from the legacy serialization'.format(name))
+            sys.exit(1)
+        print('{:<14}{:>10}{:>12}{:>18.0f}{:>18.0f}{:>9.1f}x'.format(
+            name, len(records), sum(len(record.fields) for record in records),
+            len(records) / old_time, len(records) / new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
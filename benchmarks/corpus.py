@@ -0,0 +1,159 @@
+#  -*- coding: utf8 -*-
+
+"""Seeded generators for synthetic SAMI files, used by the samiTools benchmarks."""
+
+# Import required modules
+import random
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#     Constants
+# ====================
+
+
+WORDS = ('harpsichord', 'quartet', 'symphony', 'recording', 'interviews', 'oral histories', 'jazz', 'demo',
+         'orchestra', 'Wright', 'Corea', 'Handel', 'fireworks', 'royal', 'music', 'tape', 'collection', 'Watford')
+LIBRARIES = ('RECORDING', 'WORKS-FILE', 'SOUND', 'STORE')
+LOCATIONS = ('STORE+E', 'STORE', 'RECORDED', 'OFFSITE')
+USERS = ('JCOLLIER', 'IDAVIS', 'ADMIN', 'CATALOGUER')
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def _text(rng, n=4):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, n)))
+
+
+def _date(rng):
+    return '{}/{}/{}'.format(rng.randint(1, 28), rng.randint(1, 12), rng.randint(1990, 2020))
+
+
+def authorities_text(n, seed=0):
+    """Return n SAMI authority records in text format"""
+    rng = random.Random(seed)
+    records = []
+    for i in range(n):
+        lines = ['\t\t'.join(['XX{}        '.format(i), 'NAME', 'AUTHORIZED', _date(rng), rng.choice(USERS) + '  ',
+                              _date(rng) if rng.random() < 0.9 else 'NEVER', rng.choice(USERS) + '  ', _date(rng), 'BL'])]
+        lines.append('  000:   |az n  n a')
+        lines.append('  001:   |aXX{}'.format(i))
+        lines.append('  008:   |a161109   a    aaa')
+        lines.append('  100:   |a{}, {}'.format(_text(rng, 2), rng.randint(1900, 1990)))
+        for _ in range(rng.randint(1, 6)):
+            lines.append('  {}:   |a{}'.format(rng.choice(('300', '312', '500', '680')), _text(rng)))
+        records.append('\n'.join(lines) + '\n')
+    return '\n'.join(records)
+
+
+def prn_report(n, seed=0, items=3):
+    """Return a SAMI .prn report containing n catalog records, with up to items items per record"""
+    rng = random.Random(seed)
+    out = ['<?xml version="1.0" encoding="UTF-8"?>', '<report>', '<title>Catalog report</title>',
+           '<dateCreated>2018-05-10T10:00:00</dateCreated>', '<dateFormat>YYYYMMDD</dateFormat>']
+    for i in range(n):
+        out.append('<catalog>')
+        out.append('    <marc>')
+        out.append('        <marcEntry tag="000" label="Leader" ind="  ">|aam     a</marcEntry>')
+        out.append('        <marcEntry tag="008" label="Fixed  field data" ind="  ">|a180214n   000 0 eng u</marcEntry>')
+        out.append('        <marcEntry tag="245" label="Title" ind="10">|a{}|b{}</marcEntry>'.format(_text(rng), _text(rng)))
+        for _ in range(rng.randint(1, 5)):
+            out.append('        <marcEntry tag="702" label="Contributor" ind="  ">|a{}|c(performer)|?UNAUTHORIZED</marcEntry>'
+                       .format(_text(rng, 2)))
+        if rng.random() < 0.1:
+            out.append('        <marcEntry tag="653" label="Subject" ind="  ">|aoral histories</marcEntry>')
+            out.append('        <marcEntry tag="975" label="L-ARK" ind="  ">|aark:/81055/vdc_{}</marcEntry>'.format(i))
+        out.append('        <marcEntry tag="001" label="Record control no." ind="  ">|aCKEY{}</marcEntry>'.format(i))
+        out.append('    </marc>')
+        out.append('    <call>')
+        out.append('        <callNumber>   C{}/{} S1 C1</callNumber>'.format(rng.randint(1, 999), i))
+        out.append('        <library>{}</library>'.format(rng.choice(LIBRARIES)))
+        for j in range(rng.randint(1, items)):
+            out.append('        <item>')
+            out.append('            <copyNumber>{}</copyNumber>'.format(j + 1))
+            out.append('            <itemID>{}-{}</itemID>'.format(i, 1001 + j))
+            out.append('            <library>{}</library>'.format(rng.choice(LIBRARIES)))
+            out.append('            <location>{}</location>'.format(rng.choice(LOCATIONS)))
+            out.append('            <homeLocation>{}</homeLocation>'.format(rng.choice(LOCATIONS)))
+            out.append('            <category1>POP</category1>')
+            out.append('            <type>RECORDING</type>')
+            out.append('            <dateCreated>2018-05-{:02d}</dateCreated>'.format(rng.randint(1, 28)))
+            if rng.random() < 0.5:
+                out.append('            <dateModified>2019-01-{:02d}</dateModified>'.format(rng.randint(1, 28)))
+            out.append('        </item>')
+        out.append('    </call>')
+        out.append('</catalog>')
+    out.append('</report>')
+    return '\n'.join(out) + '\n'
+
+
+def symphony_text(n, seed=0):
+    """Return n SAMI products records in Symphony flat text format"""
+    rng = random.Random(seed)
+    out = []
+    for i in range(n):
+        out.append('*** DOCUMENT BOUNDARY ***')
+        out.append('FORM=WORK')
+        out.append('.000. |aam  0c a')
+        out.append('.001. |aCKEY{}'.format(i))
+        out.append('.239.   |a{}'.format(_text(rng)))
+        out.append('.245. 10|a{}|b{}'.format(_text(rng), _text(rng)))
+        for _ in range(rng.randint(1, 5)):
+            out.append('.700.   |a{}|c(arranger)|=^A{}'.format(_text(rng, 2), rng.randint(1, 99999)))
+        out.append('.974.   |aark:/81055/vdc_{}'.format(i))
+        out.append('.999.   |aXX({}.1)|wALPHANUM|c1|i{}-1001|d{}|lRECORDED|mWORKS-FILE|rY|sY|tWORK|u{}'
+                   .format(i, i, _date(rng), _date(rng)))
+    return '\n'.join(out) + '\n'
+
+
+def oai_marcxml(n, seed=0, deleted=False):
+    """Return an OAI-PMH harvest of n MARC XML records, or of n deleted record headers"""
+    rng = random.Random(seed)
+    out = ['<?xml version="1.0" encoding="UTF-8"?>',
+           '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">',
+           '<ListRecords>']
+    for i in range(n):
+        if deleted:
+            out.append('<record>')
+            out.append('<header status="deleted">')
+            out.append('    <identifier>{}</identifier>'.format(i))
+            out.append('    <datestamp>2020-01-{:02d}</datestamp>'.format(rng.randint(1, 28)))
+            out.append('</header>')
+            out.append('</record>')
+            continue
+        out.append('<record xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+                   'xmlns:marc="http://www.loc.gov/MARC21/slim">')
+        out.append('<header>')
+        out.append('    <identifier>{}</identifier>'.format(i))
+        out.append('    <datestamp>2020-01-{:02d}</datestamp>'.format(rng.randint(1, 28)))
+        out.append('</header>')
+        out.append('<metadata>')
+        out.append('    <marc:record>')
+        out.append('        <marc:controlfield tag="000">am  0c a</marc:controlfield>')
+        out.append('        <marc:controlfield tag="001">CKEY{}</marc:controlfield>'.format(i))
+        out.append('        <marc:datafield tag="245" ind1="1" ind2="0">')
+        out.append('            <marc:subfield code="a">{} &amp; {}</marc:subfield>'.format(_text(rng), _text(rng)))
+        out.append('        </marc:datafield>')
+        for _ in range(rng.randint(1, 5)):
+            out.append('        <marc:datafield tag="702" ind1="" ind2="">')
+            out.append('            <marc:subfield code="a">{}</marc:subfield>'.format(_text(rng, 2)))
+            out.append('            <marc:subfield code="c">(conductor)</marc:subfield>')
+            out.append('        </marc:datafield>')
+        out.append('        <marc:datafield tag="999" ind1="" ind2="">')
+        out.append('            <marc:subfield code="a">1CD{:07d}</marc:subfield>'.format(i))
+        out.append('            <marc:subfield code="w">ALPHANUM</marc:subfield>')
+        out.append('            <marc:subfield code="m">{}</marc:subfield>'.format(rng.choice(LIBRARIES)))
+        out.append('        </marc:datafield>')
+        out.append('    </marc:record>')
+        out.append('</metadata>')
+        out.append('</record>')
+    out.append('</ListRecords>')
+    out.append('</OAI-PMH>')
+    return '\n'.join(out) + '\n'
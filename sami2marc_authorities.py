@@ -7,7 +7,11 @@
 
 # Import required modules
 from math import log10
+from multiprocessing import freeze_support
 from sami.marc_data import *
+from sami.sami_metrics import *
+from sami.sami_profile import *
+from sami.sami_routing import *
 
 # Set locale to assist with sorting
 locale.setlocale(locale.LC_ALL, '')
@@ -29,8 +33,6 @@ __status__ = '4 - Beta Development'
 files = {
     'input':      None,
     'output':     None,
-    'pre':        None,
-    'post':       None,
     'errors':     None,
     }
 
@@ -48,13 +50,22 @@ ARGUMENTS = OrderedDict([
 ])
 
 OPTIONS = OrderedDict([
-    ('--date', 'Split output into two files by specified date'),
+    ('--date', 'Split output into files by specified dates, or by year or month'),
     ('--max_size', 'Split output by size or number of records'),
+    ('--routes', 'Also write records to the output files described in a routes file'),
+    ('--fan_out', 'Save individual records in subfolders'),
+    ('--archive', 'Save individual records in zip or tar archives'),
+    ('--archive_size', 'Maximum size of an archive (in MB)'),
+    ('--jobs', 'Number of processes used to convert records in parallel'),
+    ('--metrics', 'Save progress reports to a file'),
+    ('--metrics_interval', 'Number of seconds between progress reports'),
+    ('--cprofile', 'Save cProfile statistics to a file'),
 ])
 
 FLAGS = OrderedDict([
     ('--tidy', 'Tidy authority files to facilitate load to MetAg'),
     ('--header', 'Include MetAg headers in MARC XML records'),
+    ('--profile', 'Display the time spent in each stage of the conversion'),
     ('--help', 'Display help message and exit'),
 ])
 
@@ -68,8 +79,14 @@ def usage(extended=False):
     """Function to print information about the program"""
     print('\nCorrect syntax is:\n')
     print('sami2marc_authorities -i <ifile> -o <ofile>'
-          '\n\t\t\t[--date <yyyymmdd>|--max_size <number|size>]'
-          '\n\t\t\t[--tidy] [--header]')
+          '\n\t\t\t[--date <yyyymmdd[,yyyymmdd...]|year|month>] [--max_size <number|size>]'
+          '\n\t\t\t[--routes <file>]'
+          '\n\t\t\t[--fan_out <hash|prefix>[:<number>]]'
+          '\n\t\t\t[--archive <zip|tar>] [--archive_size <number>]'
+          '\n\t\t\t[--jobs <number>]'
+          '\n\t\t\t[--tidy] [--header]'
+          '\n\t\t\t[--metrics <file>] [--metrics_interval <seconds>]'
+          '\n\t\t\t[--profile] [--cprofile <file>]')
     print('\nArguments:')
     for o in ARGUMENTS:
         print_opt(o, ARGUMENTS[o])
@@ -78,13 +95,13 @@ def usage(extended=False):
 Use quotation marks (") around arguments which contain spaces
 Input file should be SAMI Authorities files in .xml, .prn or text format
 Output file should be either MARC exchange (.lex) or MARC XML (.xml)
-Records with errors will be written to <ofile>_errors.\
+Records with errors will be written to <ofile>_errors
+(records in XML input which are cut short, as they are).\
 
 """)
     print('Options:')
     for o in OPTIONS:
         print_opt(o, OPTIONS[o])
-    print('--date and --max_size cannot be used at the same time.')
     print('\nFlags:')
     for o in FLAGS:
         print_opt(o, FLAGS[o])
@@ -92,14 +109,28 @@ Records with errors will be written to <ofile>_errors.\
         print("""\
 
 If parameter --date is specified:
-    Records with a created or amended date ealier than the value specified 
+    Records are written to <ofile> and also to a file for their date, 
+    which is the later of their created and amended dates;
+    With a single date, records with a date ealier than the value specified 
     will be written to <ofile>_pre_<date>;
-    Records with a created or amended date equal to or later than the value 
-    specified will be written to <ofile>_post_<date>.
+    Records with a date equal to or later than the value 
+    specified will be written to <ofile>_post_<date>;
+    With several dates separated by commas, e.g. --date 20100101,20150101, 
+    records with a date between two of the values specified (or equal to 
+    the first of them) will be written to <ofile>_<date>_<next date>;
+    Records without a created or amended date are written to the first file;
+    With --date year or --date month, records will be written to 
+    <ofile>_<yyyy> or <ofile>_<yyyymm>, and records without a created or 
+    amended date to <ofile>_undated;
+    All files are written in a single pass through the input file;
+    If --max_size is also specified, each of these files is split in the 
+    same way as <ofile>, e.g. <ofile>_pre_<date>.0, <ofile>_pre_<date>.1;
+    NOTE: --date cannot be used with --max_size 1.
     
 If parameter --max_size is specified:
     max_size is EITHER the maximum number of records in an output file 
-    OR the (approx) maximum file size (in KB) if the number has the suffix 'K';
+    OR the maximum file size (in KB) if the number has the suffix 'K'
+    (a new file is started before a file would reach this size);
     Output will be written to a sequence of files with the same name as the 
     input file, but with a suffix indicating its order in the generated 
     output sequence
@@ -108,6 +139,60 @@ If parameter --max_size is specified:
     the record identifier;
     Records with duplicate identifiers will be labelled with _DUPLICATE;
     Records without identifiers will be labelled with _NO IDENTIFIER.
+
+If parameter --routes is specified:
+    routes is a JSON file describing a list of sinks, to which records are 
+    written as well as to the main output, in the same pass;
+    Each sink is an object with the keys:
+        name        name of the sink (letters, digits, _ and -)
+        when        predicate, or list of predicates which must all match: 
+                    all, deleted, bad, oral_history, 
+                    tag:<tag> (the record has a field with the tag), 
+                    field:<tag>~<regex> or field:<tag>$<code>~<regex> 
+                    (a field, or a subfield of it, matches the regular 
+                    expression), or ! followed by a predicate to negate it;
+                    OR other, for records not written to any other sink
+        path        folder for the output files, which must not be used 
+                    for any other output (default: a subfolder of the 
+                    output folder, with the name of the sink)
+        format      lex or xml (default: the format of the main output)
+        header      true to include MetAg headers (only with xml)
+        max_size    as for --max_size
+        fan_out, archive, archive_size
+                    as for --fan_out, --archive and --archive_size
+                    (only with max_size 1)
+    Files in each sink are named in the same way as <ofile>, 
+    and are split in the same way if max_size is given;
+    Records are written to every sink whose predicates they match, 
+    including records with errors unless a sink has the predicate !bad;
+    e.g. [{"name": "personal", "when": ["tag:100", "!bad"], "format": "xml"}]
+
+If parameter --fan_out is specified:
+    NOTE: --fan_out can only be used with --max_size 1;
+    Individual records are saved in subfolders of the output folder, 
+    so that no folder holds too many files;
+    With hash, subfolders are named with the first 2 hexadecimal digits of 
+    a checksum of the file name (256 subfolders);
+    With prefix, subfolders are named with the first 3 characters of the 
+    file name (characters other than letters and digits are replaced by _);
+    The number of characters can be changed by adding it after a colon, 
+    e.g. --fan_out hash:3 (at most 8 for hash).
+
+If parameter --archive is specified:
+    NOTE: --archive can only be used with --max_size 1;
+    Individual records are saved as members of zip or tar archives, 
+    instead of as separate files;
+    Members are named in the same way as files would be; --fan_out adds 
+    folders within the archives;
+    Archives are named with the output file name and a sequence number, 
+    e.g. <ofile>.0.zip;
+    If --archive_size is specified, a new archive is started once an 
+    archive reaches that size (in MB).
+
+If parameter --jobs is specified:
+    Records will be converted by a pool of jobs processes;
+    Records are written in the same order, and to the same output files, as 
+    if they had been converted one by one.
     
 If parameter --tidy is specified:
     If no 001 is present, one will be created from the first 901 $a;
@@ -119,7 +204,25 @@ If parameter --header is specified:
     MARC XML records will be given a <header> to make them suitable for the 
     Metadata Aggregator;
     The <header> will include the record identifier;
-    NOTE: --header can only be used if the output is MARC XML.\
+    NOTE: --header can only be used if the output is MARC XML.
+
+Progress reports:
+    While the input file is converted, progress is reported as lines of JSON,
+    at most once every --metrics_interval seconds (by default, 10);
+    Each line gives the number of records converted, records/sec, 
+    bytes read and written, percent complete, estimated seconds remaining,
+    the index of the current output file, and the number of records with 
+    errors and deleted records;
+    A summary line is written when the conversion is complete;
+    Reports are written to the file specified by --metrics, 
+    or to stderr if --metrics is not specified.
+
+If flag --profile or parameter --cprofile is specified:
+    Records are converted in a single process (--jobs is ignored);
+    With --profile, the number of calls and the time spent reading, parsing, 
+    cleaning text, serializing, creating headers and writing are displayed 
+    at the end of the conversion, as a table and as JSON;
+    With --cprofile, cProfile statistics are saved to the file specified.\
     """)
     exit_prompt()
 
@@ -132,9 +235,13 @@ If parameter --header is specified:
 def main(argv=None):
     if argv is None: name = str(sys.argv[1])
 
-    xml, tidy, split, header = False, False, False, False
-    opts, args, date, limit = None, None, None, None
+    xml, tidy, split, header, profile = False, False, False, False, False
+    opts, args, date, limit, cprofile_file, metrics_file = None, None, None, None, None, None
+    routes_file, routes = None, None
+    metrics_interval = METRICS_INTERVAL
+    fan_out, archive = (None, None), (None, None)
     max_size = 1024 * 1024 * 1024
+    jobs = 1
 
     print('========================================')
     print('sami2marc_authorities')
@@ -144,7 +251,9 @@ This program converts SAMI AUTHORITY files from text, .prn, or XML format
 to MARC 21 Authority files in MARC exchange (.lex) or MARC XML format\
 """)
 
-    try: opts, args = getopt.getopt(argv, 'hi:o:m:d:t', ['ifile=', 'ofile=', 'max_size=', 'header', 'date=', 'tidy', 'help'])
+    try: opts, args = getopt.getopt(argv, 'hi:o:m:d:j:t', ['ifile=', 'ofile=', 'max_size=', 'header', 'date=', 'jobs=', 'tidy',
+                                                                    'fan_out=', 'archive=', 'archive_size=', 'routes=',
+                                                                    'metrics=', 'metrics_interval=', 'profile', 'cprofile=', 'help'])
     except getopt.GetoptError as err:
         exit_prompt('Error: {}'.format(err))
     if opts is None or not opts:
@@ -156,43 +265,55 @@ to MARC 21 Authority files in MARC exchange (.lex) or MARC XML format\
             header = True
         elif opt in ['-t', '--tidy']:
             tidy = True
+        elif opt == '--profile':
+            profile = True
+        elif opt == '--cprofile':
+            cprofile_file = arg
+        elif opt == '--fan_out':
+            fan_out = parse_fan_out(arg)
+        elif opt == '--archive':
+            if arg not in ARCHIVE_FORMATS: exit_prompt('Error: Archive format must be one of {}'.format(', '.join(ARCHIVE_FORMATS)))
+            archive = (arg, archive[1])
+        elif opt == '--archive_size':
+            archive = (archive[0], parse_archive_size(arg))
+        elif opt == '--routes':
+            routes_file = arg
+        elif opt == '--metrics':
+            metrics_file = arg
+        elif opt == '--metrics_interval':
+            try: metrics_interval = float(arg)
+            except: metrics_interval = 0
+            if not metrics_interval > 0: exit_prompt('Interval between progress reports could not be interpreted. \n'
+                                                     'Please ensure that it is a positive number of seconds.')
         elif opt in ['-d', '--date']:
-            date = arg
+            date = parse_date_partitions(arg)
         elif opt in roles:
             files[roles[opt]] = FilePath(arg, roles[opt])
         elif opt in ['-m', '--max_size']:
-            arg = arg.upper()
-            limit = 'size' if 'K' in arg else 'number'
-            try: max_size = int(re.sub(r'[^0-9]', '', arg))
-            except: exit_prompt('Maximum file size could not be interpreted. \n'
-                                'Please ensure that it is a positive integer, \n'
-                                'optionally followed by the suffix K.')
-            if not max_size >= 1: exit_prompt('Maximum file size could not be interpreted. \n'
-                                              'Please ensure that it is a positive integer, \n'
-                                              'optionally followed by the suffix K.')
-            if limit == 'size': max_size *= 1024
+            limit, max_size = parse_max_size(arg)
+        elif opt in ['-j', '--jobs']:
+            try: jobs = int(arg)
+            except: jobs = 0
+            if not jobs >= 1: exit_prompt('Number of jobs could not be interpreted. \n'
+                                          'Please ensure that it is a positive integer.')
         else:
             exit_prompt('Error: Option {} not recognised'.format(opt))
 
-    if date and limit: exit_prompt('Error: Options --date and --max_size cannot be used at the same time')
+    if profile or cprofile_file: jobs = 1
+    if date and limit == 'number' and max_size == 1:
+        exit_prompt('Error: Option --date cannot be used with --max_size 1')
+    if fan_out[0] and not (limit == 'number' and max_size == 1):
+        exit_prompt('Error: Option --fan_out can only be used with --max_size 1')
+    if archive[0] and not (limit == 'number' and max_size == 1):
+        exit_prompt('Error: Option --archive can only be used with --max_size 1')
+    if archive[1] and not archive[0]:
+        exit_prompt('Error: Option --archive_size cannot be used without --archive')
 
     for f in ['input', 'output']:
         if not files[f]:
             exit_prompt('Error: No path to {} file has been specified'.format(f))
     if files['output'].ext == '.xml': xml = True
-
-    # Check date format and create extra files for MetAg output
-
-    if date:
-        if len(re.sub(r'[^0-9]]', '', date)) != 8: exit_prompt('The date parameter must be in the format yyyymmdd')
-        try: date = datetime.datetime.strptime(date, '%Y%m%d')
-        except: exit_prompt('The date parameter must be in the format yyyymmdd')
-        files['pre'] = FilePath((files['output'].path).replace(files['output'].ext,
-                                                               '_pre_{}{}'.format(date.strftime('%Y%m%d'), files['output'].ext)),
-                                                               'output pre date')
-        files['post'] = FilePath((files['output'].path).replace(files['output'].ext,
-                                                                '_post_{}{}'.format(date.strftime('%Y%m%d'), files['output'].ext)),
-                                                                'output post date')
+    if routes_file: routes = load_routes(routes_file, os.path.dirname(files['output'].path), xml=xml)
 
     files['errors'] = FilePath((files['output']).path.replace(files['output'].ext, '_errors{}'.format(files['output'].ext)), 'error output')
 
@@ -209,11 +330,21 @@ to MARC 21 Authority files in MARC exchange (.lex) or MARC XML format\
         if max_size == 1:
             split = True
             print('Output file will be split into individual records')
+            if fan_out[0]: print('Records will be saved in subfolders by {}'.format(fan_out[0]))
+            if archive[0]: print('Records will be saved in {} archives'.format(archive[0]))
         else: print('Maximum file size : {} {}'.format(str(max_size), 'bytes' if limit == 'size' else 'records'))
     if date:
-        print('\nDate for splitting output: {}'.format(date.strftime('%Y%m%d')))
+        if isinstance(date, str): print('\nOutput will be split by {}'.format(date))
+        else: print('\nDate{} for splitting output: {}'.format('s' if len(date) > 1 else '', ', '.join(d.strftime('%Y%m%d') for d in date)))
+    if routes:
+        print('Records will also be written to sinks:')
+        for route in routes: print('    {}'.format(str(route)))
     if tidy: print('Output will be tidied for MetAg use.\n')
     if header: print('MetAg headers will be used')
+    if jobs > 1: print('Records will be converted in {} parallel processes'.format(str(jobs)))
+    if metrics_file: print('Progress reports will be saved to {}'.format(metrics_file))
+    if profile: print('The conversion will be profiled')
+    if cprofile_file: print('cProfile statistics will be saved to {}'.format(cprofile_file))
 
     # --------------------
     # Iterate through input files
@@ -223,8 +354,21 @@ to MARC 21 Authority files in MARC exchange (.lex) or MARC XML format\
     print('----------------------------------------')
     print(str(datetime.datetime.now()))
 
+    profiler = Profiler(stages=profile, cprofile_file=cprofile_file)
+    if metrics_file:
+        try: open(metrics_file, mode='w', encoding='utf-8').close()
+        except: exit_prompt('Error: Could not create metrics file {}'.format(metrics_file))
+
+    profiler.start()
+
     ifile = open(files['input'].path, mode='r', encoding='utf-8', errors='replace')
-    reader = sami_factory(reader_type='xml' if files['input'].ext == '.xml' else 'authorities', target=ifile, tidy=tidy)
+    metrics = MetricsReporter(metrics_file, metrics_interval)
+    metrics.start(os.path.basename(files['input'].path), ifile)
+    reader_type = 'xml' if files['input'].ext == '.xml' else 'authorities'
+    reader = sami_factory(reader_type=reader_type, target=ifile, tidy=tidy)
+    if jobs > 1:
+        reader = record_pipeline(reader, reader_type, jobs, xml=xml, tidy=tidy, both=any(route.xml != xml for route in routes or []),
+                                 predicates=field_predicates(routes or []))
     output_path, root = os.path.split(files['output'].path)
     if not os.path.isdir(output_path):
         try: os.makedirs(output_path)
@@ -233,126 +377,154 @@ to MARC 21 Authority files in MARC exchange (.lex) or MARC XML format\
 
     OPEN = OAI_HEADER if header else XML_HEADER
     CLOSE = '\n</ListRecords>\n</OAI-PMH>' if header else '\n</marc:collection>'
+    partitions = None
+    router = Router(routes, root, input_size=os.path.getsize(files['input'].path), metrics=metrics) if routes else None
+
+    # If a record cannot be converted, the error is reported, and the records already converted are kept
+    errors, current_file, split_archive, failed = None, None, None, False
+    try:
+        # Special case if file is to be split into separate records
+        if split:
+            record_count, current_file = 0, None
+            if archive[0]: split_archive = SplitArchive(output_path, root, archive[0], ext, archive[1], *fan_out, metrics=metrics)
+            else: names = SplitFileNames(output_path, ext, *fan_out)
+
+            for record in reader:
+                record_count += 1
+                metrics.count(record)
+                if record.is_malformed():
+                    if errors is None: errors = ErrorFile(files['errors'].path, metrics=metrics)
+                    errors.write(record)
+                    continue
+                if router: router.write(record)
+                if xml:
+                    if header:
+                        record_to_write = '{}{}<metadata>{}\n</metadata>\n</record>'.format(METAG_HEADER, record.header(), record.as_xml(namespace=True))
+                    else:
+                        record_to_write = '{}{}\n</marc:collection>'.format(XML_HEADER, record.as_xml())
+                name = record.identifier() or '_NO IDENTIFIER {}'.format(str(record_count))
+                if archive[0]:
+                    split_archive.add(name, record_to_write if xml else record.as_marc())
+                    continue
+                # Files are created exclusively, so that no record overwrites another
+                for filename in names.candidates(name):
+                    try:
+                        current_file = RecordWriter(open(filename, mode='xb'))
+                        break
+                    except FileExistsError: pass
+                metrics.opened(current_file)
+                if xml: current_file.write(record_to_write)
+                else: current_file.write_record(record)
+                metrics.closing(current_file)
+                current_file.close()
+            if archive[0]: split_archive.close()
 
-    # Special case if file is to be split into separate records
-    if split:
-        record_count = 0
-
-        for record in reader:
-            record_count += 1
-            if record_count % 100 == 0:
-                print('{} records processed'.format(str(record_count)), end='\r')
-            filename = os.path.join(output_path, (record.identifier() or '_NO IDENTIFIER {}'.format(str(record_count))) + ext)
-            file_count = 0
-            while os.path.isfile(filename):
-                file_count += 1
-                filename = os.path.join(output_path, (record.identifier() or '_NO IDENTIFIER {}'.format(str(record_count))) + '_DUPLICATE {}'.format(str(file_count)) + ext)
-            if xml:
-                current_file = open(filename, 'w', encoding='utf-8', errors='replace')
-                if header:
-                    current_file.write('{}{}<metadata>{}\n</metadata>\n</record>'.format(METAG_HEADER, record.header(), record.as_xml(namespace=True)))
-                else:
-                    current_file.write('{}{}\n</marc:collection>'.format(XML_HEADER, record.as_xml()))
-            else:
-                current_file = open(filename, mode='wb')
-                writer = MARCWriter(current_file)
-                writer.write(record)
-
-    # All other cases
-    else:
-        FMT = None
-        record_count, record_count_in_file = 0, 0
-        current_idx, current_size = 0, 0
+        # All other cases
+        else:
+            FMT = None
+            record_count, record_count_in_file = 0, 0
+            current_idx = 0
 
-        if limit == 'size':
-            FMT = ".%%0%dd" % (int(log10(os.path.getsize(files['input'].path) / max_size)) + 1)
+            if limit == 'size':
+                FMT = ".%%0%dd" % (int(log10(os.path.getsize(files['input'].path) / max_size)) + 1)
 
-        mid = FMT % current_idx if limit == 'size' else '.{}'.format(str(current_idx)) if limit == 'number' else ''
-        filename = os.path.join(output_path, root + mid + ext)
+            mid = FMT % current_idx if limit == 'size' else '.{}'.format(str(current_idx)) if limit == 'number' else ''
+            filename = os.path.join(output_path, root + mid + ext)
 
-        for f in files:
-            if f not in ('input', 'output') and files[f]:
-                if xml:
-                    files[f].file_object = open(files[f].path, mode='w', encoding='utf-8', errors='replace')
-                    files[f].file_object.write(OPEN)
-                else:
+            for f in files:
+                if f not in ('input', 'output') and files[f]:
                     files[f].file_object = open(files[f].path, mode='wb')
-                    files[f].file_writer = MARCWriter(files[f].file_object)
+                    files[f].file_writer = RecordWriter(files[f].file_object)
+                    if xml: files[f].file_writer.write(OPEN)
+                    metrics.opened(files[f].file_writer)
+
+            # Files split by date are written in the same pass; dates are in the format yyyymmdd once tidied
+            partitions = DatePartitions(output_path, root, ext, date, fmt='%Y%m%d' if tidy else '%d/%m/%Y',
+                                        limit=limit, max_size=max_size, mid=FMT or '.%d',
+                                        opening=OPEN if xml else None, closing=CLOSE if xml else None,
+                                        metrics=metrics) if date else None
+
+            current_file = RecordWriter(open(filename, mode='wb'))
+            if xml: current_file.write(OPEN)
+            metrics.opened(current_file, current_idx)
+            # Files are split by size before they would reach max_size bytes, including the closing elements
+            reserve = len(RecordWriter.encode(CLOSE)) if xml else 0
+
+            for record in reader:
+                record_count += 1
+                metrics.count(record)
+                # Records which could not be parsed are written to the errors file as they are
+                if record.is_malformed():
+                    files['errors'].file_writer.write(RecordWriter.encode(record.data + '\n'))
+                    continue
+                record_count_in_file += 1
+                if router: router.write(record)
 
-        if xml:
-            current_file = open(filename, 'w', encoding='utf-8', errors='replace')
-            current_file.write(OPEN)
-        else:
-            current_file = open(filename, mode='wb')
-            writer = MARCWriter(current_file)
-
-        for record in reader:
-            record_count += 1
-            record_count_in_file += 1
-            if record_count % 100 == 0:
-                print('{} records processed'.format(str(record_count)), end='\r')
-
-            # Check whether we need to start a new file
-            current_size += len(record.as_xml()) if xml else len(record.as_marc())
-            if (limit == 'size' and current_size >= max_size) \
-                    or (limit == 'number' and record_count_in_file > max_size):
-                if xml: current_file.write(CLOSE)
-                current_file.close()
-                print('{} records processed'.format(str(record_count)), end='\r')
-                print('\nFile {} done'.format(str(current_idx)))
-                current_size = len(record.as_xml()) if xml else len(record.as_marc())
-                record_count_in_file = 0
-                current_idx += 1
-                mid = FMT % current_idx if limit == 'size' else '.{}'.format(
-                    str(current_idx)) if limit == 'number' else ''
-                filename = os.path.join(output_path, root + mid + ext)
                 if xml:
-                    current_file = open(filename, 'w', encoding='utf-8', errors='replace')
-                    current_file.write(OPEN)
+                    record_to_write = '{}{}<metadata>{}\n</metadata>\n</record>'.format(OAI_RECORD, record.header(), record.as_xml(namespace=True)) if header \
+                        else record.as_xml()
+                else: record_to_write = record.as_marc()
+                # Each record is encoded once: files are split on the size of the bytes which are written
+                record_to_write = RecordWriter.encode(record_to_write)
+
+                # Check whether we need to start a new file
+                if (limit == 'size' and not record.is_bad() and current_file.size + len(record_to_write) + reserve >= max_size) \
+                        or (limit == 'number' and record_count_in_file > max_size):
+                    if xml: current_file.write(CLOSE)
+                    metrics.closing(current_file)
+                    current_file.close()
+                    print('{} records processed'.format(str(record_count)), end='\r')
+                    print('\nFile {} done'.format(str(current_idx)))
+                    record_count_in_file = 0
+                    current_idx += 1
+                    mid = FMT % current_idx if limit == 'size' else '.{}'.format(
+                        str(current_idx)) if limit == 'number' else ''
+                    filename = os.path.join(output_path, root + mid + ext)
+                    current_file = RecordWriter(open(filename, mode='wb'))
+                    if xml: current_file.write(OPEN)
+                    metrics.opened(current_file, current_idx)
+
+                if record.is_bad():
+                    files['errors'].file_writer.write(record_to_write)
                 else:
-                    current_file = open(filename, mode='wb')
-                    writer = MARCWriter(current_file)
-
-            record_to_write = '{}{}<metadata>{}\n</metadata>\n</record>'.format(OAI_RECORD, record.header(), record.as_xml(namespace=True)) if header \
-                else record.as_xml()
-
-            if record.is_bad():
-                if xml:
-                    files['errors'].file_object.write(record_to_write)
-                else: files['errors'].file_writer.write(record)
-            else:
-                # Write record to main output file
-                if xml: current_file.write(record_to_write)
-                else: writer.write(record)
-                # If splitting by date, write record to appropriate output file
-                if date:
-                    fmt = '%Y%m%d' if tidy else '%d/%m/%Y'
-                    try:
-                        f = 'post' if (record.created != 'NEVER' and datetime.datetime.strptime(record.created, fmt) >= date) \
-                                      or (record.modified != 'NEVER' and datetime.datetime.strptime(record.modified,  fmt) >= date) else 'pre'
-                    except: print('\nError parsing date')
-                    else:
-                        if xml: files[f].file_object.write(record_to_write)
-                        else: files[f].file_writer.write(record)
-
-    # Write closing elements in files
+                    # Write record to main output file
+                    current_file.write(record_to_write)
+                    # If splitting by date, write record to appropriate output file
+                    if partitions:
+                        try: partitions.write(record_to_write, getattr(record, 'created', None), getattr(record, 'modified', None))
+                        except: print('\nError parsing date')
+    except Exception as err:
+        print('\nError processing file {}: {}'.format(files['input'].path, err))
+        failed = True
+
+    # Write closing elements in files (files of individual records are already complete)
     if xml:
-        current_file.write(CLOSE)
+        if current_file and not split: current_file.write(CLOSE)
         for f in files:
-            if f != 'input' and files[f] and files[f].file_object:
-                files[f].file_object.write(CLOSE)
+            if f != 'input' and files[f] and files[f].file_writer:
+                files[f].file_writer.write(CLOSE)
+    if partitions: partitions.finish()
+    if router: router.finish()
 
     print('{} records processed'.format(str(record_count)), end='\r')
+    metrics.finish()
 
     # Close files
     for f in [ifile, current_file]:
-        f.close()
+        if f: f.close()
     for f in files:
-        try: files[f].file_object.close()
+        try: files[f].file_writer.close()
         except: pass
+    if split_archive: split_archive.close()
+    if partitions: partitions.close()
+    if router: router.close()
+    if errors: errors.close()
 
-    date_time_exit()
+    profiler.stop()
+    # The exit status is 1 if the input file could not be converted
+    date_time_exit(1 if failed else None)
 
 
 if __name__ == '__main__':
+    freeze_support()
     main(sys.argv[1:])
@@ -6,9 +6,14 @@
 # ====================
 
 # Import required modules
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from math import log10
+from multiprocessing import freeze_support
 from sami.marc_data import *
-import profile
+from sami.sami_manifest import *
+from sami.sami_metrics import *
+from sami.sami_profile import *
+from sami.sami_routing import *
 
 # Set locale to assist with sorting
 locale.setlocale(locale.LC_ALL, '')
@@ -35,11 +40,22 @@ ARGUMENTS = OrderedDict([
 OPTIONS = OrderedDict([
     ('--max_size', 'Split output by size or number of records'),
     ('--oral_history', 'Save oral history records to a separate folder'),
+    ('--routes', 'Also write records to the output files described in a routes file'),
+    ('--incremental', 'Only convert input files and records which have changed since the last run'),
+    ('--jobs', 'Number of input files to convert in parallel'),
+    ('--fan_out', 'Save individual records in subfolders'),
+    ('--archive', 'Save individual records in zip or tar archives'),
+    ('--archive_size', 'Maximum size of an archive (in MB)'),
+    ('--metrics', 'Save progress reports to a file'),
+    ('--metrics_interval', 'Number of seconds between progress reports'),
+    ('--cprofile', 'Save cProfile statistics to a file'),
 ])
 
 FLAGS = OrderedDict([
     ('-x', 'Output files will be MARC XML rather than MARC 21 (.lex)'),
     ('--header', 'Include MetAg headers in MARC XML records'),
+    ('--pipeline', 'Convert the records within each input file in parallel'),
+    ('--profile', 'Display the time spent in each stage of the conversion'),
     ('--help', 'Display help message and exit'),
 ])
 
@@ -54,8 +70,15 @@ def usage(extended=False):
     print('\nCorrect syntax is:\n')
     print('sami2marc_products -i <ifile> -o <ofile>'
           '\n\t\t\t[--max_size <number|size>]'
-          '\n\t\t\t[--oral_history <path>]'          
-          '\n\t\t\t[-x] [--header]')
+          '\n\t\t\t[--oral_history <path>]'
+          '\n\t\t\t[--routes <file>]'
+          '\n\t\t\t[--incremental <full|delta|both>]'
+          '\n\t\t\t[--fan_out <hash|prefix>[:<number>]]'
+          '\n\t\t\t[--archive <zip|tar>] [--archive_size <number>]'          
+          '\n\t\t\t[--jobs <number>] [--pipeline]'
+          '\n\t\t\t[-x] [--header]'
+          '\n\t\t\t[--metrics <file>] [--metrics_interval <seconds>]'
+          '\n\t\t\t[--profile] [--cprofile <file>]')
     print('\nArguments:')
     for o in ARGUMENTS:
         print_opt(o, ARGUMENTS[o])
@@ -63,7 +86,9 @@ def usage(extended=False):
 
 Use quotation marks (") around arguments which contain spaces
 Input files should be SAMI Products files, in .xml, .prn or text format
-Output file(s) will be either MARC exchange (.lex) or MARC XML (.xml).\
+Output file(s) will be either MARC exchange (.lex) or MARC XML (.xml).
+Records in XML input which are cut short are written, as they are,
+to <input file>_errors.xml in the output folder.\
 
 """)
     print('Options:')
@@ -77,7 +102,8 @@ Output file(s) will be either MARC exchange (.lex) or MARC XML (.xml).\
             
 If parameter --max_size is specified:
     max_size is EITHER the maximum number of records in an output file 
-    OR the (approx) maximum file size (in KB) if the number has the suffix 'K';
+    OR the maximum file size (in KB) if the number has the suffix 'K'
+    (a new file is started before a file would reach this size);
     Output will be written to a sequence of files with the same name as the 
     input file, but with a suffix indicating its order in the generated 
     output sequence
@@ -86,6 +112,29 @@ If parameter --max_size is specified:
     the record identifier;
     Records with duplicate identifiers will be labelled with _DUPLICATE;
     Records without identifiers will be labelled with _NO IDENTIFIER.
+
+If parameter --fan_out is specified:
+    NOTE: --fan_out can only be used with --max_size 1 or --oral_history;
+    Individual records are saved in subfolders of the output folder 
+    (and of the oral_history folder), so that no folder holds too many files;
+    With hash, subfolders are named with the first 2 hexadecimal digits of 
+    a checksum of the file name (256 subfolders);
+    With prefix, subfolders are named with the first 3 characters of the 
+    file name (characters other than letters and digits are replaced by _);
+    The number of characters can be changed by adding it after a colon, 
+    e.g. --fan_out hash:3 (at most 8 for hash).
+
+If parameter --archive is specified:
+    NOTE: --archive can only be used with --max_size 1 or --oral_history;
+    Individual records are saved as members of zip or tar archives, 
+    instead of as separate files;
+    Members are named in the same way as files would be; --fan_out adds 
+    folders within the archives;
+    Archives are named with the input file name and a sequence number, 
+    e.g. <input file>.0.zip; a separate sequence of archives is saved 
+    in the oral_history folder;
+    If --archive_size is specified, a new archive is started once an 
+    archive reaches that size (in MB).
     
 If parameter --oral_history is specified:
     IMPORTANT: This will over-ride the max_size parameter and set --max_size 1
@@ -93,16 +142,324 @@ If parameter --oral_history is specified:
     Records for oral histories and interviews will be saved to this path;
     Records are selected on the basis of 975 $a 'ark' 
     AND 653 $a 'oral histories' or 'interviews' (case insensitive);    
+    To save oral history records without splitting the rest of the output,
+    use --routes with a sink for oral_history records.
+
+If parameter --routes is specified:
+    routes is a JSON file describing a list of sinks, to which records are 
+    written as well as to the main output, in the same pass;
+    Each sink is an object with the keys:
+        name        name of the sink (letters, digits, _ and -)
+        when        predicate, or list of predicates which must all match: 
+                    all, oral_history, deleted, bad, 
+                    tag:<tag> (the record has a field with the tag), 
+                    field:<tag>~<regex> or field:<tag>$<code>~<regex> 
+                    (a field, or a subfield of it, matches the regular 
+                    expression), or ! followed by a predicate to negate it;
+                    OR other, for records not written to any other sink
+        path        folder for the output files, which must not be used 
+                    for any other output (default: a subfolder of the 
+                    output folder, with the name of the sink)
+        format      lex or xml (default: the format of the main output)
+        header      true to include MetAg headers (only with xml)
+        max_size    as for --max_size
+        fan_out, archive, archive_size
+                    as for --fan_out, --archive and --archive_size
+                    (only with max_size 1)
+    Files in each sink are named in the same way as the main output, 
+    and are split in the same way if max_size is given;
+    Records are written to every sink whose predicates they match;
+    e.g. [{"name": "oral", "when": "oral_history", "format": "xml"}, 
+          {"name": "music", "when": ["field:653$a~(?i)music", "!deleted"],
+           "max_size": "500K"}]
+
+If parameter --incremental is specified:
+    A manifest of the input files which have been converted is kept in the
+    output folder (sami_manifest.json), with the size, modification time 
+    and a hash of the content of each file, and a fingerprint of each of 
+    its records (a hash of the text of the record, by record identifier);
+    Input files which have not changed since they were last converted are 
+    skipped;
+    With full, changed files are converted in full, as without --incremental;
+    With delta, only records which are new or have changed are converted, 
+    and the main output (and any --routes output) is not written;
+    With both, changed files are converted in full, and new and changed 
+    records are also written to delta files;
+    Delta files are saved in a subfolder of the output folder named with 
+    the date and time of the run (delta_<yyyymmdd>_<hhmmss>), as 
+    <input file>_new, <input file>_changed (without splitting) and 
+    <input file>_vanished.txt, a list of the identifiers of records which 
+    are no longer in the input file (or of all its records, if the input 
+    file has been removed);
+    Records with duplicate identifiers are labelled with _DUPLICATE, and 
+    records without identifiers with _NO IDENTIFIER, as with --max_size 1;
+    If options which change the main output differ from those of the last 
+    run, files are converted in full again (with full or both);
+    NOTE: files from earlier runs which are not written again (e.g. parts 
+    of split output) are not removed; with --max_size 1, the records of 
+    files which are converted again are saved alongside those from earlier 
+    runs, labelled with _DUPLICATE.
+
+If parameter --jobs is specified:
+    jobs is the number of input files which will be converted at the same 
+    time, each in a separate process;
+    The largest input files are started first;
+    Output file names are the same as if the files were converted one by one,
+    except that where the same identifier occurs in more than one input file, 
+    the _DUPLICATE numbering depends on the order in which files finish.
+
+If flag --pipeline is specified:
+    Input files are converted one at a time, but the records within each 
+    file are converted by a pool of --jobs processes (by default, one for 
+    each CPU);
+    Records are written in the same order, and to the same output files, as 
+    if they had been converted one by one.
 
 If parameter --header is specified:
     MARC XML records will be given a <header> to make them suitable for the 
     Metadata Aggregator;
     The <header> will include the record identifier;
-    NOTE: --header can only be used with -x.\
+    For files of deleted records (with _dels in the file name), only the 
+    <header> is written, with the record identifier and datestamp; 
+    XML files of deleted records are converted without parsing the fields 
+    of the records, unless --oral_history or --routes is specified;
+    NOTE: --header can only be used with -x.
+
+Progress reports:
+    While each input file is converted, progress is reported as lines of JSON,
+    at most once every --metrics_interval seconds (by default, 10);
+    Each line gives the number of records converted, records/sec, 
+    bytes read and written, percent complete, estimated seconds remaining,
+    the index of the current output file, and the number of records with 
+    errors, deleted records and oral history records;
+    A summary line is written when each input file is complete;
+    Reports are appended to the file specified by --metrics, 
+    or written to stderr if --metrics is not specified.
+
+If flag --profile or parameter --cprofile is specified:
+    Input files are converted one at a time, in a single process 
+    (--jobs and --pipeline are ignored);
+    With --profile, the number of calls and the time spent reading, parsing, 
+    cleaning text, serializing, creating headers and writing are displayed 
+    at the end of the conversion, as a table and as JSON;
+    With --cprofile, cProfile statistics are saved to the file specified.\
     """)
     exit_prompt()
 
 
+def is_input_file(file):
+    """Function to test whether a file in the input folder should be converted"""
+    root, ext = os.path.splitext(file)
+    return ext in ['.xml', '.prn'] or file.endswith(SAMI_SUFFICES) or any(f in root for f in PRIMO_FLAGS)
+
+
+def output_root(file):
+    """Function to return the root of the names of the output files for an input file, and the extension of the input file"""
+    root, ext = os.path.splitext(file)
+    if any(f in root for f in PRIMO_FLAGS): return root + ext, '.xml'
+    return root, ext
+
+
+def incremental_entry(input_file, changes, digest, full=True, quiet=False):
+    """Function to return the manifest entry for an input file converted with --incremental"""
+    if changes is None: return None
+    if not quiet: print('\n{}'.format(str(changes)))
+    return file_entry(input_file, changes.records, full=full, digest=digest)
+
+
+def convert_file(file, input_path, output_path, oral_history_path=None, xml=False, header=False,
+                 split=False, limit=None, max_size=1024 * 1024 * 1024, pipeline_jobs=0, quiet=False,
+                 metrics_file=None, metrics_interval=METRICS_INTERVAL, fan_out=(None, None),
+                 archive=(None, None), routes=None, incremental=None, previous=None, delta_path=None):
+    """Function to convert a single input file; returns the number of records converted,
+    and with incremental, the manifest entry for the file (previous is the entry from the last run)"""
+    root, ext = output_root(file)
+    deleted = False
+
+    if not quiet: date_time('Processing file {} ...'.format(str(file)))
+    if '_dels' in root:
+        deleted = True
+        if not quiet: print('File contains deleted records')
+
+    input_file = os.path.join(input_path, file)
+    digest = file_hash(input_file) if incremental else None
+    if previous and previous['hash'] == digest and (incremental == 'delta' or previous.get('full')):
+        if not quiet: print('File has not changed since it was last converted')
+        return 0, file_entry(input_file, previous['records'], full=previous.get('full'), digest=digest)
+
+    # Open input file
+    ifile = open(input_file, mode='r', encoding='utf-8', errors='replace')
+    metrics = MetricsReporter(metrics_file, metrics_interval)
+    metrics.start(file, ifile, deleted=deleted)
+    reader_type = 'prn' if ext == '.prn' else 'xml' if ext == '.xml' else 'txt'
+    ext = '.xml' if xml else '.lex'
+    # Only headers are written for files of deleted records, so in XML files only the headers need to be parsed
+    # (records cannot then be checked for oral histories, or routed)
+    headers_only = deleted and header and reader_type == 'xml' and not oral_history_path and not routes
+    reader = sami_factory(reader_type='headers' if headers_only else reader_type, target=ifile)
+    changes = None
+    if incremental:
+        # With delta, unchanged records are not parsed at all
+        reader = changes = IncrementalReader(reader, previous and previous['records'], skip_unchanged=incremental == 'delta')
+    delta = DeltaWriter(delta_path, root, xml=xml, header=header, deleted=deleted, metrics=metrics) if incremental in ('delta', 'both') else None
+    if pipeline_jobs and not headers_only:
+        reader = record_pipeline(reader, reader_type, pipeline_jobs, xml=xml, both=any(route.xml != xml for route in routes or []),
+                                 predicates=field_predicates(routes or []))
+    router = Router(routes, root, deleted=deleted, input_size=os.path.getsize(input_file),
+                    metrics=metrics) if routes and incremental != 'delta' else None
+
+    OPEN = OAI_HEADER if header else XML_HEADER
+    CLOSE = '\n</ListRecords>\n</OAI-PMH>' if header else '\n</marc:collection>'
+
+    # Records which could not be parsed are written to an errors file, and not converted
+    errors = ErrorFile(os.path.join(output_path, root + '_errors.xml'), metrics=metrics)
+
+    # Only new and changed records are written with --incremental delta; the main output is left as it is
+    # If a record cannot be converted, the files are completed and closed before the error is raised
+    if incremental == 'delta':
+        record_count = 0
+        try:
+            for record in reader:
+                record_count += 1
+                metrics.count(record)
+                change = changes.change(record)
+                if record.is_malformed(): errors.write(record)
+                elif change: delta.write(change, record)
+            delta.write_vanished(changes.vanished())
+        finally:
+            delta.finish()
+            metrics.finish()
+            for f in [ifile, delta, errors]:
+                f.close()
+        if not quiet: print('{} records processed'.format(str(record_count)), end='\r')
+        return record_count, incremental_entry(input_file, changes, digest, full=False, quiet=quiet)
+
+    # Special case if file is to be split into separate records
+    if split:
+        record_count = 0
+        paths = [path for path in (output_path, oral_history_path) if path]
+        if archive[0]:
+            archives = {path: SplitArchive(path, root, archive[0], ext, archive[1], *fan_out, metrics=metrics) for path in paths}
+        else: names = {path: SplitFileNames(path, ext, *fan_out) for path in paths}
+        try:
+            for record in reader:
+                record_count += 1
+                metrics.count(record)
+                change = changes.change(record) if changes else None
+                if record.is_malformed():
+                    errors.write(record)
+                    continue
+                if router: router.write(record)
+                if delta and change: delta.write(change, record)
+                if oral_history_path and record.is_oral_history():
+                    path = oral_history_path
+                    metrics.oral_history += 1
+                else:
+                    path = output_path
+                if xml:
+                    if header:
+                        record_to_write = METAG_HEADER + record.header(deleted=deleted)
+                        if not (deleted or record.deleted):
+                            record_to_write += '<metadata>{}\n</metadata>\n'.format(record.as_xml(namespace=True))
+                        record_to_write += '</record>'
+                    else:
+                        record_to_write = '{}{}\n</marc:collection>'.format(XML_HEADER, record.as_xml())
+                name = record.identifier() or '_NO IDENTIFIER {}'.format(str(record_count))
+                if archive[0]:
+                    archives[path].add(name, record_to_write if xml else record.as_marc())
+                    continue
+                # Files are created exclusively, so that parallel conversions cannot claim the same file name
+                for filename in names[path].candidates(name):
+                    try:
+                        current_file = RecordWriter(open(filename, mode='xb'))
+                        break
+                    except FileExistsError: pass
+                metrics.opened(current_file)
+                if xml: current_file.write(record_to_write)
+                else: current_file.write_record(record)
+                metrics.closing(current_file)
+                current_file.close()
+            if delta: delta.write_vanished(changes.vanished())
+        finally:
+            if archive[0]:
+                for path in archives: archives[path].close()
+            if router: router.finish()
+            if delta: delta.finish()
+            metrics.finish()
+            for f in [ifile, router, delta, errors]:
+                if f: f.close()
+        if not quiet: print('{} records processed'.format(str(record_count)), end='\r')
+        return record_count, incremental_entry(input_file, changes, digest, quiet=quiet)
+
+    # All other cases
+    FMT = None
+    record_count, record_count_in_file = 0, 0
+    current_idx = 0
+
+    if limit == 'size':
+        FMT = ".%%0%dd" % (int(log10(os.path.getsize(input_file) / max_size)) + 1)
+
+    mid = FMT % current_idx if limit == 'size' else '.{}'.format(str(current_idx)) if limit == 'number' else ''
+    filename = os.path.join(output_path, root + mid + ext)
+
+    current_file = RecordWriter(open(filename, mode='wb'))
+    if xml: current_file.write(OPEN)
+    metrics.opened(current_file, current_idx)
+    # Files are split by size before they would reach max_size bytes, including the closing elements
+    reserve = len(RecordWriter.encode(CLOSE)) if xml else 0
+
+    try:
+        for record in reader:
+            record_count += 1
+            metrics.count(record)
+            change = changes.change(record) if changes else None
+            if record.is_malformed():
+                errors.write(record)
+                continue
+            record_count_in_file += 1
+            if router: router.write(record)
+            if delta and change: delta.write(change, record)
+
+            if xml:
+                record_to_write = '{}{}{}</record>'.format(OAI_RECORD, record.header(deleted=deleted),
+                                                           '<metadata>{}\n</metadata>\n'.format(record.as_xml(namespace=True)) if not (deleted or record.deleted) else '') if header \
+                    else record.as_xml()
+            else: record_to_write = record.as_marc()
+            # Each record is encoded once: files are split on the size of the bytes which are written
+            record_to_write = RecordWriter.encode(record_to_write)
+
+            # Check whether we need to start a new file
+            if (limit == 'size' and current_file.size + len(record_to_write) + reserve >= max_size) \
+                    or (limit == 'number' and record_count_in_file > max_size):
+                if xml: current_file.write(CLOSE)
+                metrics.closing(current_file)
+                current_file.close()
+                if not quiet:
+                    print('{} records processed'.format(str(record_count)), end='\r')
+                    print('\nFile {} done'.format(str(current_idx)))
+                record_count_in_file = 0
+                current_idx += 1
+                mid = FMT % current_idx if limit == 'size' else '.{}'.format(str(current_idx)) if limit == 'number' else ''
+                filename = os.path.join(output_path, root + mid + ext)
+                current_file = RecordWriter(open(filename, mode='wb'))
+                if xml: current_file.write(OPEN)
+                metrics.opened(current_file, current_idx)
+
+            current_file.write(record_to_write)
+        if delta: delta.write_vanished(changes.vanished())
+    finally:
+        if xml: current_file.write(CLOSE)
+        if not quiet: print('{} records processed'.format(str(record_count)), end='\r')
+        if router: router.finish()
+        if delta: delta.finish()
+        metrics.closing(current_file)
+        metrics.finish()
+        # Close files
+        for f in [ifile, current_file, router, delta, errors]:
+            if f: f.close()
+    return record_count, incremental_entry(input_file, changes, digest, quiet=quiet)
+
+
 # ====================
 #      Main code
 # ====================
@@ -112,11 +469,16 @@ def main(argv=None):
     if argv is None: name = str(sys.argv[1])
     if argv is None: name = str(sys.argv[1])
 
-    xml, split, header, deleted = False, False, False, False
+    xml, split, header, deleted, pipeline, profile = False, False, False, False, False, False
     opts, args = None, None
-    input_path, output_path, oral_history_path = None, None, None
+    input_path, output_path, oral_history_path, routes_file, routes = None, None, None, None, None
+    incremental, manifest, delta_path = None, None, None
     limit = None
     max_size = 1024 * 1024 * 1024
+    jobs = None
+    cprofile_file, metrics_file = None, None
+    fan_out, archive = (None, None), (None, None)
+    metrics_interval = METRICS_INTERVAL
 
     print('========================================')
     print('sami2marc_products')
@@ -127,7 +489,9 @@ to MARC 21 Bibliographic files in MARC exchange (.lex) or MARC XML format\
 """)
 
     try:
-        opts, args = getopt.getopt(argv, 'hi:o:m:p:x', ['input_path=', 'output_path=', 'max_size=', 'oral_history=', 'header', 'help'])
+        opts, args = getopt.getopt(argv, 'hi:o:m:p:j:x', ['input_path=', 'output_path=', 'max_size=', 'oral_history=', 'jobs=',
+                                                          'fan_out=', 'archive=', 'archive_size=', 'routes=', 'incremental=', 'cprofile=', 'metrics=', 'metrics_interval=',
+                                                          'header', 'pipeline', 'profile', 'help'])
     except getopt.GetoptError as err:
         exit_prompt('Error: {0}'.format(err))
     if opts is None or not opts:
@@ -139,23 +503,44 @@ to MARC 21 Bibliographic files in MARC exchange (.lex) or MARC XML format\
             xml = True
         elif opt in ['-h', '--header']:
             header = True
+        elif opt == '--pipeline':
+            pipeline = True
+        elif opt == '--profile':
+            profile = True
+        elif opt == '--cprofile':
+            cprofile_file = arg
+        elif opt == '--metrics':
+            metrics_file = arg
+        elif opt == '--metrics_interval':
+            try: metrics_interval = float(arg)
+            except: metrics_interval = 0
+            if not metrics_interval > 0: exit_prompt('Interval between progress reports could not be interpreted. \n'
+                                                     'Please ensure that it is a positive number of seconds.')
         elif opt in ['-i', '--input_path']:
             input_path = arg
         elif opt in ['-o', '--output_path']:
             output_path = arg
         elif opt in ['-m', '--max_size']:
-            arg = arg.upper()
-            limit = 'size' if 'K' in arg else 'number'
-            try: max_size = int(re.sub(r'[^0-9]', '', arg))
-            except: exit_prompt('Maximum file size could not be interpreted. \n'
-                                'Please ensure that it is a positive integer, \n'
-                                'optionally followed by the suffix K.')
-            if not max_size >= 1: exit_prompt('Maximum file size could not be interpreted. \n'
-                                              'Please ensure that it is a positive integer, \n'
-                                              'optionally followed by the suffix K.')
-            if limit == 'size': max_size *= 1024
+            limit, max_size = parse_max_size(arg)
         elif opt in ['-p', '--oral_history']:
             oral_history_path = arg
+        elif opt == '--routes':
+            routes_file = arg
+        elif opt == '--incremental':
+            if arg not in INCREMENTAL_MODES: exit_prompt('Error: Incremental mode must be one of {}'.format(', '.join(INCREMENTAL_MODES)))
+            incremental = arg
+        elif opt == '--fan_out':
+            fan_out = parse_fan_out(arg)
+        elif opt == '--archive':
+            if arg not in ARCHIVE_FORMATS: exit_prompt('Error: Archive format must be one of {}'.format(', '.join(ARCHIVE_FORMATS)))
+            archive = (arg, archive[1])
+        elif opt == '--archive_size':
+            archive = (archive[0], parse_archive_size(arg))
+        elif opt in ['-j', '--jobs']:
+            try: jobs = int(arg)
+            except: jobs = 0
+            if not jobs >= 1: exit_prompt('Number of jobs could not be interpreted. \n'
+                                          'Please ensure that it is a positive integer.')
         else:
             exit_prompt('Error: Option {} not recognised'.format(opt))
 
@@ -177,6 +562,24 @@ to MARC 21 Bibliographic files in MARC exchange (.lex) or MARC XML format\
 
     if header and not xml:
         exit_prompt('Error: Option --header cannot be used without -x')
+    if fan_out[0] and not (limit == 'number' and max_size == 1):
+        exit_prompt('Error: Option --fan_out can only be used with --max_size 1 or --oral_history')
+    if archive[0] and not (limit == 'number' and max_size == 1):
+        exit_prompt('Error: Option --archive can only be used with --max_size 1 or --oral_history')
+    if archive[1] and not archive[0]:
+        exit_prompt('Error: Option --archive_size cannot be used without --archive')
+    if routes_file: routes = load_routes(routes_file, output_path, xml=xml, separate=(oral_history_path,))
+    if incremental:
+        # Options which change the main output are kept in the manifest
+        manifest = Manifest(output_path, dict(xml=xml, header=header, limit=limit, max_size=max_size,
+                                              oral_history_path=oral_history_path, fan_out=fan_out, archive=archive,
+                                              routes=[str(route) for route in routes or []]))
+        if incremental != 'full':
+            delta_path = os.path.join(output_path, 'delta_{}'.format(datetime.datetime.now().strftime('%Y%m%d_%H%M%S')))
+
+    if profile or cprofile_file:
+        jobs, pipeline = 1, False
+    if jobs is None: jobs = (os.cpu_count() or 1) if pipeline else 1
 
     # --------------------
     # Parameters seem OK => start program
@@ -189,133 +592,103 @@ to MARC 21 Bibliographic files in MARC exchange (.lex) or MARC XML format\
     print('Output format: {0}'.format('MARC XML (.xml)' if xml else 'MARC (.lex)'))
     if oral_history_path:
         print('Output folder for oral histories: {0}'.format(oral_history_path))
+    if routes:
+        print('Records will also be written to sinks:')
+        for route in routes: print('    {}'.format(str(route)))
     if limit:
         if max_size == 1:
             split = True
             print('Output file will be split into individual records')
+            if fan_out[0]: print('Records will be saved in subfolders by {}'.format(fan_out[0]))
+            if archive[0]: print('Records will be saved in {} archives'.format(archive[0]))
         else: print('Maximum file size : {} {}'.format(str(max_size), 'bytes' if limit == 'size' else 'records'))
     if header:
         print('MetAg headers will be used')
+    if incremental:
+        print('Only input files which have changed since the last run will be converted')
+        if incremental != 'full': print('New and changed records will be saved to {}'.format(delta_path))
+        if incremental == 'delta': print('Full output will not be written')
+        if manifest.changed_options and incremental != 'delta':
+            print('Options have changed since the last run: changed files will be converted in full')
+    if pipeline:
+        print('Records will be converted in {} parallel processes'.format(str(jobs)))
+    elif jobs > 1:
+        print('Input files will be converted in {} parallel processes'.format(str(jobs)))
+    if metrics_file: print('Progress reports will be saved to {}'.format(metrics_file))
+    if profile: print('The conversion will be profiled')
+    if cprofile_file: print('cProfile statistics will be saved to {}'.format(cprofile_file))
 
     # --------------------
     # Iterate through input files
     # --------------------
 
-    for file in os.listdir(input_path):
-        root, ext = os.path.splitext(file)
-        deleted = False
-        if ext in ['.xml', '.prn'] or file.endswith(SAMI_SUFFICES) or any(f in root for f in PRIMO_FLAGS):
-            if any(f in root for f in PRIMO_FLAGS):
-                root = root + ext
-                ext = '.xml'
-
-            date_time('Processing file {} ...'.format(str(file)))
-            if '_dels' in root:
-                deleted = True
-                print('File contains deleted records')
-
-            # Open input file
-            ifile = open(os.path.join(input_path, file), mode='r', encoding='utf-8', errors='replace')
-            reader_type = 'prn' if ext == '.prn' else 'xml' if ext == '.xml' else 'txt'
-            ext = '.xml' if xml else '.lex'
-            reader = sami_factory(reader_type=reader_type, target=ifile)
-
-            OPEN = OAI_HEADER if header else XML_HEADER
-            CLOSE = '\n</ListRecords>\n</OAI-PMH>' if header else '\n</marc:collection>'
-
-            # Special case if file is to be split into separate records
-            if split:
-                record_count = 0
-                for record in reader:
-                    record_count += 1
-                    if record_count % 100 == 0:
-                        print('{} records processed'.format(str(record_count)), end='\r')
-                    if oral_history_path and record.is_oral_history:
-                        path = oral_history_path
-                    else:
-                        path = output_path
-                    filename = os.path.join(path, (record.identifier() or '_NO IDENTIFIER {}'.format(str(record_count))) + ext)
-                    file_count = 0
-                    while os.path.isfile(filename):
-                        file_count += 1
-                        filename = os.path.join(path, (record.identifier() or '_NO IDENTIFIER {}'.format(str(record_count))) + '_DUPLICATE {}'.format(str(file_count)) + ext)
-                    if xml:
-                        current_file = open(filename, 'w', encoding='utf-8', errors='replace')
-                        if header:
-                            current_file.write(METAG_HEADER + record.header(deleted=deleted))
-                            if not (deleted or record.deleted):
-                                current_file.write('<metadata>{}\n</metadata>\n'.format(record.as_xml(namespace=True)))
-                            current_file.write('</record>')
-                        else:
-                            current_file.write('{}{}\n</marc:collection>'.format(XML_HEADER, record.as_xml()))
-                    else:
-                        current_file = open(filename, mode='wb')
-                        writer = MARCWriter(current_file)
-                        writer.write(record)
-                    current_file.close()
-                ifile.close()
-                print('{} records processed'.format(str(record_count)), end='\r')
-                continue
-
-            # All other cases
-            FMT = None
-            record_count, record_count_in_file = 0, 0
-            current_idx, current_size = 0, 0
-
-            if limit == 'size':
-                FMT = ".%%0%dd" % (int(log10(os.path.getsize(os.path.join(input_path, file)) / max_size)) + 1)
-
-            mid = FMT % current_idx if limit == 'size' else '.{}'.format(str(current_idx)) if limit == 'number' else ''
-            filename = os.path.join(output_path, root + mid + ext)
-
-            if xml:
-                current_file = open(filename, 'w', encoding='utf-8', errors='replace')
-                current_file.write(OPEN)
-            else:
-                current_file = open(filename, mode='wb')
-                writer = MARCWriter(current_file)
-
-            for record in reader:
-                record_count += 1
-                record_count_in_file += 1
-                if record_count % 100 == 0:
-                    print('{} records processed'.format(str(record_count)), end='\r')
-
-                # Check whether we need to start a new file
-                current_size += len(record.as_xml()) if xml else len(record.as_marc())
-                if (limit == 'size' and current_size >= max_size) \
-                        or (limit == 'number' and record_count_in_file > max_size):
-                    if xml: current_file.write(CLOSE)
-                    current_file.close()
-                    print('{} records processed'.format(str(record_count)), end='\r')
-                    print('\nFile {} done'.format(str(current_idx)))
-                    current_size = len(record.as_xml()) if xml else len(record.as_marc())
-                    record_count_in_file = 0
-                    current_idx += 1
-                    mid = FMT % current_idx if limit == 'size' else '.{}'.format(str(current_idx)) if limit == 'number' else ''
-                    filename = os.path.join(output_path, root + mid + ext)
-                    if xml:
-                        current_file = open(filename, 'w', encoding='utf-8', errors='replace')
-                        current_file.write(OPEN)
-                    else:
-                        current_file = open(filename, mode='wb')
-                        writer = MARCWriter(current_file)
-
-                record_to_write = '{}{}{}</record>'.format(OAI_RECORD, record.header(deleted=deleted),
-                                                           '<metadata>{}\n</metadata>\n'.format(record.as_xml(namespace=True)) if not (deleted or record.deleted) else '') if header \
-                    else record.as_xml()
-
-                if xml: current_file.write(record_to_write)
-                else: writer.write(record)
-
-            if xml: current_file.write(CLOSE)
-            print('{} records processed'.format(str(record_count)), end='\r')
-            # Close files
-            for f in [ifile, current_file]:
-                f.close()
+    listing = os.listdir(input_path)
+    files = [file for file in listing if is_input_file(file)]
+    options = dict(input_path=input_path, output_path=output_path, oral_history_path=oral_history_path,
+                   xml=xml, header=header, split=split, limit=limit, max_size=max_size,
+                   metrics_file=metrics_file, metrics_interval=metrics_interval, fan_out=fan_out,
+                   archive=archive, routes=routes, incremental=incremental, delta_path=delta_path)
+
+    # Reports from all the input files are appended to the same metrics file
+    if metrics_file:
+        try: open(metrics_file, mode='w', encoding='utf-8').close()
+        except: exit_prompt('Error: Could not create metrics file {}'.format(metrics_file))
+
+    if manifest:
+        # Input files are skipped if their size and modification time have not changed;
+        # files which have been removed since the last run are removed from the manifest
+        unchanged = {file for file in files if manifest.unchanged(input_path, file, full=incremental != 'delta')}
+        if unchanged: print('\n{} input files have not changed since the last run'.format(str(len(unchanged))))
+        files = [file for file in files if file not in unchanged]
+        present = set(listing)
+        for file in [file for file in manifest.files if file not in present]:
+            entry = manifest.files.pop(file)
+            if delta_path: DeltaWriter(delta_path, output_root(file)[0]).write_vanished(list(entry['records']))
+
+    # The manifest is saved even if the run is interrupted, with the entries of the files converted so far
+    failed = []
+    try:
+        if jobs == 1 or pipeline:
+            profiler = Profiler(stages=profile, cprofile_file=cprofile_file)
+            profiler.start()
+            for file in files:
+                # An input file which cannot be converted is reported, and its manifest entry (if any) is not updated
+                try: record_count, entry = convert_file(file, pipeline_jobs=jobs if pipeline else 0,
+                                                        previous=manifest and manifest.files.get(file), **options)
+                except Exception as err:
+                    print('\nError processing file {}: {}'.format(file, err))
+                    failed.append(file)
+                    continue
+                if entry: manifest.files[file] = entry
+            profiler.stop()
 
-    date_time_exit()
+        else:
+            # Start with the largest files, so that a large file is not left to run on its own at the end
+            files.sort(key=lambda f: os.path.getsize(os.path.join(input_path, f)), reverse=True)
+            print('\n\nConverting {} files using {} processes ...'.format(str(len(files)), str(jobs)))
+            total_count, done = 0, 0
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = {executor.submit(convert_file, file, quiet=True, previous=manifest and manifest.files.get(file),
+                                           **options): file for file in files}
+                for future in as_completed(futures):
+                    done += 1
+                    try: record_count, entry = future.result()
+                    except Exception as err:
+                        print('Error processing file {}: {}'.format(futures[future], err))
+                        failed.append(futures[future])
+                        continue
+                    if entry: manifest.files[futures[future]] = entry
+                    total_count += record_count
+                    print('File {} done: {} records ({} of {} files complete, {} records processed)'.format(
+                        futures[future], str(record_count), str(done), str(len(files)), str(total_count)))
+    finally:
+        if manifest: manifest.save()
+
+    # The exit status is 1 if any input file could not be converted
+    if failed: print('\n{} input files could not be converted: {}'.format(str(len(failed)), ', '.join(sorted(failed))))
+    date_time_exit(1 if failed else None)
 
 if __name__ == '__main__':
+    freeze_support()
     main(sys.argv[1:])
 
@@ -4,6 +4,12 @@
 
 # Import required modules
 
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import mmap
+from xml.parsers import expat
 from sami.sami_functions import *
 
 __author__ = 'Victoria Morris'
@@ -18,21 +24,41 @@ __status__ = '4 - Beta Development'
 
 LEADER_LENGTH, DIRECTORY_ENTRY_LENGTH = 24, 12
 SUBFIELD_INDICATOR, END_OF_FIELD, END_OF_RECORD = chr(0x1F), chr(0x1E), chr(0x1D)
+SUBFIELD_INDICATOR_BYTES, END_OF_FIELD_BYTES = SUBFIELD_INDICATOR.encode('ascii'), END_OF_FIELD.encode('ascii')
 ALEPH_CONTROL_FIELDS = ['DB ', 'SYS', 'LDR']
 
+# Number of characters read from SAMI input files at a time
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Number of bytes gathered by a RecordWriter before they are written
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Values taken from the OAI headers of records (if there are any), with patterns to find them in the text of the records
+OAI_HEADER_VALUES = [(name, re.compile(r'<{0}>(.*?)</{0}>'.format(name))) for name in ('identifier', 'datestamp')]
+
+# Number of records passed to a worker process at a time by record_pipeline
+PIPELINE_BATCH_SIZE = 250
+
+# Subfields of the 999 fields generated for items in PRN files, in order, with the item elements from which they are taken
 SUBS = OrderedDict([
-    ('c', re.compile(r'<copyNumber>(.*?)</copyNumber>')),
-    ('i', re.compile(r'<itemID>(.*?)</itemID>')),
-    ('d', re.compile(r'<dateCreated>(.*?)</dateCreated>')),
-    ('k', re.compile(r'<location>(.*?)</location>')),
-    ('l', re.compile(r'<homeLocation>(.*?)</homeLocation>')),
+    ('c', 'copyNumber'),
+    ('i', 'itemID'),
+    ('d', 'dateCreated'),
+    ('k', 'location'),
+    ('l', 'homeLocation'),
     ('m', None),
-    ('t', re.compile(r'<type>(.*?)</type>')),
-    ('u', re.compile(r'<dateModified>(.*?)</dateModified>')),
-    ('x', re.compile(r'<category1>(.*?)</category1>')),
-    ('z', re.compile(r'<category2>(.*?)</category2>')),
+    ('t', 'type'),
+    ('u', 'dateModified'),
+    ('x', 'category1'),
+    ('z', 'category2'),
 ])
 
+# Elements of PRN files which are used in records, in a single pattern so that each record can be parsed in one pass:
+# marcEntry elements (within a single line), the start and end of call and item elements, and the text elements within them
+PRN_TOKENS = re.compile(r'<(?:marcEntry tag="(.*?)" label="(.*?)" ind="(.*?)">(.*?)</marcEntry>'
+                        r'|(/?)(call|item)>'
+                        r'|(callNumber|library|' + '|'.join(e for e in SUBS.values() if e) + r')>([\s\S]*?)</\7>)')
+
 
 XML_HEADER = '<?xml version="1.0" encoding="UTF-8" ?>' \
              '\n<marc:collection xmlns:marc="http://www.loc.gov/MARC21/slim" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' \
@@ -61,6 +87,11 @@ OAI_RECORD = '\n<record ' \
              'xmlns:bl="http://www.bl.uk/schemas/digitalobject/entities#" ' \
              'xmlns:blit="http://bl.uk/namespaces/blit">'
 
+MARCXML_RECORD = '\n\t<marc:record>'
+
+MARCXML_RECORD_NS = '\n\t<marc:record xsi:schemaLocation="http://www.loc.gov/MARC21/slim ' \
+                    'http://www.loc.gov/standards/marcxml/schema/MARC21slim.xsd">'
+
 
 # ====================
 #     Exceptions
@@ -95,6 +126,13 @@ class RecordWritingError(Exception):
     def __str__(self): return 'Error writing record'
 
 
+class XMLParsingError(Exception):
+    def __init__(self, error):
+        self.error = error
+
+    def __str__(self): return 'Error parsing XML: {}'.format(self.error)
+
+
 # ====================
 #       Classes
 # ====================
@@ -110,16 +148,34 @@ def sami_factory(reader_type, target, tidy=False):
         return SAMIReaderXML(target, tidy)
     if reader_type == 'txt':
         return SAMIReaderText(target, tidy)
+    if reader_type == 'headers':
+        return SAMIReaderHeaders(target, tidy)
     raise Exception(f'The reader_type {reader_type} is not supported.')
 
 
 class SAMIReader(object):
+    """Base class for reading records from SAMI files.
+
+    Input is read in large blocks, and each block is searched for record boundaries with a
+    single compiled regular expression, so that records are sliced from the block rather
+    than being built up line by line.
+    BOUNDARY is a pattern which matches (at least) every line for which new_record() is True;
+    the boundary line is taken to be the line containing the end of the match.
+    Candidate lines found by the pattern are confirmed with new_record().
+    """
+
+    BOUNDARY = r'(?!)'
 
     def __init__(self, target, tidy=False):
         if hasattr(target, 'read') and callable(target.read):
             self.file_handle = target
         self.deleted = '_dels' in str(target)
         self.tidy = tidy
+        self.block_size = READ_BLOCK_SIZE
+        self._boundary = re.compile(self.boundary())
+        # The buffer always starts with the line break preceding the first unread line
+        self._buffer, self._first, self._eof = '\n', 1, False
+        self._chunks = deque()
 
     def __iter__(self):
         return self
@@ -130,18 +186,46 @@ class SAMIReader(object):
             self.file_handle = None
 
     def __next__(self):
-        chunk = ''
-        line = self.file_handle.readline()
-        if not line: raise StopIteration
-        while chunk == '' and line and (self.new_record(line) or self.while_chunk(line)):
-            line = self.file_handle.readline()
-            if not line: break
-        while line and not self.new_record(line):
-            chunk += line
-            line = self.file_handle.readline()
-            if not line: break
-        if not chunk: raise StopIteration
-        return self.record(data=chunk, tidy=self.tidy)
+        return self.record(data=self.next_chunk(), tidy=self.tidy)
+
+    def next_chunk(self):
+        """Return the raw text of the next record in the file"""
+        while not self._chunks:
+            if self._eof: raise StopIteration
+            self._read_block()
+        return self._chunks.popleft()
+
+    def _read_block(self):
+        # If the buffer already holds more than a block (i.e. a very long record),
+        # read as much again, so that the cost of extending the buffer stays linear
+        block = self.file_handle.read(max(self.block_size, len(self._buffer)))
+        buffer = self._buffer + block
+        if not block:
+            self._eof = True
+            end = len(buffer)
+        else: end = buffer.rfind('\n') + 1
+        start, first = 1, self._first
+        for match in self._boundary.finditer(buffer, first - 1, end):
+            line_start = buffer.rfind('\n', 0, match.end()) + 1
+            if line_start < first or line_start >= end: continue
+            line_end = buffer.find('\n', match.end(), end) + 1 or end
+            first = line_end
+            if self.new_record(buffer[line_start:line_end]):
+                self._add_chunk(buffer, start, line_start)
+                start = line_end
+        if self._eof: self._add_chunk(buffer, start, end)
+        else: self._buffer, self._first = buffer[start - 1:], end - start + 1
+
+    def _add_chunk(self, buffer, start, stop):
+        # Lines at the start of a record are skipped if while_chunk() is True
+        while start < stop:
+            line_end = buffer.find('\n', start, stop) + 1 or stop
+            if not self.while_chunk(buffer[start:line_end]): break
+            start = line_end
+        if start < stop: self._chunks.append(buffer[start:stop])
+
+    def boundary(self):
+        return self.BOUNDARY
 
     def while_chunk(self, line):
         if 'xmlns:xsi' in line: return True
@@ -156,6 +240,8 @@ class SAMIReader(object):
 
 class SAMIReaderAuthorities(SAMIReader):
 
+    BOUNDARY = r'\n(?=\.end|[^\S\n]*(?:\n|\Z))'
+
     def __init__(self, target, tidy=False):
         super().__init__(target, tidy)
 
@@ -175,6 +261,8 @@ class SAMIReaderAuthorities(SAMIReader):
 
 class SAMIReaderText(SAMIReader):
 
+    BOUNDARY = r'\*\*\* DOCUMENT BOUNDARY \*\*\*'
+
     def __init__(self, target, tidy=False):
         super().__init__(target, tidy)
 
@@ -188,6 +276,12 @@ class SAMIReaderText(SAMIReader):
 
 class SAMIReaderPRN(SAMIReader):
 
+    BOUNDARY = r'<(?:\?xml version|title>|report>|/report>|dateFormat>|catalog>|dateCreated>[0-9]{4}-[0-9]{2}-[0-9]{2}T)'
+    # Lines which begin a new record: those containing one of the tags, or consisting of a single timestamp
+    # (kept as two patterns, since an alternation with an anchored branch defeats the search for '<')
+    NEW_RECORD_TAG = re.compile(r'<(?:\?xml version|title>|report>|/report>|dateFormat>|catalog>)')
+    NEW_RECORD_TIMESTAMP = re.compile(r'\s*<dateCreated>[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}</dateCreated>\s*\Z')
+
     def __init__(self, target, tidy=False):
         super().__init__(target, tidy)
 
@@ -195,29 +289,360 @@ class SAMIReaderPRN(SAMIReader):
         return SAMIRecordPRN(data=data, tidy=tidy)
 
     def new_record(self, line):
-        if any(s in line for s in ['<?xml version', '<title>', '<report>', '</report>', '<dateFormat>', '<catalog>']): return True
-        if re.search(r'^<dateCreated>[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}</dateCreated>$', line.strip()): return True
-        return False
+        return self.NEW_RECORD_TAG.search(line) is not None or self.NEW_RECORD_TIMESTAMP.match(line) is not None
 
 
 class SAMIReaderXML(SAMIReader):
+    """Reads records from XML files (usually OAI-PMH harvests) with an incremental XML parser,
+    rather than splitting the file into records line by line."""
 
     def __init__(self, target, tidy=False):
         super().__init__(target, tidy)
+        self._parser = None
+
+    def __next__(self):
+        parsed = self._next_parsed(fields=True)
+        return SAMIRecordXML(data=parsed[0], tidy=self.tidy, parsed=parsed if parsed[1] is not None else None)
+
+    def next_chunk(self):
+        """Return the raw text of the next record in the file"""
+        return self._next_parsed(fields=False)[0]
+
+    def _next_parsed(self, fields):
+        # The fields of records are only parsed if the first record is read with __next__ rather than next_chunk
+        if self._parser is None: self._parser = XMLRecordParser(fields=fields)
+        while not self._parser.records:
+            if self._eof: raise StopIteration
+            block = self.file_handle.read(self.block_size)
+            if block: self._parser.feed(block)
+            else:
+                self._parser.close()
+                self._eof = True
+        return self._parser.records.popleft()
 
     def record(self, data, tidy):
         return SAMIRecordXML(data=data, tidy=tidy)
 
-    def new_record(self, line):
-        if any(s in line for s in ['<record xmlns="http://www.loc.gov/mods/v3">', '<record xmlns:rdf=', '<?xml version',
-                                   '<OAI-PMH', '</OAI-PMH>', '<ListRecords>', '</ListRecords>']): return True
-        if self.deleted and any(s in line for s in ['<record>', 'xmlns="http://www.openarchives.org/OAI/2.0/"',
-                                                    'xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/',
-                                                    'http://www.openarchives.org/OAI/2.0/OAI- PMH.xsd"']): return True
-        return False
+
+class SAMIReaderHeaders(SAMIReaderXML):
+    """Reads only the OAI headers of records from XML files, for files of deleted records whose output is just a header.
+
+    Records are SAMIHeaderRecords: only the OAI header and any field 001 of each record are parsed,
+    and no MARCRecord is built. If the file starts with records which are just deleted headers, as in OAI-PMH harvests,
+    records are not parsed at all where possible: the identifier and datestamp are taken from the text of the record.
+    """
+
+    # A record consisting of nothing but a deleted header, whose values can be read without parsing the XML
+    DELETED_HEADER = re.compile(r'<record(?:\s[^>]*)?>\s*<header status="deleted">\s*<identifier>([^<]*)</identifier>\s*'
+                                r'<datestamp>([^<]*)</datestamp>\s*</header>\s*</record>')
+
+    def __next__(self):
+        if self._parser is None: self._start_parser()
+        if self._parser.headers: return SAMIHeaderRecord(self._next_parsed(fields=True), tidy=self.tidy)
+        return self.record(self._next_parsed(fields=False)[0], tidy=self.tidy)
+
+    def record(self, data, tidy):
+        match = self.DELETED_HEADER.fullmatch(data)
+        if match is None: return SAMIHeaderRecord(XMLRecordParser.parse(data, headers=True), tidy=tidy)
+        # Values are taken from the text of the elements, as they are by XMLRecordParser
+        identifier, datestamp = (value.replace('\n', '').strip() for value in match.groups())
+        return SAMIHeaderRecord((data, [], {'status': 'deleted', 'identifier': identifier, 'datestamp': datestamp}), tidy=tidy)
+
+    def _start_parser(self):
+        # If the first block of the file holds no fields, records are expected to be just deleted headers,
+        # and only their text is found by the parser; otherwise only their headers and fields 001 are parsed
+        block = self.file_handle.read(self.block_size)
+        headers = 'controlfield' in block or 'datafield' in block
+        self._parser = XMLRecordParser(fields=False, headers=headers)
+        if block: self._parser.feed(block)
+        else:
+            self._parser.close()
+            self._eof = True
+
+
+class XMLRecordParser(object):
+    """Incremental parser for MARC XML records, including records in OAI-PMH harvests.
+
+    Input is passed to feed() as it is read. As soon as the end of a record has been parsed,
+    a tuple (raw text, fields, header) is added to records, where header is a dictionary
+    holding the identifier, datestamp and status from the OAI header of the record.
+    If fields is False, only the raw text of each record is found, and fields and header are None.
+    If headers is True, only the header and any fields with tag 001 (which are empty for data fields) are parsed.
+    The outermost element named record (with any namespace prefix) is taken to be a record.
+    No document tree is built, and only the text of the current record is kept,
+    so that files of any size can be parsed in constant memory.
+    Several XML documents (e.g. pages of a harvest) may be concatenated in the input.
+
+    Field values are taken from the raw text of the elements, with line breaks removed,
+    as they were by the regular expressions which this parser replaces.
+
+    A record which is not well-formed (e.g. with a bare & or an HTML entity) does not stop the parse: the input is skipped
+    to the start of the next record with the same element name, and the fields and header of the malformed record
+    are found with regular expressions instead (see tolerant_parse), as they were before this parser was used.
+    Only if the record cannot be recovered, because it has no end tag (e.g. at the end of a truncated file),
+    is the tuple (raw text, None, None) added to records, so that it can be reported (see SAMIRecordXML).
+    """
+
+    START_TAG = re.compile(rb'<[^\s/>]+(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>')
+    RECORD_START = re.compile(rb'<(?:[^\s/>:]+:)?record[\s/>]')
+    RESTART_ERRORS = {expat.errors.codes[expat.errors.XML_ERROR_JUNK_AFTER_DOC_ELEMENT],
+                      expat.errors.codes[expat.errors.XML_ERROR_MISPLACED_XML_PI]}
+    # Elements (with any namespace prefix) and attributes of records which are not well-formed (see tolerant_parse)
+    TOLERANT_ELEMENT = r'<(?:[^\s/>:]+:)?({})(\s[^>]*?)?\s*(?:/>|>(.*?)</(?:[^\s/>:]+:)?\1\s*>)'
+    TOLERANT_FIELD = re.compile(TOLERANT_ELEMENT.format('controlfield|datafield|header'), re.S)
+    TOLERANT_SUBFIELD = re.compile(TOLERANT_ELEMENT.format('subfield'), re.S)
+    TOLERANT_HEADER_VALUE = re.compile(TOLERANT_ELEMENT.format('identifier|datestamp'), re.S)
+    TOLERANT_ATTRIBUTE = re.compile(r'([^\s=]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+    def __init__(self, fields=True, headers=False):
+        self.fields, self.headers = fields, headers
+        self.records = deque()
+        # Raw input, starting at byte offset _offset, from which the text of records and fields is sliced
+        self._raw, self._offset = b'', 0
+        # Position of the start or end tag of the most recent record
+        self._position = 0
+        self._depth, self._record_start = 0, None
+        # Element names without namespace prefixes, by qualified name
+        self._names = dict()
+        # After an error, the position from which the next record is searched for, and the start and element name
+        # of the malformed record (or None if the error was outside a record)
+        self._skip, self._skip_start, self._skip_name = None, None, None
+        self._new_parser(0)
+
+    @classmethod
+    def parse(cls, data, headers=False):
+        """Parse the text of a single record, returning a tuple (raw text, fields, header)"""
+        parser = cls(headers=headers)
+        parser.feed(data)
+        parser.close()
+        if parser.records: return parser.records[0]
+        return data, [], {}
+
+    @classmethod
+    def tolerant_parse(cls, data, headers=False):
+        """Parse the text of a single record which is not well-formed with regular expressions,
+        returning a tuple (raw text, fields, header) with the same fields and header as the parser would find:
+        values are taken from the raw text of the elements, with line breaks removed"""
+        control_fields, data_fields, header = [], [], {}
+        for match in cls.TOLERANT_FIELD.finditer(data):
+            name, attributes, content = match.group(1), cls._tolerant_attributes(match.group(2)), (match.group(3) or '').replace('\n', '')
+            if name == 'header':
+                if 'status' in attributes: header['status'] = attributes['status']
+                for value in cls.TOLERANT_HEADER_VALUE.finditer(content):
+                    if value.group(1) not in header: header[value.group(1)] = (value.group(3) or '').strip()
+            elif headers:
+                if '%03s' % attributes.get('tag', '') != '001': continue
+                if name == 'controlfield': control_fields.append(Field(tag='001', data=content))
+                else: data_fields.append(Field(tag='001'))
+            elif name == 'controlfield':
+                control_fields.append(Field(tag=attributes.get('tag', ''), data=content))
+            else:
+                subfields = []
+                for subfield in cls.TOLERANT_SUBFIELD.finditer(content):
+                    code = cls._tolerant_attributes(subfield.group(2)).get('code', '')
+                    if len(code) == 1: subfields.extend([code, subfield.group(3) or ''])
+                indicators = [(attributes.get('ind1') or ' ')[0], (attributes.get('ind2') or ' ')[0]]
+                data_fields.append(Field(tag=attributes.get('tag', ''), indicators=indicators, subfields=subfields))
+        return data, control_fields + data_fields, header
+
+    @classmethod
+    def _tolerant_attributes(cls, text):
+        if not text: return {}
+        return {m.group(1): m.group(2) if m.group(2) is not None else m.group(3)
+                for m in cls.TOLERANT_ATTRIBUTE.finditer(text)}
+
+    def feed(self, data):
+        if isinstance(data, str): data = data.encode('utf-8')
+        self._raw += data
+        if self._skip is None: self._parse(data, False)
+        elif self._resume(False): self._parse(self._raw[self._base - self._offset:], False)
+        # Discard any input which is no longer needed
+        keep = self._position if self._record_start is None else self._record_start
+        if keep > self._offset:
+            self._raw, self._offset = self._raw[keep - self._offset:], keep
+
+    def close(self):
+        if self._skip is None:
+            if self._started: self._parse(b'', True)
+        elif self._resume(True): self._parse(self._raw[self._base - self._offset:], True)
+
+    def _new_parser(self, base):
+        # base is the byte offset in the input at which the parser starts
+        self._parser, self._base, self._started = expat.ParserCreate(encoding='utf-8'), base, False
+        if self.headers: self._parser.StartElementHandler, self._parser.EndElementHandler = self._start_header, self._end_header
+        elif self.fields: self._parser.StartElementHandler, self._parser.EndElementHandler = self._start, self._end
+        else: self._parser.StartElementHandler, self._parser.EndElementHandler = self._start_record, self._end_record
+
+    def _parse(self, data, final):
+        while True:
+            try:
+                self._parser.Parse(data, final)
+                return
+            except expat.ExpatError as e:
+                position = self._base + self._parser.ErrorByteIndex
+                # Start a new parser at the beginning of the next document, or after a malformed record, at the next record
+                if e.code in self.RESTART_ERRORS and self._depth == 0: self._new_parser(position)
+                elif not self._recover(position, final): return
+                data = self._raw[self._base - self._offset:]
+
+    def _recover(self, position, final):
+        # Skip the rest of the current record (if any), starting again at the next record with the same name
+        if self._depth:
+            self._skip_start = self._record_start
+            self._skip_name = re.match(rb'<([^\s/>]+)', self._raw[self._record_start - self._offset:]).group(1)
+        else: self._skip_start, self._skip_name = None, None
+        self._depth, self._skip, self._position = 0, position, position
+        return self._resume(final)
+
+    def _resume(self, final):
+        # Return True if a new parser has been started at the next record
+        name = self._skip_name
+        pattern = re.compile(b'<' + re.escape(name) + rb'[\s/>]') if name else self.RECORD_START
+        match = pattern.search(self._raw, self._skip - self._offset)
+        if match is None and not final:
+            # The start tag of the next record may be split between blocks
+            self._skip = max(self._skip, len(self._raw) + self._offset - 256)
+            return False
+        end = match.start() + self._offset if match else len(self._raw) + self._offset
+        if self._skip_start is not None:
+            # The malformed record ends with its last end tag before the next record
+            text = self._raw[self._skip_start - self._offset:end - self._offset]
+            closing = [m.end() for m in re.finditer(b'</' + re.escape(name) + rb'\s*>', text)]
+            text = (text[:closing[-1]] if closing else text.rstrip()).decode('utf-8', errors='replace')
+            if closing and (self.fields or self.headers): self.records.append(self.tolerant_parse(text, self.headers))
+            else: self.records.append((text, None, None))
+        self._skip, self._skip_start, self._skip_name, self._record_start = None, None, None, None
+        if match is None: return False
+        self._position = end
+        self._new_parser(end)
+        return True
+
+    def _content_start(self):
+        # Return the position following the current start tag, or None if the element is empty
+        raw, start = self._raw, self._base + self._parser.CurrentByteIndex - self._offset
+        end = raw.index(b'>', start)
+        if raw.count(b'"', start, end) % 2 or raw.count(b"'", start, end) % 2:
+            # The first > is within an attribute value
+            end = self.START_TAG.match(raw, start).end() - 1
+        if raw[end - 1] == 47: return None
+        return end + 1 + self._offset
+
+    def _content(self):
+        # Return the content of the element ending at the current position
+        if self._content_from is None: return ''
+        return self._raw[self._content_from - self._offset:self._base + self._parser.CurrentByteIndex - self._offset]\
+            .decode('utf-8').replace('\n', '')
+
+    def _local_name(self, name):
+        # Return the name of an element without any namespace prefix
+        local = self._names[name] = name.rpartition(':')[2]
+        return local
+
+    def _open_record(self):
+        self._depth, self._started = 1, True
+        self._position = self._record_start = self._base + self._parser.CurrentByteIndex
+        # An empty record element has no end tag
+        if self._content_start() is None:
+            self._record_end = self.START_TAG.match(self._raw, self._record_start - self._offset).end() + self._offset
+        else: self._record_end = None
+
+    def _close_record(self, fields, header):
+        self._position = self._base + self._parser.CurrentByteIndex
+        end = self._record_end or self._raw.index(b'>', self._position - self._offset) + 1 + self._offset
+        self.records.append((self._raw[self._record_start - self._offset:end - self._offset].decode('utf-8'), fields, header))
+        self._record_start = None
+
+    def _start_record(self, name, attributes):
+        self._started = True
+        if self._depth: self._depth += 1
+        elif (self._names.get(name) or self._local_name(name)) == 'record': self._open_record()
+
+    def _end_record(self, name):
+        if not self._depth: return
+        self._depth -= 1
+        if not self._depth: self._close_record(None, None)
+
+    def _start(self, name, attributes):
+        self._started = True
+        name = self._names.get(name) or self._local_name(name)
+        if self._depth:
+            self._depth += 1
+            if name == 'subfield':
+                if self._subfields is not None: self._code, self._content_from = attributes.get('code', ''), self._content_start()
+            elif name == 'datafield':
+                self._tag, self._subfields = attributes.get('tag', ''), []
+                self._indicators = [(attributes.get('ind1') or ' ')[0], (attributes.get('ind2') or ' ')[0]]
+            elif name == 'controlfield':
+                self._tag, self._content_from = attributes.get('tag', ''), self._content_start()
+            elif name == 'header':
+                self._in_header = True
+                if 'status' in attributes: self._header['status'] = attributes['status']
+            elif name in ('identifier', 'datestamp') and self._in_header:
+                self._content_from = self._content_start()
+        elif name == 'record':
+            self._open_record()
+            self._header, self._in_header = {}, False
+            self._control_fields, self._data_fields, self._subfields = [], [], None
+
+    def _end(self, name):
+        if not self._depth: return
+        self._depth -= 1
+        name = self._names.get(name) or self._local_name(name)
+        if name == 'subfield':
+            if self._subfields is not None and len(self._code) == 1: self._subfields.extend([self._code, self._content()])
+        elif name == 'datafield':
+            self._data_fields.append(Field(tag=self._tag, indicators=self._indicators, subfields=self._subfields))
+            self._subfields = None
+        elif name == 'controlfield':
+            self._control_fields.append(Field(tag=self._tag, data=self._content()))
+        elif name == 'header':
+            self._in_header = False
+        elif name in ('identifier', 'datestamp') and self._in_header and name not in self._header:
+            self._header[name] = self._content().strip()
+        # Control fields are added to the record before data fields
+        if not self._depth: self._close_record(self._control_fields + self._data_fields, self._header)
+
+    def _start_header(self, name, attributes):
+        self._started = True
+        name = self._names.get(name) or self._local_name(name)
+        if self._depth:
+            self._depth += 1
+            if name in ('controlfield', 'datafield'):
+                self._tag = '%03s' % attributes.get('tag', '')
+                if name == 'controlfield' and self._tag == '001': self._content_from = self._content_start()
+            elif name == 'header':
+                self._in_header = True
+                if 'status' in attributes: self._header['status'] = attributes['status']
+            elif name in ('identifier', 'datestamp') and self._in_header:
+                self._content_from = self._content_start()
+        elif name == 'record':
+            self._open_record()
+            self._header, self._in_header = {}, False
+            self._control_fields, self._data_fields = [], []
+
+    def _end_header(self, name):
+        if not self._depth: return
+        self._depth -= 1
+        name = self._names.get(name) or self._local_name(name)
+        if name in ('controlfield', 'datafield'):
+            if self._tag == '001':
+                if name == 'controlfield': self._control_fields.append(Field(tag='001', data=self._content()))
+                else: self._data_fields.append(Field(tag='001'))
+            self._tag = None
+        elif name == 'header':
+            self._in_header = False
+        elif name in ('identifier', 'datestamp') and self._in_header and name not in self._header:
+            self._header[name] = self._content().strip()
+        if not self._depth: self._close_record(self._control_fields + self._data_fields, self._header)
 
 
 class SAMIRecord(object):
+    """Base class for records read from SAMI files.
+
+    data is the raw text of the record, which subclasses release (with release()) once it has been parsed,
+    so that records do not keep their source text alive. The identifier and datestamp from any OAI header
+    are kept in oai_header, and the identifier of the record is kept until the record is changed.
+    """
 
     def __init__(self, data, tidy=False):
         self.record = MARCRecord()
@@ -225,6 +650,22 @@ class SAMIRecord(object):
         self.deleted = '<header status="deleted">' in data
         self.tidy = tidy
         self.error = False
+        self.oai_header, self._identifier = None, None
+
+    def release(self):
+        """Release the raw text of the record, keeping the identifier and datestamp from any OAI header"""
+        self._oai_header()
+        self.data = None
+
+    def _oai_header(self):
+        if self.oai_header is None:
+            self.oai_header = {}
+            for name, pattern in OAI_HEADER_VALUES:
+                # Most records have no OAI header, so the text is searched for the tags before the pattern is used
+                if '<{}>'.format(name) not in self.data: continue
+                match = pattern.search(self.data)
+                if match: self.oai_header[name] = match.group(1).strip()
+        return self.oai_header
 
     def as_marc(self):
         return self.record.as_marc()
@@ -236,14 +677,15 @@ class SAMIRecord(object):
         return str(self.record)
 
     def identifier(self):
-        try: return clean_text(self.record['001'].data.replace('CKEY', '').strip())
-        except:
-            try: return clean_text(re.search(r'<identifier>(.*?)</identifier>', self.data).group(1).strip())
-            except: return None
+        version = self.record.version()
+        if self._identifier is None or self._identifier[0] != version:
+            try: identifier = clean_text(self.record['001'].data.replace('CKEY', '').strip())
+            except: identifier = clean_text(self._oai_header().get('identifier'))
+            self._identifier = (version, identifier)
+        return self._identifier[1]
 
     def datestamp(self):
-        try: return re.search(r'<datestamp>(.*?)</datestamp>', self.data).group(1).strip()
-        except: return '[NO DATESTAMP]'
+        return self._oai_header().get('datestamp', '[NO DATESTAMP]')
 
     def header(self, deleted=False):
         if self.deleted or deleted:
@@ -258,6 +700,14 @@ class SAMIRecord(object):
     def is_bad(self):
         return self.error
 
+    def is_malformed(self):
+        """Return True if the record could not be parsed (see XMLRecordParser), in which case data is its raw text"""
+        return self.error and self.data is not None
+
+    def matches(self, predicate):
+        """Return the result of a predicate which tests the fields of the record (see sami_routing)"""
+        return predicate.match(self.record)
+
     def is_oral_history(self):
         ark = False
         if '975' not in self.record:
@@ -285,12 +735,12 @@ class SAMIRecordAuthorities(SAMIRecord):
 
         if self.tidy:
             if self.created != 'NEVER':
-                try: self.created = datetime.datetime.strftime(datetime.datetime.strptime(self.created, '%d/%m/%Y'), '%Y%m%d')
+                try: self.created = reformat_date(self.created)
                 except:
                     print('Error parsing created date')
                     self.error = True
             if self.modified != 'NEVER':
-                try: self.modified = datetime.datetime.strftime(datetime.datetime.strptime(self.modified, '%d/%m/%Y'), '%Y%m%d')
+                try: self.modified = reformat_date(self.modified)
                 except:
                     print('Error parsing modified date')
                     self.error = True
@@ -331,6 +781,7 @@ class SAMIRecordAuthorities(SAMIRecord):
                 else:
                     print('Failed to add 001')
                     self.error = True
+        self.release()
 
 
 class SAMIRecordPRN(SAMIRecord):
@@ -338,69 +789,110 @@ class SAMIRecordPRN(SAMIRecord):
     def __init__(self, data, tidy=False):
         super().__init__(data, tidy)
 
-        for field in re.findall(r'<marcEntry tag="(.*?)" label="(.*?)" ind="(.*?)">(.*?)</marcEntry>', self.data):
-            tag, label, ind1, ind2, content = field[0], field[1], field[2][0], field[2][1], field[3]
-            try: test = int(tag)
-            except: test = None
-            if tag == '000' or (test and test < 10) or tag in ALEPH_CONTROL_FIELDS:
-                try: f = Field(tag=tag, data=content.split('|a', 1)[1].strip())
-                except: f = Field(tag=tag, data=content.strip())
-            else:
-                subfields = []
-                for s in content.split('|')[1:]:
-                    try: subfields.extend([s[0], s[1:]])
-                    except: pass
-                f = Field(tag=tag, indicators=[ind1, ind2], subfields=subfields)
-            self.record.add_ordered_field(f)
-        self.data = ''.join(line for line in self.data.split('\n'))
-        for call in re.findall(r'<call>(.*?)</call>', self.data):
-            try: call_number = re.search(r'<callNumber>(.*?)</callNumber>', call).group(1)
-            except: call_number = '[NO CALL NUMBER]'
-            try: library = re.search(r'<library>(.*?)</library>', call).group(1)
-            except: library = None
-            for item in re.findall(r'<item>(.*?)</item>', call):
-                subfields = ['a', call_number, 'w', 'ALPHANUM']
-                for s in SUBS:
-                    if s == 'm':
-                        if library:
-                            subfields.extend(['m', library])
-                        subfields.extend(['r', 'Y', 's', 'Y'])
-                    else:
-                        try: subfields.extend([s, re.search(SUBS[s], item).group(1).strip()])
-                        except:
-                            if s == 'u':
-                                try: subfields.extend([s, re.search(SUBS['d'], item).group(1).strip()])
-                                except: pass
-                            else: pass
-                f = Field(tag='999', indicators=[' ', ' '], subfields=subfields)
+        # A 999 field is generated for each item within a call, once the end of the call has been reached,
+        # using the first call number and library within the call
+        holdings, call, item = [], None, None
+        for token in PRN_TOKENS.finditer(self.data):
+            tag, label, ind, content, end, element, name, value = token.groups()
+            if tag is not None:
+                ind1, ind2 = ind[0], ind[1]
+                try: test = int(tag)
+                except: test = None
+                if tag == '000' or (test and test < 10) or tag in ALEPH_CONTROL_FIELDS:
+                    try: f = Field(tag=tag, data=content.split('|a', 1)[1].strip())
+                    except: f = Field(tag=tag, data=content.strip())
+                else:
+                    subfields = []
+                    for s in content.split('|')[1:]:
+                        try: subfields.extend([s[0], s[1:]])
+                        except: pass
+                    f = Field(tag=tag, indicators=[ind1, ind2], subfields=subfields)
                 self.record.add_ordered_field(f)
+            elif name is not None:
+                if call is None: continue
+                if '\n' in value: value = value.replace('\n', '')
+                if name in ('callNumber', 'library'): call.setdefault(name, value)
+                elif item is not None: item.setdefault(name, value.strip())
+            elif element == 'call':
+                if not end:
+                    if call is None: call = {'items': []}
+                elif call is not None:
+                    holdings.extend(self.holdings(call))
+                    call, item = None, None
+            elif call is not None:
+                if not end:
+                    if item is None: item = {}
+                elif item is not None:
+                    call['items'].append(item)
+                    item = None
+        for f in holdings:
+            self.record.add_ordered_field(f)
+        self.release()
+
+    @staticmethod
+    def holdings(call):
+        """Return a list of 999 fields for the items in a call"""
+        call_number, library = call.get('callNumber', '[NO CALL NUMBER]'), call.get('library')
+        fields = []
+        for item in call['items']:
+            subfields = ['a', call_number, 'w', 'ALPHANUM']
+            for s in SUBS:
+                if s == 'm':
+                    if library:
+                        subfields.extend(['m', library])
+                    subfields.extend(['r', 'Y', 's', 'Y'])
+                elif SUBS[s] in item: subfields.extend([s, item[SUBS[s]]])
+                elif s == 'u' and 'dateCreated' in item: subfields.extend([s, item['dateCreated']])
+            fields.append(Field(tag='999', indicators=[' ', ' '], subfields=subfields))
+        return fields
 
 
 class SAMIRecordXML(SAMIRecord):
 
-    def __init__(self, data, tidy=False):
+    def __init__(self, data, tidy=False, parsed=None):
         super().__init__(data, tidy)
 
-        for field in re.findall(r'<(?:marc:)?controlfield tag="(.*?)">(.*?)</(?:marc:)?controlfield>', self.data, re.M):
-            tag, data = field[0], field[1]
-            subfields = []
-            for s in re.findall(r'<(?:marc:)?subfield code="(.)">(.*?)</(?:marc:)?subfield>', data):
-                try: subfields.extend([s[0], s[1]])
-                except: pass
-            f = Field(tag=tag, data=data)
-            self.record.add_ordered_field(f)
-        self.data = ''.join(line for line in self.data.split('\n'))
-        for field in re.findall(r'<(?:marc:)?datafield tag="(.*?)" ind1="(.?)" ind2="(.?)">(.*?)</(?:marc:)?datafield>', self.data,
-                                re.M):
-            tag, ind1, ind2, data = field[0], field[1], field[2], field[3]
-            if ind1 == '': ind1 = ' '
-            if ind2 == '': ind2 = ' '
-            subfields = []
-            for s in re.findall(r'<(?:marc:)?subfield code="(.)">(.*?)</(?:marc:)?subfield>', data):
-                try: subfields.extend([s[0], s[1]])
-                except: pass
-            f = Field(tag=tag, indicators=[ind1, ind2], subfields=subfields)
+        # parsed is the tuple (raw text, fields, header) produced by XMLRecordParser, if data has already been parsed
+        if parsed is None: parsed = XMLRecordParser.parse(data)
+        if parsed[1] is None:
+            # The record could not be recovered (see XMLRecordParser): it has no fields, and its raw text is kept
+            # so that it can be written to an errors file
+            self.error = True
+            self._oai_header()
+            return
+        self.oai_header = parsed[2]
+        self.deleted = self.oai_header.get('status') == 'deleted'
+        for f in parsed[1]:
             self.record.add_ordered_field(f)
+        self.release()
+
+
+class SAMIHeaderRecord(SAMIRecord):
+    """Stand-in for a SAMIRecordXML of which only the OAI header and field 001 have been parsed, by SAMIReaderHeaders.
+
+    The identifier and datestamp are found in the same way as for a SAMIRecordXML, so that header() gives the same result;
+    there is no MARCRecord, so the record cannot be serialized or tested for oral histories.
+    """
+
+    def __init__(self, parsed, tidy=False):
+        self.record, self.data = None, None
+        self.tidy = tidy
+        self.error = False
+        # Fields with tag 001, in the order in which they would be in a MARCRecord
+        self.oai_header, self._fields = parsed[2], parsed[1]
+        if self._fields is None:
+            # The record could not be recovered (see XMLRecordParser): values are taken from its raw text, which is kept
+            self.data, self.error, self._fields = parsed[0], True, []
+            self._oai_header()
+            self.deleted = '<header status="deleted">' in self.data
+        else: self.deleted = self.oai_header.get('status') == 'deleted'
+
+    def identifier(self):
+        try: return clean_text(self._fields[0].data.replace('CKEY', '').strip())
+        except: return clean_text(self.oai_header.get('identifier'))
+
+    def datestamp(self):
+        return self.oai_header.get('datestamp', '[NO DATESTAMP]')
 
 
 class SAMIRecordText(SAMIRecord):
@@ -434,27 +926,160 @@ class SAMIRecordText(SAMIRecord):
                                 pass
                         f = Field(tag=tag, indicators=[ind1, ind2], subfields=subfields)
                     self.record.add_ordered_field(f)
+        self.release()
+
+
+class SerializedRecord(SAMIRecord):
+    """Stand-in for a SAMIRecord whose output has already been generated, e.g. by a worker process.
+
+    Only the serialization needed for the output format is kept (MARC if xml is False, otherwise MARC XML,
+    or both if both is True), together with the values needed to write headers and to choose output files.
+    The results of predicates which test the fields of the record are kept, since the fields are not.
+    """
+
+    def __init__(self, record, xml=False, both=False, predicates=()):
+        self.record = None
+        self.data = record.data if record.is_malformed() else None
+        self.deleted = record.deleted
+        self.tidy = record.tidy
+        self.error = record.error
+        self.oral_history = record.is_oral_history()
+        self.created = getattr(record, 'created', None)
+        self.modified = getattr(record, 'modified', None)
+        self._identifier, self._datestamp = record.identifier(), record.datestamp()
+        self.marc = record.as_marc() if both or not xml else None
+        self.xml = record.as_xml() if both or xml else None
+        self.matched = {predicate.spec: record.matches(predicate) for predicate in predicates}
 
+    def as_marc(self):
+        return self.marc
 
-class MARCReader(object):
+    def as_xml(self, namespace=False):
+        if namespace: return MARCXML_RECORD_NS + self.xml[len(MARCXML_RECORD):]
+        return self.xml
+
+    def identifier(self):
+        return self._identifier
+
+    def datestamp(self):
+        return self._datestamp
+
+    def is_oral_history(self):
+        return self.oral_history
+
+    def matches(self, predicate):
+        return self.matched[predicate.spec]
 
-    def __init__(self, marc_target):
+
+# Record classes for each type of reader, used when records are parsed away from their reader
+RECORD_CLASSES = {
+    'authorities': SAMIRecordAuthorities,
+    'prn': SAMIRecordPRN,
+    'xml': SAMIRecordXML,
+    'txt': SAMIRecordText,
+}
+
+
+def convert_chunks(reader_type, chunks, tidy=False, xml=False, both=False, predicates=()):
+    """Parse and serialize a batch of raw record chunks, returning a list of SerializedRecords"""
+    record_class = RECORD_CLASSES[reader_type]
+    return [SerializedRecord(record_class(data=chunk, tidy=tidy), xml=xml, both=both, predicates=predicates) for chunk in chunks]
+
+
+def record_pipeline(reader, reader_type, jobs, xml=False, tidy=False, both=False, predicates=(), batch_size=PIPELINE_BATCH_SIZE):
+    """Generator which converts the records read by reader in a pool of worker processes.
+
+    The reader only cuts raw chunks; batches of chunks are parsed and serialized by the workers,
+    and the resulting SerializedRecords are yielded in input order. With both, records are serialized
+    in both formats; predicates which test the fields of records (see sami_routing) are evaluated by the workers.
+    At most 2 * jobs batches are in progress at a time, so memory use does not depend on the size of the input.
+    """
+    chunks = iter(reader.next_chunk, None)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        while True:
+            batch = list(islice(chunks, batch_size))
+            if batch: pending.append(executor.submit(convert_chunks, reader_type, batch, tidy, xml, both, predicates))
+            if pending and (not batch or len(pending) >= 2 * jobs):
+                yield from pending.popleft().result()
+            elif not batch: break
+
+
+class MARCReader(object):
+    """Reads records in MARC 21 from a file opened in binary mode.
+
+    If the file can be memory-mapped, records are found by walking the record lengths in the map,
+    and each record is passed on as a memoryview of the map rather than a copy
+    (the position of the file object is not changed); otherwise records are read from the file.
+    With lazy=True, the fields of each record are only decoded when they are first used (see LazyField).
+    raw_records(), identifiers() and tags() iterate over the records without creating MARCRecords.
+    """
+
+    def __init__(self, marc_target, lazy=False):
+        self.file_handle, self.lazy = None, lazy
+        self._map, self._view, self._pos = None, None, 0
         if hasattr(marc_target, 'read') and callable(marc_target.read):
             self.file_handle = marc_target
+            self._open_map()
+
+    def _open_map(self):
+        try:
+            self._pos = self.file_handle.tell()
+            # Empty files cannot be mapped, and are read from the file instead
+            if os.fstat(self.file_handle.fileno()).st_size <= self._pos: return
+            self._map = mmap.mmap(self.file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            self._map = None
+            return
+        self._view = memoryview(self._map)
 
     def __iter__(self):
         return self
 
     def close(self):
+        if self._map is not None:
+            self._view.release()
+            # If records which are still in use refer to the map, it is closed once they have all been discarded
+            try: self._map.close()
+            except BufferError: pass
+            self._map, self._view = None, None
         if self.file_handle:
             self.file_handle.close()
             self.file_handle = None
 
     def __next__(self):
-        first5 = self.file_handle.read(5)
-        if not first5: raise StopIteration
-        if len(first5) < 5: raise RecordLengthError
-        return MARCRecord(first5 + self.file_handle.read(int(first5) - 5))
+        return MARCRecord(self.next_raw(), lazy=self.lazy)
+
+    def next_raw(self):
+        """Return the next record in MARC 21 without decoding it, as a memoryview if the file is memory-mapped"""
+        if self._map is None:
+            first5 = self.file_handle.read(5)
+            if not first5: raise StopIteration
+            if len(first5) < 5 or int(first5) < 5: raise RecordLengthError
+            return first5 + self.file_handle.read(int(first5) - 5)
+        view, start = self._view, self._pos
+        if start >= len(view): raise StopIteration
+        if len(view) - start < 5: raise RecordLengthError
+        length = int(view[start:start + 5])
+        if length < 5: raise RecordLengthError
+        self._pos = start + length
+        return view[start:self._pos]
+
+    def raw_records(self):
+        """Yield each record in MARC 21 without decoding it"""
+        while True:
+            try: yield self.next_raw()
+            except StopIteration: return
+
+    def identifiers(self):
+        """Yield the identifier (the data of field 001) of each record, or None if the record has no 001"""
+        for marc in self.raw_records():
+            yield next((str(data, 'utf-8') for tag, data in MARCRecord.directory(marc) if tag == '001'), None)
+
+    def tags(self):
+        """Yield a list of the tags of the fields in each record, in record order"""
+        for marc in self.raw_records():
+            yield [tag for tag, data in MARCRecord.directory(marc)]
 
 
 class MARCWriter(object):
@@ -471,21 +1096,241 @@ class MARCWriter(object):
         self.file_handle = None
 
 
+class RecordWriter(object):
+    """Writes serialized records to a file opened in binary mode, buffering the bytes written.
+
+    Text (e.g. MARC XML) is encoded record by record, as it is written, in the same way as by a file opened
+    in text mode with encoding='utf-8' and errors='replace', so that the bytes written are identical.
+    When files are split by size, a record can be encoded with encode(), its exact size checked,
+    and the same bytes then written. Bytes are gathered in a buffer, which is written with writelines()
+    once it holds buffer_size bytes.
+    size is the exact number of bytes written to the file, including those still in the buffer.
+    The writer must be closed (or flushed) before the file is closed.
+    """
+
+    def __init__(self, file_handle, buffer_size=WRITE_BUFFER_SIZE):
+        self.file_handle = file_handle
+        self.buffer_size = buffer_size
+        self.size = 0
+        self._buffer, self._buffered = [], 0
+
+    def write(self, data):
+        """Write text or bytes"""
+        if isinstance(data, str): data = self.encode(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.size += len(data)
+        if self._buffered >= self.buffer_size: self.flush()
+
+    def write_record(self, record):
+        """Write a record in MARC exchange format"""
+        if not isinstance(record, MARCRecord) and not isinstance(record, SAMIRecord):
+            raise RecordWritingError
+        self.write(record.as_marc())
+
+    @staticmethod
+    def encode(data):
+        """Return the bytes which are written for data: text is encoded, and bytes are returned unchanged"""
+        if isinstance(data, bytes): return data
+        if os.linesep != '\n': data = data.replace('\n', os.linesep)
+        return data.encode('utf-8', errors='replace')
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        if self._buffer:
+            self.file_handle.writelines(self._buffer)
+            self._buffer, self._buffered = [], 0
+
+    def close(self):
+        if self.file_handle:
+            self.flush()
+            self.file_handle.close()
+            self.file_handle = None
+
+
+class FileSequence(object):
+    """Writes records to an output file, or to a sequence of output files of limited size.
+
+    Files are saved in the folder path with the name <root><ext>, or if limit is 'size' or 'number',
+    <root>.0<ext>, <root>.1<ext>, etc., where mid is the format of the sequence numbers (e.g. '.%03d');
+    a new file is started before a file would reach max_size bytes (including closing), or once it holds
+    max_size records (max_size + 1 after the first file, as the main output of the scripts is split, so that
+    files split by date or written to sinks hold the same number of records as the main output).
+    A file is not left empty: a record which is larger than max_size is written on its own.
+    Records are written as bytes (see RecordWriter.encode); opening and closing are written at the start
+    and end of each file. The first file is opened when the sequence is created.
+    If metrics is given, files are registered with it as they are opened and closed.
+    """
+
+    def __init__(self, path, root, ext, limit=None, max_size=None, mid='.%d', opening=None, closing=None, metrics=None):
+        self.path, self.root, self.ext = path, root, ext
+        self.limit, self.max_size, self.mid = limit, max_size, mid
+        self.opening = opening
+        self.closing = RecordWriter.encode(closing) if closing else b''
+        self.metrics = metrics
+        self.index, self.count = 0, 0
+        self.writer = self.open()
+
+    def filename(self, index=0):
+        mid = self.mid % index if self.limit else ''
+        return os.path.join(self.path, '{}{}{}'.format(self.root, mid, self.ext))
+
+    def write(self, data):
+        """Write the bytes data for a record, starting a new file first if necessary"""
+        if self.count and ((self.limit == 'size' and self.writer.size + len(data) + len(self.closing) >= self.max_size)
+                           or (self.limit == 'number' and self.count >= self.max_size + (1 if self.index else 0))):
+            if self.closing: self.writer.write(self.closing)
+            if self.metrics: self.metrics.closing(self.writer)
+            self.writer.close()
+            self.index += 1
+            self.count = 0
+            self.writer = self.open()
+        self.writer.write(data)
+        self.count += 1
+
+    def open(self):
+        writer = RecordWriter(open(self.filename(self.index), mode='wb'))
+        if self.opening: writer.write(self.opening)
+        if self.metrics: self.metrics.opened(writer)
+        return writer
+
+    def finish(self):
+        """Write the closing elements of the current file, which is left open (e.g. to report metrics)"""
+        if self.closing: self.writer.write(self.closing)
+
+    def close(self):
+        self.writer.close()
+
+
+class ErrorFile(object):
+    """Writes the raw text of records which could not be parsed (see XMLRecordParser) to a file,
+    which is only created once there is a record to write to it."""
+
+    def __init__(self, filename, metrics=None):
+        self.filename, self.metrics = filename, metrics
+        self.writer = None
+
+    def write(self, record):
+        if self.writer is None:
+            self.writer = RecordWriter(open(self.filename, mode='wb'))
+            if self.metrics: self.metrics.opened(self.writer)
+        self.writer.write(RecordWriter.encode(record.data + '\n'))
+
+    def close(self):
+        if self.writer: self.writer.close()
+
+
+class DatePartitions(object):
+    """Writes records to output files partitioned by date, in a single pass.
+
+    partitions is either a sorted list of cutoff dates, or 'year' or 'month' (see parse_date_partitions).
+    The date of a record is the later of its created and modified dates, which are parsed with the format fmt;
+    dates of NEVER are ignored.
+    With cutoff dates, records earlier than the first cutoff are written to <root>_pre_<first cutoff>,
+    records between two cutoffs to <root>_<cutoff>_<next cutoff>, and records on or after the last cutoff
+    to <root>_post_<last cutoff>; records without dates are written to the first of these files.
+    All of these files are created, even if no records are written to them.
+    With year or month, records are written to <root>_<yyyy> or <root>_<yyyymm>, and records without dates
+    to <root>_undated; files are created as they are needed.
+    Each partition is written to a FileSequence, so if limit is 'size' or 'number', it is split in the same
+    way as the main output, into files <root>_<partition>.0<ext>, <root>_<partition>.1<ext>, etc.
+    """
+
+    def __init__(self, path, root, ext, partitions, fmt='%d/%m/%Y', limit=None, max_size=None, mid='.%d',
+                 opening=None, closing=None, metrics=None):
+        self.path, self.root, self.ext = path, root, ext
+        self.partitions = partitions
+        self.fmt = fmt
+        self.options = dict(limit=limit, max_size=max_size, mid=mid, opening=opening, closing=closing, metrics=metrics)
+        # Partition labels, by bucket for cutoff dates or by date for year and month
+        self.labels = {}
+        # FileSequences, by partition label
+        self.files = OrderedDict()
+        if not isinstance(partitions, str):
+            self.labels = {i: self.label_cutoffs(i) for i in range(len(partitions) + 1)}
+            for label in self.labels.values(): self.open(label)
+
+    def label_cutoffs(self, bucket):
+        if bucket == 0: return 'pre_{}'.format(self.partitions[0].strftime('%Y%m%d'))
+        if bucket == len(self.partitions): return 'post_{}'.format(self.partitions[-1].strftime('%Y%m%d'))
+        return '{}_{}'.format(self.partitions[bucket - 1].strftime('%Y%m%d'), self.partitions[bucket].strftime('%Y%m%d'))
+
+    def label(self, created, modified):
+        """Return the label of the partition of a record with the dates created and modified.
+
+        Raises ValueError (or TypeError) if a date cannot be parsed.
+        """
+        if isinstance(self.partitions, str):
+            dates = [parse_date(d, self.fmt) for d in (created, modified) if d != 'NEVER']
+            if not dates: return 'undated'
+            date = max(dates)
+            label = self.labels.get(date)
+            if label is None:
+                label = self.labels[date] = date.strftime('%Y' if self.partitions == 'year' else '%Y%m')
+            return label
+        bucket, last = 0, len(self.partitions)
+        for d in (created, modified):
+            if d == 'NEVER': continue
+            bucket = max(bucket, bisect_right(self.partitions, parse_date(d, self.fmt)))
+            # A record on or after the last cutoff goes to the last file, whatever its other date
+            if bucket == last: break
+        return self.labels[bucket]
+
+    def write(self, data, created, modified):
+        """Write the bytes data for a record to the file for its partition; returns the label of the partition"""
+        label = self.label(created, modified)
+        (self.files.get(label) or self.open(label)).write(data)
+        return label
+
+    def open(self, label):
+        sequence = self.files[label] = FileSequence(self.path, '{}_{}'.format(self.root, label), self.ext, **self.options)
+        return sequence
+
+    def finish(self):
+        """Write the closing elements of all open files, which are left open (e.g. to report metrics)"""
+        for sequence in self.files.values(): sequence.finish()
+
+    def close(self):
+        for sequence in self.files.values(): sequence.close()
+        self.files.clear()
+
+
 class MARCRecord(object):
-    def __init__(self, data='', leader=' ' * LEADER_LENGTH):
+    """A MARC record.
+
+    Fields should be added with add_field or add_ordered_field, and subfields with Field.add_subfield.
+    The MARC 21 and MARC XML serializations of the record, and its index of fields by tag, are cached
+    until the record is changed by one of these methods (or its leader is changed); if the list of fields
+    or the tag, data, indicators or subfields of a field are changed directly, changed() must be called.
+    Changes to one record do not discard the cached serializations of any other record.
+    """
+
+    __slots__ = ('leader', 'fields', 'pos', '_keys', '_ordered', '_index', '_marc', '_xml', '_changes', '__pos')
+
+    def __init__(self, data='', leader=' ' * LEADER_LENGTH, lazy=False):
         self.leader = '{}22{}4500'.format(leader[0:10], leader[12:20])
         self.fields = list()
         self.pos = 0
-        if len(data) > 0: self.decode_marc(data)
+        # Sort keys of the fields, used by add_ordered_field; _ordered is False if add_field has put them out of order
+        self._keys, self._ordered = list(), True
+        # Index of fields by (upper case) tag, in record order; rebuilt by _tag_index if set to None
+        self._index = dict()
+        # Cached serializations, discarded whenever the record is changed
+        self._marc, self._xml = None, None
+        # Number of times the fields of the record have been changed, shared with the fields so that add_subfield can count
+        # its changes (a list rather than a reference to the record, so that records and their fields form no reference cycles)
+        self._changes = [0]
+        if len(data) > 0: self.decode_marc(data, lazy)
 
     def __getitem__(self, tag):
-        fields = self.get_fields(tag)
-        if len(fields) > 0: return fields[0]
+        fields = self._tag_index().get(tag)
+        if fields: return fields[0]
         return None
 
     def __contains__(self, tag):
-        fields = self.get_fields(tag)
-        return len(fields) > 0
+        return tag in self._tag_index()
 
     def __iter__(self):
         self.__pos = 0
@@ -497,67 +1342,94 @@ class MARCRecord(object):
         return self.fields[self.__pos - 1]
 
     def __str__(self):
-        fields, directory = b'', b''
-        offset = 0
-
-        for field in self.fields:
-            field_data = field.as_marc()
-            fields += field_data
-            if field.tag.isdigit():
-                directory += ('%03d' % int(field.tag)).encode('utf-8')
-            else:
-                directory += ('%03s' % field.tag).encode('utf-8')
-            directory += ('%04d%05d' % (len(field_data), offset)).encode('utf-8')
-            offset += len(field_data)
-
-        directory += END_OF_FIELD.encode('utf-8')
-        fields += END_OF_RECORD.encode('utf-8')
-        base_address = LEADER_LENGTH + len(directory)
-        record_length = base_address + len(fields)
-        leader = '%05d%s%05d%s' % (record_length, self.leader[5:12], base_address, self.leader[17:])
-
-        text_list = ['=LDR  {}'.format(leader)]
+        text_list = ['=LDR  {}'.format(self._encode()[1])]
         text_list.extend([str(field) for field in self.fields])
         return '\n'.join(text_list) + '\n'
 
     def add_field(self, *fields):
-        self.fields.extend(fields)
+        self._marc, self._xml = None, None
+        if len(self._keys) != len(self.fields): self._sort_keys()
+        for f in fields:
+            self._append_field(f)
 
     def add_ordered_field(self, *fields):
+        self._marc, self._xml = None, None
+        if len(self._keys) != len(self.fields): self._sort_keys()
         for f in fields:
             if len(self.fields) == 0 or not f.tag.isdigit():
-                self.fields.append(f)
+                self._append_field(f)
                 continue
             self._sort_fields(f)
 
+    @staticmethod
+    def _sort_key(field, previous):
+        """Sort key for a field: the numeric value of its tag;
+        ALEPH control fields take the key of the preceding field;
+        other non-numeric tags sort after everything else"""
+        if field.tag.isdigit():
+            try: return int(field.tag)
+            except ValueError: pass
+        if field.tag in ALEPH_CONTROL_FIELDS: return previous
+        return float('inf')
+
+    def _sort_keys(self):
+        # Rebuild the sort keys, e.g. if the list of fields has been changed directly
+        self._keys, self._ordered, self._index = list(), True, None
+        for f in self.fields:
+            f._changes = self._changes
+            key = self._sort_key(f, self._keys[-1] if self._keys else 0)
+            if self._keys and key < self._keys[-1]: self._ordered = False
+            self._keys.append(key)
+
+    def _append_field(self, field):
+        key = self._sort_key(field, self._keys[-1] if self._keys else 0)
+        if self._keys and key < self._keys[-1]: self._ordered = False
+        field._changes = self._changes
+        self.fields.append(field)
+        self._keys.append(key)
+        if self._index is not None: self._index.setdefault(field.tag.upper(), []).append(field)
+
     def _sort_fields(self, field):
+        # The field is inserted before the first field with a greater key (i.e. after any fields with the same tag)
         tag = int(field.tag)
-
-        i, last_tag = 0, 0
-        for selff in self.fields:
-            i += 1
-            if not selff.tag.isdigit() and selff.tag not in ALEPH_CONTROL_FIELDS:
-                self.fields.insert(i - 1, field)
-                break
-
-            if selff.tag not in ALEPH_CONTROL_FIELDS:
-                last_tag = int(selff.tag)
-
-            if last_tag > tag:
-                self.fields.insert(i - 1, field)
-                break
-            if len(self.fields) == i:
-                self.fields.append(field)
-                break
+        if self._ordered:
+            i = bisect_right(self._keys, tag)
+            # Any fields with the same tag come before position i, so the index stays in record order
+            if self._index is not None: self._index.setdefault(field.tag.upper(), []).append(field)
+        else:
+            i = next((i for i, key in enumerate(self._keys) if key > tag), len(self._keys))
+            self._index = None
+        field._changes = self._changes
+        self.fields.insert(i, field)
+        self._keys.insert(i, tag)
+
+    def _tag_index(self):
+        """Return a dictionary of the fields in the record by (upper case) tag, with the fields for each tag in record order"""
+        if len(self._keys) != len(self.fields): self._sort_keys()
+        if self._index is None:
+            self._index = dict()
+            for f in self.fields:
+                self._index.setdefault(f.tag.upper(), []).append(f)
+        return self._index
 
     def get_fields(self, *args):
         if len(args) == 0: return self.fields
+        index = self._tag_index()
+        if len(args) == 1: return list(index.get(args[0], []))
+        # If the record is in tag order, fields for different numeric tags can be combined without scanning the record
+        if self._ordered and all(isinstance(tag, str) and tag.isdigit() for tag in args):
+            fields = []
+            for tag in sorted(set(args), key=int):
+                fields.extend(index.get(tag, []))
+            return fields
         return [f for f in self.fields if f.tag.upper() in args]
 
-    def decode_marc(self, marc):
+    def decode_marc(self, marc, lazy=False):
+        """Add the fields of a record in MARC 21, given as bytes or a memoryview.
+        With lazy=True, fields are only decoded when they are first used (see LazyField)."""
         # Extract record leader
         try:
-            self.leader = marc[0:LEADER_LENGTH].decode('ascii')
+            self.leader = bytes(marc[0:LEADER_LENGTH]).decode('ascii')
         except:
             print('Record has problem with Leader and cannot be processed')
         if len(self.leader) != LEADER_LENGTH: raise LeaderError
@@ -565,6 +1437,18 @@ class MARCRecord(object):
         # Determine character encoding
         self.leader = self.leader[0:9] + 'a' + self.leader[10:]
 
+        # Add fields to record using directory offsets
+        field_count = 0
+        for entry_tag, entry_data in self.directory(marc):
+            self.add_field(LazyField(entry_tag, entry_data) if lazy else Field.from_marc(entry_tag, entry_data))
+            field_count += 1
+
+        if field_count == 0: raise FieldsError
+
+    @staticmethod
+    def directory(marc):
+        """Return a list of (tag, data) for the fields of a record in MARC 21, in the order of its directory;
+        data is the MARC 21 data of the field without END_OF_FIELD, sliced from marc"""
         # Extract the byte offset where the record data starts
         base_address = int(marc[12:17])
         if base_address <= 0: raise BaseAddressError
@@ -572,123 +1456,153 @@ class MARCRecord(object):
 
         # Extract directory
         # base_address-1 is used since the directory ends with an END_OF_FIELD byte
-        directory = marc[LEADER_LENGTH:base_address - 1].decode('ascii')
+        directory = bytes(marc[LEADER_LENGTH:base_address - 1]).decode('ascii')
 
         # Determine the number of fields in record
         if len(directory) % DIRECTORY_ENTRY_LENGTH != 0:
             raise DirectoryError
-        field_total = len(directory) / DIRECTORY_ENTRY_LENGTH
-
-        # Add fields to record using directory offsets
-        field_count = 0
-        while field_count < field_total:
-            entry_start = field_count * DIRECTORY_ENTRY_LENGTH
-            entry_end = entry_start + DIRECTORY_ENTRY_LENGTH
-            entry = directory[entry_start:entry_end]
-            entry_tag = entry[0:3]
-            entry_length = int(entry[3:7])
-            entry_offset = int(entry[7:12])
-            entry_data = marc[base_address + entry_offset:base_address + entry_offset + entry_length - 1]
-
-            # Check if tag is a control field
-            if str(entry_tag) < '010' and entry_tag.isdigit():
-                field = Field(tag=entry_tag, data=entry_data.decode('utf-8'))
-            elif str(entry_tag) in ALEPH_CONTROL_FIELDS:
-                field = Field(tag=entry_tag, data=entry_data.decode('utf-8'))
 
-            else:
-                subfields = list()
-                subs = entry_data.split(SUBFIELD_INDICATOR.encode('ascii'))
-                # Missing indicators are recorded as blank spaces.
-                # Extra indicators are ignored.
-
-                subs[0] = subs[0].decode('ascii') + '  '
-                first_indicator, second_indicator = subs[0][0], subs[0][1]
+        entries = []
+        for entry_start in range(0, len(directory), DIRECTORY_ENTRY_LENGTH):
+            entry_tag = directory[entry_start:entry_start + 3]
+            entry_length = int(directory[entry_start + 3:entry_start + 7])
+            entry_offset = base_address + int(directory[entry_start + 7:entry_start + 12])
+            entries.append((entry_tag, marc[entry_offset:entry_offset + entry_length - 1]))
+        return entries
+
+    def _encode(self):
+        """Encode the record as MARC 21, returning a tuple (key, leader, MARC 21 bytes).
+
+        Each field is encoded once, and the directory is built in a single pass.
+        The result is cached until the record is changed (see version).
+        """
+        key = self.version()
+        if self._marc is not None and self._marc[0] == key: return self._marc
+        fields = [field.as_marc() for field in self.fields]
+        directory, offset = [], 0
+        for field, field_data in zip(self.fields, fields):
+            if field.tag.isdigit(): directory.append('%03d%04d%05d' % (int(field.tag), len(field_data), offset))
+            else: directory.append('%03s%04d%05d' % (field.tag, len(field_data), offset))
+            offset += len(field_data)
+        directory.append(END_OF_FIELD)
+        directory = ''.join(directory).encode('utf-8')
+        fields.append(END_OF_RECORD.encode('utf-8'))
+        base_address = LEADER_LENGTH + len(directory)
+        record_length = base_address + offset + 1
+        leader = '%05d%s%05d%s' % (record_length, self.leader[5:12], base_address, self.leader[17:])
+        fields[0:0] = [leader.encode('utf-8'), directory]
+        self._marc = (key, leader, b''.join(fields))
+        return self._marc
 
-                for subfield in subs[1:]:
-                    if len(subfield) == 0: continue
-                    try:
-                        code, data = subfield[0:1].decode('ascii'), subfield[1:].decode('utf-8', 'strict')
-                        subfields.append(code)
-                        subfields.append(data)
-                    except:
-                        print('Error in subfield code in field {}'.format(entry_tag))
-                field = Field(
-                    tag=entry_tag,
-                    indicators=[first_indicator, second_indicator],
-                    subfields=subfields,
-                )
-            self.add_field(field)
-            field_count += 1
+    def version(self):
+        """Return a value which changes whenever the record is changed by add_field, add_ordered_field
+        or Field.add_subfield, or changed() is called"""
+        return self.leader, len(self.fields), self._changes[0]
 
-        if field_count == 0: raise FieldsError
+    def changed(self):
+        """Discard cached serializations and the index of fields by tag, after fields have been changed directly"""
+        self._changes[0] += 1
+        self._marc, self._xml = None, None
+        self._sort_keys()
 
     def as_marc(self):
-        fields, directory = b'', b''
-        offset = 0
-
-        for field in self.fields:
-            field_data = field.as_marc()
-            fields += field_data
-            if field.tag.isdigit():
-                directory += ('%03d' % int(field.tag)).encode('utf-8')
-            else:
-                directory += ('%03s' % field.tag).encode('utf-8')
-            directory += ('%04d%05d' % (len(field_data), offset)).encode('utf-8')
-            offset += len(field_data)
-
-        directory += END_OF_FIELD.encode('utf-8')
-        fields += END_OF_RECORD.encode('utf-8')
-        base_address = LEADER_LENGTH + len(directory)
-        record_length = base_address + len(fields)
-        strleader = '%05d%s%05d%s' % (record_length, self.leader[5:12], base_address, self.leader[17:])
-        leader = strleader.encode('utf-8')
-        return leader + directory + fields
+        return self._encode()[2]
 
     def as_xml(self, namespace=False):
-        if namespace:
-            xml = '\n\t<marc:record xsi:schemaLocation="http://www.loc.gov/MARC21/slim http://www.loc.gov/standards/marcxml/schema/MARC21slim.xsd">'
-        else: xml = '\n\t<marc:record>'
-        fields, directory = b'', b''
-        offset = 0
-        for field in self.fields:
-            field_data = field.as_marc()
-            fields += field_data
-            if field.tag.isdigit():
-                directory += ('%03d' % int(field.tag)).encode('utf-8')
-            else:
-                directory += ('%03s' % field.tag).encode('utf-8')
-            directory += ('%04d%05d' % (len(field_data), offset)).encode('utf-8')
-            offset += len(field_data)
-        directory += END_OF_FIELD.encode('utf-8')
-        fields += END_OF_RECORD.encode('utf-8')
-        base_address = LEADER_LENGTH + len(directory)
-        record_length = base_address + len(fields)
-        leader = '%05d%s%05d%s' % (record_length, self.leader[5:12], base_address, self.leader[17:])
-        xml += '\n\t\t<marc:leader>{}</marc:leader>'.format(leader)
-        for field in self.fields:
-            xml += '\n' + field.as_xml()
-        return xml + '\n\t</marc:record>'
+        key = self.version()
+        if self._xml is None or self._xml[0] != key:
+            # The leader is taken from the MARC 21 serialization if it is already cached
+            leader = self._marc[1] if self._marc is not None and self._marc[0] == key else None
+            self._xml = (key, MARCXML_SERIALIZER.record(self, leader))
+        if namespace: return MARCXML_RECORD_NS + self._xml[1][len(MARCXML_RECORD):]
+        return self._xml[1]
 
 
 class Field(object):
+    """A MARC field.
+
+    Tags and subfield codes are interned, and indicators and subfields are held in tuples,
+    so that large batches of records can be kept in memory.
+    Subfields are held as a flat tuple of alternating codes and values.
+    If the tag, data, indicators or subfields of a field in a record are set directly,
+    MARCRecord.changed() must be called for the record (see MARCRecord).
+    """
+
+    __slots__ = ('tag', 'control', 'data', 'indicators', 'subfields', '_changes', '__pos')
 
     def __init__(self, tag, indicators=None, subfields=None, data=''):
         if indicators is None: indicators = []
         if subfields is None: subfields = []
-        indicators = [str(x) for x in indicators]
+        # Change count of the record to which the field has been added, if any (see MARCRecord)
+        self._changes = None
 
         # Normalize tag to three digits
-        self.tag = '%03s' % tag
+        self.tag = sys.intern('%03s' % tag)
 
         # Check if tag is a control field
-        if self.tag < '010' and self.tag.isdigit():
-            self.data = str(data)
-        elif self.tag in ALEPH_CONTROL_FIELDS:
+        self.control = self.control_tag(self.tag)
+        if self.control:
             self.data = str(data)
         else:
-            self.indicator1, self.indicator2 = self.indicators = indicators
-            self.subfields = subfields
+            first_indicator, second_indicator = self.indicators = tuple(str(x) for x in indicators)
+            subfields = list(subfields)
+            subfields[::2] = [sys.intern(code) if isinstance(code, str) else code for code in subfields[::2]]
+            self.subfields = tuple(subfields)
+
+    @staticmethod
+    def control_tag(tag):
+        """Return True if fields with the (three character) tag are control fields"""
+        return (tag < '010' and tag.isdigit()) or tag in ALEPH_CONTROL_FIELDS
+
+    @staticmethod
+    def from_marc(tag, marc):
+        """Return a Field decoded from its data in MARC 21 (without END_OF_FIELD), given as bytes or a memoryview"""
+        if Field.control_tag('%03s' % tag):
+            return Field(tag=tag, data=str(marc, 'utf-8'))
+
+        # Fields are usually valid UTF-8 and can be decoded in one go,
+        # since SUBFIELD_INDICATOR cannot occur within a multi-byte character
+        try: subs = str(marc, 'utf-8').split(SUBFIELD_INDICATOR)
+        except UnicodeDecodeError: subs = None
+        if subs is not None and subs[0].isascii():
+            subfields = list()
+            for subfield in subs[1:]:
+                if len(subfield) == 0: continue
+                if not subfield[0].isascii(): break
+                subfields.append(subfield[0])
+                subfields.append(subfield[1:])
+            else: return Field(tag=tag, indicators=(subs[0] + '  ')[0:2], subfields=subfields)
+
+        # Otherwise each subfield is decoded separately, and any which cannot be decoded are skipped
+        subfields = list()
+        subs = bytes(marc).split(SUBFIELD_INDICATOR.encode('ascii'))
+        # Missing indicators are recorded as blank spaces.
+        # Extra indicators are ignored.
+
+        subs[0] = subs[0].decode('ascii') + '  '
+        first_indicator, second_indicator = subs[0][0], subs[0][1]
+
+        for subfield in subs[1:]:
+            if len(subfield) == 0: continue
+            try:
+                code, data = subfield[0:1].decode('ascii'), subfield[1:].decode('utf-8', 'strict')
+                subfields.append(code)
+                subfields.append(data)
+            except:
+                print('Error in subfield code in field {}'.format(tag))
+        return Field(
+            tag=tag,
+            indicators=[first_indicator, second_indicator],
+            subfields=subfields,
+        )
+
+    @property
+    def indicator1(self):
+        return self.indicators[0]
+
+    @property
+    def indicator2(self):
+        return self.indicators[1]
 
     def __iter__(self):
         self.__pos = 0
@@ -704,7 +1618,7 @@ class Field(object):
         return len(subfields) > 0
 
     def __next__(self):
-        if not hasattr(self, 'subfields'):
+        if self.control:
             raise StopIteration
         while self.__pos + 1 < len(self.subfields):
             subfield = (self.subfields[self.__pos], self.subfields[self.__pos + 1])
@@ -713,7 +1627,7 @@ class Field(object):
         raise StopIteration
 
     def __str__(self):
-        if self.is_control_field() or self.tag in ALEPH_CONTROL_FIELDS:
+        if self.control:
             text = '={}  {}'.format(self.tag, self.data.replace(' ', '#'))
         else:
             text = '={}  '.format(self.tag)
@@ -734,26 +1648,143 @@ class Field(object):
         return values
 
     def add_subfield(self, code, value):
-        self.subfields.append(code)
-        self.subfields.append(clean_text(value))
+        if self._changes is not None: self._changes[0] += 1
+        self.subfields += (sys.intern(code), clean_text(value))
 
     def is_control_field(self):
-        if self.tag < '010' and self.tag.isdigit(): return True
-        if self.tag in ALEPH_CONTROL_FIELDS: return True
-        return False
+        return self.control
 
     def as_marc(self):
-        if self.is_control_field():
+        if self.control:
             return (self.data + END_OF_FIELD).encode('utf-8')
-        marc = self.indicator1 + self.indicator2
+        marc = list(self.indicators)
         for subfield in self:
-            marc += SUBFIELD_INDICATOR + subfield[0] + subfield[1]
-        return (marc + END_OF_FIELD).encode('utf-8')
+            marc.extend([SUBFIELD_INDICATOR, subfield[0], subfield[1]])
+        marc.append(END_OF_FIELD)
+        return ''.join(marc).encode('utf-8')
 
     def as_xml(self):
-        if self.is_control_field():
-            return '\t\t<marc:controlfield tag="{}">{}</marc:controlfield>'.format(self.tag, clean_text(self.data))
-        xml = '\t\t<marc:datafield tag="{}" ind1="{}" ind2="{}">'.format(self.tag, self.indicator1, self.indicator2)
-        for subfield in self:
-            xml += '\n\t\t\t<marc:subfield code="{}">{}</marc:subfield>'.format(subfield[0], clean_text(subfield[1].strip()))
-        return xml + '\n\t\t</marc:datafield>'
\ No newline at end of file
+        xml = []
+        MARCXML_SERIALIZER.field(self, xml)
+        # Fields are written on a new line within records
+        return ''.join(xml)[1:]
+
+
+class LazyField(Field):
+    """A MARC field read from MARC 21, which is decoded when its data, indicators or subfields are first used.
+
+    Until then, the field holds only its tag and its data in MARC 21 (usually a memoryview of a memory-mapped file),
+    and its data, indicators and subfields should not be set directly.
+    Errors in the data are reported when the field is decoded rather than when the record is read.
+    Once decoded, the field behaves exactly like a Field, with no further cost.
+    Fields which have not been decoded are written to MARC 21 as they were read, where this gives the same result.
+    """
+
+    __slots__ = ('_raw',)
+
+    def __init__(self, tag, raw):
+        self.tag = sys.intern('%03s' % tag)
+        self.control = self.control_tag(self.tag)
+        self._raw, self._changes = raw, None
+
+    def __getattr__(self, name):
+        # Only called for slots which have not been set, i.e. data, indicators and subfields before the field is decoded
+        if name in ('data', 'indicators', 'subfields') and self._raw is not None:
+            self._decode()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def _decode(self):
+        field, self._raw = Field.from_marc(self.tag, self._raw), None
+        if self.control: self.data = field.data
+        else: self.indicators, self.subfields = field.indicators, field.subfields
+
+    def as_marc(self):
+        # A field which has not been decoded is written as it was read, if decoding it would not change it
+        if self._raw is not None:
+            marc = bytes(self._raw)
+            if self._decodes_unchanged(marc): return marc + END_OF_FIELD_BYTES
+        return Field.as_marc(self)
+
+    def _decodes_unchanged(self, marc):
+        """Return True if marc is valid UTF-8 and, for data fields, has two ASCII indicators
+        and no empty subfields or subfields with non-ASCII codes, which would be changed by decoding"""
+        if not marc.isascii():
+            try: marc.decode('utf-8')
+            except UnicodeDecodeError: return False
+        if self.control: return True
+        subs = marc.split(SUBFIELD_INDICATOR_BYTES)
+        return len(subs[0]) == 2 and subs[0].isascii() and all(sub and sub[0] < 0x80 for sub in subs[1:])
+
+
+class MARCXMLSerializer(object):
+    """Serializes MARC records as MARC XML.
+
+    Start tags are built once for each control field tag, each combination of data field tag and indicators,
+    and each subfield code, and text is only passed to clean_text if it contains characters which clean_text may change.
+    The parts of each record are gathered in a list and joined once.
+    The leader is completed from the sizes of the fields in MARC 21, which are counted rather than encoded
+    when the text of a field is ASCII.
+    """
+
+    def __init__(self):
+        self._control_tags, self._data_tags, self._codes = {}, {}, {}
+
+    def record(self, record, leader=None):
+        """Return a MARCRecord as MARC XML; leader is the completed leader, if it is already known"""
+        xml = [MARCXML_RECORD, '\n\t\t<marc:leader>', leader, '</marc:leader>']
+        field = self.field
+        sizes = [field(f, xml) for f in record.fields]
+        xml.append('\n\t</marc:record>')
+        if leader is None: xml[2] = self.leader(record, sizes)
+        return ''.join(xml)
+
+    def field(self, field, xml):
+        """Append the MARC XML for a field (starting on a new line) to the list xml,
+        returning the size of the field in MARC 21"""
+        if field.control:
+            start = self._control_tags.get(field.tag)
+            if start is None:
+                start = self._control_tags[field.tag] = '\n\t\t<marc:controlfield tag="{}">'.format(field.tag)
+            data = field.data
+            xml += (start, self.text(data), '</marc:controlfield>')
+            return len(data) + 1 if data.isascii() else len(field.as_marc())
+
+        key = (field.tag,) + field.indicators
+        start = self._data_tags.get(key)
+        if start is None:
+            start = self._data_tags[key] = '\n\t\t<marc:datafield tag="{}" ind1="{}" ind2="{}">'.format(*key)
+        xml.append(start)
+        codes, text, subfields = self._codes, self.text, field.subfields
+        size, ascii = len(key[1]) + len(key[2]) + 1, (key[1] + key[2]).isascii()
+        for code, value in zip(subfields[::2], subfields[1::2]):
+            start = codes.get(code)
+            if start is None:
+                start = codes[code] = '\n\t\t\t<marc:subfield code="{}">'.format(code)
+            xml += (start, text(value.strip()), '</marc:subfield>')
+            size += len(code) + len(value) + 1
+            if ascii and not (value.isascii() and code.isascii()): ascii = False
+        xml.append('\n\t\t</marc:datafield>')
+        return size if ascii else len(field.as_marc())
+
+    @staticmethod
+    def text(value):
+        """Return text as written in MARC XML, i.e. as str(clean_text(value))"""
+        if value and CLEAN_TEXT_SPECIAL.search(value) is None: return value
+        return str(clean_text(value))
+
+    @staticmethod
+    def leader(record, sizes):
+        """Return the leader of a record in MARC 21, given the sizes of its fields in MARC 21"""
+        # The directory has an entry for each field, followed by END_OF_FIELD
+        directory, offset = 1, 0
+        for field, size in zip(record.fields, sizes):
+            if size < 10000 and offset < 100000 and len(field.tag) == 3 and field.tag.isascii(): directory += DIRECTORY_ENTRY_LENGTH
+            elif field.tag.isdigit(): directory += len(('%03d%04d%05d' % (int(field.tag), size, offset)).encode('utf-8'))
+            else: directory += len(('%03s%04d%05d' % (field.tag, size, offset)).encode('utf-8'))
+            offset += size
+        base_address = LEADER_LENGTH + directory
+        return '%05d%s%05d%s' % (base_address + offset + 1, record.leader[5:12], base_address, record.leader[17:])
+
+
+MARCXML_SERIALIZER = MARCXMLSerializer()
\ No newline at end of file
@@ -6,16 +6,22 @@
 from collections import OrderedDict
 import datetime
 import fileinput
+import functools
 import gc
 import getopt
 import html
+import io
 import locale
 import os
 import re
 import string
 import sys
+import tarfile
 import textwrap
+import time
 import unicodedata
+import zipfile
+import zlib
 
 __author__ = 'Victoria Morris'
 __license__ = 'MIT License'
@@ -31,6 +37,37 @@ __status__ = '4 - Beta Development'
 SAMI_SUFFICES = ('export_ALL', 'export_DOCRECITEM', 'export_MLRECITEM', 'export_PUBLPROD', 'export_WORK', 'export_WRSECITEM')
 PRIMO_FLAGS = ('primo_dels', 'primo_upd')
 
+# Ways of fanning out records split into individual files into subfolders, with the default subfolder name length
+FAN_OUT_WIDTHS = OrderedDict([
+    ('hash', 2),
+    ('prefix', 3),
+])
+
+# Formats of archives for records split into individual files
+ARCHIVE_FORMATS = ('zip', 'tar')
+
+# Characters which may be changed by clean_text; text containing none of them is returned unchanged
+CLEAN_TEXT_SPECIAL = re.compile(r'[&<>"\'\u0000-\u001F\u007F-\u009F]')
+CONTROL_CHARACTERS = re.compile(r'[\u0000-\u001F\u007F-\u009F]')
+
+# Number of distinct values cleaned by clean_text whose results are cached
+CLEAN_TEXT_CACHE_SIZE = 4096
+
+# Number of calls to clean_text which have returned without using the cache (see clean_text_cache_info)
+_clean_text_fast_path = 0
+
+# Ways of partitioning output by date, other than by a list of cutoff dates
+DATE_PARTITIONS = ('year', 'month')
+
+# Date formats which are parsed without strptime, when the date matches the pattern exactly
+FAST_DATE_FORMATS = {
+    '%d/%m/%Y': re.compile(r'(?P<d>[0-9]{2})/(?P<m>[0-9]{2})/(?P<Y>[0-9]{4})'),
+    '%Y%m%d': re.compile(r'(?P<Y>[0-9]{4})(?P<m>[0-9]{2})(?P<d>[0-9]{2})'),
+}
+
+# Number of distinct dates whose parsed values are cached
+DATE_CACHE_SIZE = 4096
+
 
 # ====================
 #       Classes
@@ -64,11 +101,168 @@ class FilePath:
             exit_prompt('Error: The specified {} file cannot be found'.format(self.function))
 
 
+class SplitFileNames:
+    """Class for choosing the names of files when output is split into individual records.
+
+    Names are taken from record identifiers; where a name has already been used, the suffix _DUPLICATE n is added.
+    Names in use are kept in memory, and the names already in each output folder are read with a single
+    listing when the folder is first used, so that finding a free name does not require a file system check
+    for each duplicate.
+
+    If listing is False (e.g. for names within an archive), folders are neither listed nor created.
+    If fan_out is 'hash', files are saved in subfolders named with the first width hexadecimal digits
+    of a checksum of the name; if fan_out is 'prefix', subfolders are named with the first width characters
+    of the name. Files with duplicate identifiers are saved in the same subfolder.
+    """
+
+    def __init__(self, path, ext, fan_out=None, width=None, listing=True):
+        self.path = path
+        self.listing = listing
+        self.ext = ext
+        self.fan_out = fan_out
+        self.width = width or FAN_OUT_WIDTHS.get(fan_out)
+        self.used = {}
+        self.duplicates = {}
+
+    def candidates(self, name):
+        """Generator of free paths for a file with the name name (without extension).
+
+        Each path is marked as used as it is generated; further paths are only needed if a file cannot be
+        created at the previous path, e.g. because it has been created by another process.
+        """
+        folder = self.folder(name)
+        used = self.used.get(folder)
+        if used is None:
+            if self.listing: os.makedirs(folder, exist_ok=True)
+            used = self.used[folder] = set(os.listdir(folder)) if self.listing else set()
+        count = self.duplicates.get(name, -1)
+        while True:
+            count += 1
+            filename = name + self.ext if count == 0 else '{}_DUPLICATE {}{}'.format(name, str(count), self.ext)
+            if filename in used: continue
+            used.add(filename)
+            self.duplicates[name] = count
+            yield os.path.join(folder, filename)
+
+    def folder(self, name):
+        if self.fan_out == 'hash':
+            return os.path.join(self.path, '{:08x}'.format(zlib.crc32(name.encode('utf-8')))[:self.width])
+        if self.fan_out == 'prefix':
+            return os.path.join(self.path, re.sub(r'[^0-9A-Za-z]', '_', name[:self.width]))
+        return self.path
+
+
+class SplitArchive:
+    """Class for writing records split into individual files to a sequence of zip or tar archives.
+
+    Archives are saved in the folder path, with the names <root>.0.zip, <root>.1.zip, etc.
+    Members are named as files would be named in the folder (see SplitFileNames), and each member
+    is written to the archive as it is added. Once an archive reaches max_size bytes it is closed,
+    and the next member is written to a new archive.
+    If metrics is given, archive files are registered with it as they are opened and closed.
+    """
+
+    def __init__(self, path, root, archive_format, ext, max_size=None, fan_out=None, width=None, metrics=None):
+        self.path = path
+        self.root = root
+        self.archive_format = archive_format
+        self.max_size = max_size
+        self.metrics = metrics
+        self.names = SplitFileNames('', ext, fan_out, width, listing=False)
+        self.index = -1
+        self.archive, self.file_object = None, None
+
+    def add(self, name, data):
+        """Add a member for a file with the name name (without extension); returns the name of the member.
+
+        Text is encoded as it would be written to a file opened in text mode with errors='replace'.
+        """
+        if isinstance(data, str):
+            if os.linesep != '\n': data = data.replace('\n', os.linesep)
+            data = data.encode('utf-8', errors='replace')
+        member = next(self.names.candidates(name)).replace(os.sep, '/')
+        if self.archive is None: self.open()
+        if self.archive_format == 'zip':
+            info = zipfile.ZipInfo(member, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(member)
+            info.size, info.mtime, info.mode = len(data), int(time.time()), 0o644
+            self.archive.addfile(info, io.BytesIO(data))
+        if self.max_size and self.file_object.tell() >= self.max_size: self.close()
+        return member
+
+    def open(self):
+        self.index += 1
+        self.file_object = open(os.path.join(self.path, '{}.{}.{}'.format(self.root, str(self.index), self.archive_format)), mode='wb')
+        if self.archive_format == 'zip': self.archive = zipfile.ZipFile(self.file_object, mode='w')
+        else: self.archive = tarfile.open(fileobj=self.file_object, mode='w', format=tarfile.PAX_FORMAT)
+        if self.metrics: self.metrics.opened(self.file_object, self.index)
+
+    def close(self):
+        if self.archive is None: return
+        self.archive.close()
+        if self.metrics: self.metrics.closing(self.file_object)
+        self.file_object.close()
+        self.archive, self.file_object = None, None
+
+
 # ====================
 #  General Functions
 # ====================
 
 
+def parse_fan_out(arg):
+    """Function to interpret the value of the --fan_out option; returns a tuple (fan_out, width)"""
+    fan_out, _, width = arg.partition(':')
+    try: width = int(width) if width else FAN_OUT_WIDTHS[fan_out]
+    except: width = 0
+    if fan_out not in FAN_OUT_WIDTHS or not 1 <= width <= (8 if fan_out == 'hash' else 255):
+        exit_prompt('Fan out could not be interpreted. \n'
+                    'Please ensure that it is hash or prefix, \n'
+                    'optionally followed by : and the number of characters in subfolder names \n'
+                    '(at most 8 for hash).')
+    return fan_out, width
+
+
+def parse_max_size(arg):
+    """Function to interpret the value of the --max_size option; returns a tuple (limit, max_size),
+    where limit is 'size' (and max_size is in bytes) or 'number' (and max_size is a number of records)"""
+    arg = str(arg).upper()
+    limit = 'size' if 'K' in arg else 'number'
+    try: max_size = int(re.sub(r'[^0-9]', '', arg))
+    except: max_size = 0
+    if not max_size >= 1: exit_prompt('Maximum file size could not be interpreted. \n'
+                                      'Please ensure that it is a positive integer, \n'
+                                      'optionally followed by the suffix K.')
+    if limit == 'size': max_size *= 1024
+    return limit, max_size
+
+
+def parse_archive_size(arg):
+    """Function to interpret the value of the --archive_size option (in MB); returns the size in bytes"""
+    try: size = int(arg)
+    except: size = 0
+    if not size >= 1: exit_prompt('Maximum archive size could not be interpreted. \n'
+                                  'Please ensure that it is a positive integer (the size in MB).')
+    return size * 1024 * 1024
+
+
+def parse_date_partitions(arg):
+    """Function to interpret the value of the --date option; returns 'year', 'month' or a sorted list of cutoff dates"""
+    if arg in DATE_PARTITIONS: return arg
+    cutoffs = set()
+    for date in arg.split(','):
+        try: cutoffs.add(datetime.datetime.strptime(date.strip(), '%Y%m%d') if len(date.strip()) == 8 else None)
+        except: cutoffs.add(None)
+    if None in cutoffs:
+        exit_prompt('The date parameter must be year, month, \n'
+                    'or one or more dates in the format yyyymmdd, separated by commas')
+    return sorted(cutoffs)
+
+
 def print_opt(o, v, indent=5):
     """Function to print information about options/arguments for a function"""
     print('{}{:<10}  {:<40}'.format(' ' * indent, o, textwrap.fill(v, width=60 - indent, subsequent_indent=' ' * (indent + 12))))
@@ -81,10 +275,10 @@ def date_time(message='All processing complete'):
     print(str(datetime.datetime.now()))
 
 
-def date_time_exit():
-    """Function to exit the program after displaying the current date and time"""
+def date_time_exit(status=None):
+    """Function to exit the program with exit status status after displaying the current date and time"""
     date_time()
-    sys.exit()
+    sys.exit(status)
 
 
 def exit_prompt(message=None):
@@ -102,5 +296,44 @@ def exit_prompt(message=None):
 
 def clean_text(s):
     """Function to remove control characters and escape invalid HTML characters <>&"""
-    if s is None or not s: return None
-    return html.escape(re.sub(r'[\u0000-\u001F\u007F-\u009F]', '', html.unescape(s)))
\ No newline at end of file
+    global _clean_text_fast_path
+    if not s or CLEAN_TEXT_SPECIAL.search(s) is None:
+        _clean_text_fast_path += 1
+        return s or None
+    return _clean_text(s)
+
+
+@functools.lru_cache(maxsize=CLEAN_TEXT_CACHE_SIZE)
+def _clean_text(s):
+    return html.escape(CONTROL_CHARACTERS.sub('', html.unescape(s)))
+
+
+def clean_text_cache_info():
+    """Function to return a dictionary of the number of calls to clean_text which returned on the fast path
+    (text which is empty or has nothing to escape or remove, which is not cached),
+    and the hits, misses, maximum size and current size of the cache used by clean_text"""
+    return dict(fast_path=_clean_text_fast_path, **_clean_text.cache_info()._asdict())
+
+
+# ====================
+#    Functions for
+#   parsing dates
+# ====================
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(s, fmt='%d/%m/%Y'):
+    """Function to convert a date string to a datetime, as datetime.strptime does (raising ValueError if it is invalid).
+
+    The same dates occur in many records, so results are cached; dates in the formats in FAST_DATE_FORMATS
+    are parsed without strptime.
+    """
+    match = FAST_DATE_FORMATS[fmt].fullmatch(s) if fmt in FAST_DATE_FORMATS else None
+    if match: return datetime.datetime(int(match.group('Y')), int(match.group('m')), int(match.group('d')))
+    return datetime.datetime.strptime(s, fmt)
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def reformat_date(s, fmt='%d/%m/%Y', new_fmt='%Y%m%d'):
+    """Function to convert a date string from format fmt to format new_fmt (raising ValueError if it is invalid)"""
+    return parse_date(s, fmt).strftime(new_fmt)
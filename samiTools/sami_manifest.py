@@ -0,0 +1,228 @@
+#  -*- coding: utf8 -*-
+
+"""Manifest of converted input files and fingerprints of their records, used by the --incremental option
+of the command line scripts."""
+
+# Import required modules
+from collections import deque
+import hashlib
+import json
+from sami.marc_data import *
+from sami.sami_routing import serialize
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Constants
+# ====================
+
+
+# Name of the manifest file, which is saved in the output folder
+MANIFEST_FILE = 'sami_manifest.json'
+
+# Version of the format of the manifest file; manifests of other versions are ignored
+MANIFEST_VERSION = 1
+
+# Modes of incremental conversion: full output, delta output, or both
+INCREMENTAL_MODES = ('full', 'delta', 'both')
+
+# Number of bytes in the fingerprint of a record
+FINGERPRINT_SIZE = 8
+
+# Number of bytes read at a time when input files are hashed
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+# ====================
+#       Classes
+# ====================
+
+
+class Manifest(object):
+    """Manifest of the input files which have been converted into an output folder, saved in the folder as JSON.
+
+    For each input file, the manifest holds its size, modification time and content hash when it was last converted,
+    whether the full output was written with the options of the manifest (full), and the fingerprint of each
+    of its records, by record key (see IncrementalReader). options describes the options which affect the full output;
+    if they differ from those of the manifest, fingerprints are kept but full outputs are treated as out of date.
+    """
+
+    def __init__(self, output_path, options):
+        self.path = os.path.join(output_path, MANIFEST_FILE)
+        # Options are compared as they are read back from JSON
+        self.options = json.loads(json.dumps(options))
+        self.files = {}
+        self.changed_options = False
+        if not os.path.isfile(self.path): return
+        try:
+            with open(self.path, mode='r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except: manifest = {}
+        if manifest.get('version') != MANIFEST_VERSION: return
+        self.files = manifest.get('files', {})
+        if manifest.get('options') != self.options:
+            self.changed_options = True
+            for entry in self.files.values(): entry['full'] = False
+
+    def unchanged(self, input_path, file, full=True):
+        """Return True if an input file has the same size and modification time as when it was last converted
+        (and if full is True, its full output is up to date)"""
+        entry = self.files.get(file)
+        if entry is None or (full and not entry.get('full')): return False
+        return [entry['size'], entry['mtime']] == list(file_stat(os.path.join(input_path, file)))
+
+    def save(self):
+        """Save the manifest, replacing the previous manifest only once it has been written"""
+        temp = self.path + '.tmp'
+        with open(temp, mode='w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'options': self.options, 'files': self.files}, f, separators=(',', ':'))
+        os.replace(temp, self.path)
+
+
+class IncrementalReader(object):
+    """Reads records from a SAMIReader, comparing each record with the records of the file when it was last converted.
+
+    Each record is fingerprinted from its raw text, as cut by the reader, and given a key: its identifier,
+    with _DUPLICATE <n> for repeated identifiers, or _NO IDENTIFIER <n> for records without one.
+    previous holds the fingerprints of the records of the file by key, from the manifest. Records are read
+    in the same way as from the reader, including with record_pipeline (which reads chunks with next_chunk);
+    change() must then be called for each record read, in order, to classify it as new or changed.
+    If skip_unchanged is True, chunks whose fingerprints are among the previous fingerprints are not returned
+    at all, so that unchanged records are not parsed (unless the keys of those records have already been given
+    to other records, in which case they are returned, so that each record has a key of its own). The fingerprints of all records are kept in records, by key.
+    """
+
+    def __init__(self, reader, previous=None, skip_unchanged=False):
+        self.reader = reader
+        self.previous = previous or {}
+        self.records = {}
+        self.counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+        self._pending = deque()
+        self._keys = {}
+        self._by_fingerprint = {}
+        if skip_unchanged:
+            for key, fingerprint in self.previous.items():
+                self._by_fingerprint.setdefault(fingerprint, deque()).append(key)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.reader.record(data=self.next_chunk(), tidy=self.reader.tidy)
+
+    def next_chunk(self):
+        """Return the raw text of the next record to be converted"""
+        while True:
+            data = self.reader.next_chunk()
+            fingerprint = record_fingerprint(data)
+            keys = self._by_fingerprint.get(fingerprint)
+            # Keys which have already been given to records read earlier are not reused
+            while keys and keys[0] in self.records: keys.popleft()
+            if not keys:
+                self._pending.append(fingerprint)
+                return data
+            self.records[keys.popleft()] = fingerprint
+            self.counts['unchanged'] += 1
+
+    def change(self, record):
+        """Return 'new' or 'changed' for the next record read, or None if it has not changed"""
+        fingerprint = self._pending.popleft()
+        key = self.key(record)
+        self.records[key] = fingerprint
+        previous = self.previous.get(key)
+        change = None if previous == fingerprint else 'changed' if previous else 'new'
+        self.counts[change or 'unchanged'] += 1
+        return change
+
+    def key(self, record):
+        identifier = record.identifier()
+        # Keys of skipped records are taken from the manifest, so are not reused
+        while True:
+            count = self._keys.get(identifier, 0)
+            self._keys[identifier] = count + 1
+            if not identifier: key = '_NO IDENTIFIER {}'.format(str(count + 1))
+            elif count: key = '{}_DUPLICATE {}'.format(identifier, str(count))
+            else: key = identifier
+            if key not in self.records: return key
+
+    def vanished(self):
+        """Return the keys of previous records which were not read"""
+        return [key for key in self.previous if key not in self.records]
+
+    def __str__(self):
+        return '{} new, {} changed, {} unchanged, {} vanished records'.format(
+            str(self.counts['new']), str(self.counts['changed']), str(self.counts['unchanged']), str(len(self.vanished())))
+
+
+class DeltaWriter(object):
+    """Writes the records of an input file which are new or changed, and the keys of records which have vanished.
+
+    Files are saved in the folder path, which is created if necessary, as <root>_new<ext>, <root>_changed<ext>
+    and <root>_vanished.txt (one key per line); each file is only created if there is something to write to it.
+    Records are written in the same format as the main output, without splitting.
+    """
+
+    def __init__(self, path, root, xml=False, header=False, deleted=False, metrics=None):
+        self.path, self.root = path, root
+        self.xml, self.header, self.deleted = xml, header, deleted
+        self.metrics = metrics
+        self.sequences = {}
+
+    def write(self, change, record):
+        """Write a record which is new or changed (change is 'new' or 'changed')"""
+        sequence = self.sequences.get(change)
+        if sequence is None:
+            os.makedirs(self.path, exist_ok=True)
+            sequence = self.sequences[change] = FileSequence(
+                self.path, '{}_{}'.format(self.root, change), '.xml' if self.xml else '.lex',
+                opening=(OAI_HEADER if self.header else XML_HEADER) if self.xml else None,
+                closing=('\n</ListRecords>\n</OAI-PMH>' if self.header else '\n</marc:collection>') if self.xml else None,
+                metrics=self.metrics)
+        sequence.write(RecordWriter.encode(serialize(record, self.xml, self.header, deleted=self.deleted)))
+
+    def write_vanished(self, keys):
+        if not keys: return
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, '{}_vanished.txt'.format(self.root)), mode='w', encoding='utf-8') as f:
+            f.writelines(key + '\n' for key in keys)
+
+    def finish(self):
+        for sequence in self.sequences.values(): sequence.finish()
+
+    def close(self):
+        for sequence in self.sequences.values(): sequence.close()
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def record_fingerprint(data):
+    """Function to return the fingerprint of the raw text of a record, as a hexadecimal string"""
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=FINGERPRINT_SIZE).hexdigest()
+
+
+def file_hash(path):
+    """Function to return a hash of the content of a file, as a hexadecimal string"""
+    digest = hashlib.blake2b()
+    with open(path, mode='rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_stat(path):
+    """Function to return the size and modification time (in nanoseconds) of a file"""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def file_entry(path, records=None, full=True, digest=None):
+    """Function to return the manifest entry for an input file"""
+    size, mtime = file_stat(path)
+    return {'size': size, 'mtime': mtime, 'hash': digest or file_hash(path), 'full': full, 'records': records or {}}
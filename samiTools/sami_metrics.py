@@ -0,0 +1,131 @@
+#  -*- coding: utf8 -*-
+
+"""Machine-readable progress reports for conversions, written as JSON lines."""
+
+# Import required modules
+from collections import OrderedDict
+import json
+import os
+import sys
+import time
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Constants
+# ====================
+
+
+# Default number of seconds between progress reports
+METRICS_INTERVAL = 10.0
+
+
+# ====================
+#       Classes
+# ====================
+
+
+class MetricsReporter(object):
+    """Reports the progress of the conversion of an input file as JSON lines.
+
+    A 'progress' line is written at most once every interval seconds while records are counted,
+    and a 'summary' line is written by finish(). Lines are appended to metrics_file if it is given,
+    so that several processes can report to the same file; otherwise they are written to stderr.
+
+    Bytes read are taken from the position of the input file, so include any input which has been
+    read ahead of the current record. Bytes written are taken from the positions of the output files
+    registered with opened(), which must be passed to closing() before they are closed.
+    """
+
+    def __init__(self, metrics_file=None, interval=METRICS_INTERVAL):
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.clock = time.perf_counter
+        self.name, self.input_file, self.input_size = None, None, 0
+        self.deleted_file = False
+        self.records, self.errors, self.deleted, self.oral_history = 0, 0, 0, 0
+        self.bytes_written, self.output_index, self.output_files = 0, 0, 0
+        self._outputs = []
+        self._start, self._next, self._last = 0.0, 0.0, (0.0, 0)
+
+    def start(self, name, input_file, deleted=False):
+        """Start reporting on the input file name, which has been opened as input_file"""
+        self.name = name
+        self.input_file = getattr(input_file, 'buffer', input_file)
+        self.input_size = os.fstat(input_file.fileno()).st_size
+        self.deleted_file = deleted
+        self.records, self.errors, self.deleted, self.oral_history = 0, 0, 0, 0
+        self.bytes_written, self.output_index, self.output_files = 0, 0, 0
+        self._outputs = []
+        self._start = self.clock()
+        self._next = self._start + self.interval
+        self._last = (self._start, 0)
+
+    def count(self, record):
+        """Count a record which has been read, and report progress if it is due"""
+        self.records += 1
+        if record.error: self.errors += 1
+        if record.deleted or self.deleted_file: self.deleted += 1
+        if self.clock() >= self._next: self.progress()
+
+    def opened(self, file_object, index=None):
+        """Register an output file; index is the position of the file in a sequence of output files"""
+        self._outputs.append(file_object)
+        self.output_files += 1
+        if index is not None: self.output_index = index
+
+    def closing(self, file_object):
+        """Count the bytes written to an output file which is about to be closed"""
+        self.bytes_written += file_object.tell()
+        self._outputs.remove(file_object)
+
+    def progress(self):
+        """Report progress, with the rate of conversion since the last report"""
+        now = self.clock()
+        last_time, last_records = self._last
+        line = self._line('progress', now)
+        offset, elapsed = line['bytes_read'], line['elapsed_seconds']
+        line['records_per_sec'] = round((self.records - last_records) / (now - last_time), 1) if now > last_time else None
+        line['eta_seconds'] = round(elapsed * (self.input_size - offset) / offset, 1) if offset else None
+        self._last = (now, self.records)
+        self._next = now + self.interval
+        self.write(line)
+
+    def finish(self):
+        """Report a summary of the file; the input file and any registered output files must still be open"""
+        now = self.clock()
+        line = self._line('summary', now)
+        line['records_per_sec'] = round(self.records / (now - self._start), 1) if now > self._start else None
+        line['output_files'] = self.output_files
+        self.write(line)
+
+    def _line(self, event, now):
+        offset = self.input_file.tell()
+        return OrderedDict([
+            ('event', event),
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('file', self.name),
+            ('elapsed_seconds', round(now - self._start, 3)),
+            ('records', self.records),
+            ('bytes_read', offset),
+            ('input_size', self.input_size),
+            ('percent', round(100 * offset / self.input_size, 1) if self.input_size else 100.0),
+            ('bytes_written', self.bytes_written + sum(f.tell() for f in self._outputs)),
+            ('output_index', self.output_index),
+            ('errors', self.errors),
+            ('deleted', self.deleted),
+            ('oral_history', self.oral_history),
+        ])
+
+    def write(self, line):
+        text = json.dumps(line) + '\n'
+        if self.metrics_file:
+            with open(self.metrics_file, mode='a', encoding='utf-8') as f:
+                f.write(text)
+        else:
+            sys.stderr.write(text)
+            sys.stderr.flush()
@@ -0,0 +1,147 @@
+#  -*- coding: utf8 -*-
+
+"""Per-stage timing of conversions, used by the --profile option of the command line scripts."""
+
+# Import required modules
+import cProfile
+import functools
+import json
+import time
+from sami import marc_data
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Constants
+# ====================
+
+
+# Stages which are timed, with the methods timed for each: (class or module, attribute name)
+PROFILE_STAGES = [
+    ('read', [(marc_data.SAMIReader, 'next_chunk'), (marc_data.SAMIReaderXML, '_next_parsed')]),
+    ('parse', [(marc_data.SAMIRecordAuthorities, '__init__'), (marc_data.SAMIRecordPRN, '__init__'),
+               (marc_data.SAMIRecordXML, '__init__'), (marc_data.SAMIRecordText, '__init__'),
+               (marc_data.SAMIHeaderRecord, '__init__')]),
+    ('clean_text', [(marc_data, 'clean_text')]),
+    ('as_marc', [(marc_data.SAMIRecord, 'as_marc'), (marc_data.SerializedRecord, 'as_marc')]),
+    ('as_xml', [(marc_data.SAMIRecord, 'as_xml'), (marc_data.SerializedRecord, 'as_xml')]),
+    ('header', [(marc_data.SAMIRecord, 'header')]),
+    ('write', [(marc_data.RecordWriter, 'write'), (marc_data.RecordWriter, 'flush'), (marc_data.SplitArchive, 'add')]),
+]
+
+
+# ====================
+#       Classes
+# ====================
+
+
+class Profiler(object):
+    """Profiles a conversion by stage (with a StageProfiler) and/or with cProfile.
+
+    On stop(), a table of stages is printed, followed by the same figures as JSON;
+    cProfile statistics are saved to cprofile_file, and can be read with the pstats module.
+    """
+
+    def __init__(self, stages=False, cprofile_file=None):
+        self.stage_profiler = StageProfiler() if stages else None
+        self.cprofile_file = cprofile_file
+        self.cprofiler = cProfile.Profile() if cprofile_file else None
+
+    def start(self):
+        if self.stage_profiler: self.stage_profiler.install()
+        if self.cprofiler: self.cprofiler.enable()
+
+    def stop(self):
+        if self.cprofiler:
+            self.cprofiler.disable()
+            self.cprofiler.dump_stats(self.cprofile_file)
+            print('\ncProfile statistics saved to {}'.format(self.cprofile_file))
+        if self.stage_profiler:
+            self.stage_profiler.uninstall()
+            print('\nProfile:\n')
+            print(str(self.stage_profiler))
+            print(self.stage_profiler.as_json())
+
+
+class StageProfiler(object):
+    """Records the number of calls and the cumulative time spent in each stage of a conversion.
+
+    Nothing is timed until install() is called, which replaces the methods listed in PROFILE_STAGES
+    with timed wrappers, so there is no cost to the conversion when profiling is not used.
+    Writes are timed in RecordWriter, through which all records are written to output files
+    (other than to archives, which are timed in SplitArchive.add).
+
+    Times are inclusive: the time spent cleaning text, for example, is counted under clean_text
+    and also under parse or as_xml. For XML input, read includes the parsing of the XML.
+    Calls made within a call in the same stage (e.g. to RecordWriter.flush from RecordWriter.write)
+    are not counted again.
+    """
+
+    def __init__(self):
+        self.stages = {stage: [0, 0.0] for stage, _ in PROFILE_STAGES}
+        self._active = {stage: False for stage, _ in PROFILE_STAGES}
+        self._originals = []
+        self._start, self._stop = None, None
+
+    def install(self):
+        """Start timing"""
+        for stage, targets in PROFILE_STAGES:
+            for owner, name in targets:
+                function = owner.__dict__[name]
+                self._originals.append((owner, name, function))
+                setattr(owner, name, self.timed(stage, function))
+        self._start = time.perf_counter()
+
+    def uninstall(self):
+        """Stop timing, restoring the original methods"""
+        self._stop = time.perf_counter()
+        while self._originals:
+            owner, name, function = self._originals.pop()
+            setattr(owner, name, function)
+
+    def timed(self, stage, function):
+        """Return a wrapper for function which adds the time taken by each call to stage"""
+        counter, active, clock = self.stages[stage], self._active, time.perf_counter
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if active[stage]: return function(*args, **kwargs)
+            active[stage] = True
+            start = clock()
+            try: return function(*args, **kwargs)
+            finally:
+                active[stage] = False
+                counter[0] += 1
+                counter[1] += clock() - start
+        return wrapper
+
+    def total(self):
+        return ((self._stop or time.perf_counter()) - self._start) if self._start is not None else 0.0
+
+    def as_dict(self):
+        return {
+            'total_seconds': round(self.total(), 6),
+            'stages': {stage: {'calls': calls, 'seconds': round(seconds, 6)} for stage, (calls, seconds) in self.stages.items()},
+            'clean_text_cache': marc_data.clean_text_cache_info(),
+        }
+
+    def as_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def __str__(self):
+        total = self.total()
+        lines = ['{:<12}{:>12}{:>12}{:>10}{:>14}'.format('Stage', 'Calls', 'Seconds', '% total', 'Microsec/call')]
+        for stage, (calls, seconds) in self.stages.items():
+            lines.append('{:<12}{:>12}{:>12.3f}{:>10.1%}{:>14.1f}'.format(
+                stage, calls, seconds, seconds / total if total else 0, seconds * 1e6 / calls if calls else 0))
+        lines.append('{:<12}{:>12}{:>12.3f}'.format('total', '', total))
+        lines.append('Times are inclusive: clean_text is also counted in the stages which call it.')
+        cache = marc_data.clean_text_cache_info()
+        lines.append('clean_text calls: {} on the fast path (text with nothing to escape or remove, which is not cached), '
+                     '{} cache hits, {} cache misses; {} of {} values cached.'.format(
+                         cache['fast_path'], cache['hits'], cache['misses'], cache['currsize'], cache['maxsize']))
+        return '\n'.join(lines)
@@ -0,0 +1,299 @@
+#  -*- coding: utf8 -*-
+
+"""Routing of records to any number of named output sinks, used by the --routes option of the command line scripts."""
+
+# Import required modules
+import json
+from math import log10
+from sami.marc_data import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Constants
+# ====================
+
+
+# Predicates which test values kept by every record
+RECORD_PREDICATES = ('all', 'oral_history', 'deleted', 'bad')
+
+# Predicates which test the fields of a record: tag:<tag> or field:<tag>[$<code>]~<regular expression>
+FIELD_PREDICATE = re.compile(r'(?P<kind>tag|field):(?P<tag>[0-9A-Za-z]{3})(?:\$(?P<code>[0-9A-Za-z]))?(?:~(?P<pattern>.+))?')
+
+# Sink names, which are used as folder names
+SINK_NAME = re.compile(r'[0-9A-Za-z_\-]+')
+
+# Keys of the description of a sink in a routes file
+ROUTE_KEYS = ('name', 'when', 'path', 'format', 'header', 'max_size', 'fan_out', 'archive', 'archive_size')
+
+
+# ====================
+#       Classes
+# ====================
+
+
+class Predicate(object):
+    """A test of a record, from a specification such as 'oral_history' or '!field:653$a~(?i)interviews'.
+
+    all, oral_history, deleted and bad test every record, are oral histories, are deleted (or are in a file
+    of deleted records) and have errors respectively. tag:<tag> tests whether a record has a field with the tag;
+    field:<tag>~<pattern> tests whether the value of a field with the tag matches the regular expression
+    (with re.search), and field:<tag>$<code>~<pattern> tests the subfields of the field with the code.
+    A specification starting with ! is negated.
+    """
+
+    def __init__(self, spec):
+        self.negated = spec.startswith('!')
+        self.spec = spec[1:] if self.negated else spec
+        self.kind, self.tag, self.code, self.pattern = self.spec, None, None, None
+        if self.spec in RECORD_PREDICATES: return
+        match = FIELD_PREDICATE.fullmatch(self.spec)
+        if not match or (match.group('kind') == 'tag') != (match.group('code') is None and match.group('pattern') is None):
+            raise ValueError('Predicate {} could not be interpreted'.format(spec))
+        self.kind, self.tag, self.code = match.group('kind'), match.group('tag'), match.group('code')
+        if self.kind == 'field':
+            try: self.pattern = re.compile(match.group('pattern'))
+            except re.error as err: raise ValueError('Predicate {} could not be interpreted: {}'.format(spec, err))
+
+    def __call__(self, record, deleted=False):
+        if self.kind == 'all': result = True
+        elif self.kind == 'oral_history': result = record.is_oral_history()
+        elif self.kind == 'deleted': result = deleted or record.deleted
+        elif self.kind == 'bad': result = record.is_bad()
+        else: result = record.matches(self)
+        return result != self.negated
+
+    def fields(self):
+        """Return True if the predicate tests the fields of a record"""
+        return self.kind in ('tag', 'field')
+
+    def match(self, marc_record):
+        """Return the result of the predicate for a MARCRecord (before negation)"""
+        if self.kind == 'tag': return self.tag in marc_record
+        for field in marc_record.get_fields(self.tag):
+            if field.control: values = [field.data] if self.code is None else []
+            elif self.code is None: values = [' '.join(field.get_subfields())]
+            else: values = field.get_subfields(self.code)
+            for value in values:
+                if self.pattern.search(value): return True
+        return False
+
+
+class Route(object):
+    """Description of a sink: which records are written to it, where, in which format and how output is split.
+
+    Records are written to the sink if they match all of the predicates; a route whose only predicate is other
+    receives the records which are not written to any sink without other.
+    Output files are saved in the folder path, which is not used for any other output.
+    If single is True (max_size 1), each record is written to a separate file, named with its identifier
+    (or to archives, if archive is given); otherwise records are written to files named in the same way
+    as the main output, split by size or number of records if limit is given.
+    """
+
+    def __init__(self, name, when, path, xml=False, header=False, limit=None, max_size=None,
+                 fan_out=(None, None), archive=(None, None)):
+        self.name = name
+        self.other = when == ['other']
+        self.predicates = [] if self.other else [Predicate(spec) for spec in when]
+        self.path = path
+        self.xml, self.header = xml, header
+        self.limit, self.max_size = limit, max_size
+        self.single = limit == 'number' and max_size == 1
+        self.fan_out, self.archive = fan_out, archive
+
+    def matches(self, record, deleted=False):
+        return all(predicate(record, deleted) for predicate in self.predicates)
+
+    def __str__(self):
+        when = 'other records' if self.other else ' and '.join(('not ' if p.negated else '') + p.spec for p in self.predicates)
+        split = ', split into individual records' if self.single \
+            else ', maximum file size: {} {}'.format(self.max_size, 'bytes' if self.limit == 'size' else 'records') if self.limit else ''
+        return '{}: {} -> {} ({}{}{})'.format(self.name, when, self.path, 'MARC XML' if self.xml else 'MARC',
+                                              ' with MetAg headers' if self.header else '', split)
+
+
+class Sink(object):
+    """Output files for a Route, for one input file (sequences of files and archives are named with root)"""
+
+    def __init__(self, route, root, input_size=None, metrics=None):
+        self.route = route
+        self.ext = '.xml' if route.xml else '.lex'
+        self.metrics = metrics
+        self.sequence, self.names, self.split_archive = None, None, None
+        if route.single:
+            if route.archive[0]:
+                self.split_archive = SplitArchive(route.path, root, route.archive[0], self.ext,
+                                                  route.archive[1], *route.fan_out, metrics=metrics)
+            else: self.names = SplitFileNames(route.path, self.ext, *route.fan_out)
+            return
+        mid = '.%d'
+        if route.limit == 'size' and input_size:
+            mid = '.%%0%dd' % (int(log10(input_size / route.max_size)) + 1 if input_size > route.max_size else 1)
+        self.sequence = FileSequence(route.path, root, self.ext, route.limit, route.max_size, mid,
+                                     opening=(OAI_HEADER if route.header else XML_HEADER) if route.xml else None,
+                                     closing=('\n</ListRecords>\n</OAI-PMH>' if route.header else '\n</marc:collection>') if route.xml else None,
+                                     metrics=metrics)
+
+    def write(self, data, name):
+        """Write the bytes data for a record, with the name name if records are written to separate files"""
+        if self.sequence:
+            self.sequence.write(data)
+        elif self.split_archive:
+            self.split_archive.add(name, data)
+        else:
+            # Files are created exclusively, so that parallel conversions cannot claim the same file name
+            for filename in self.names.candidates(name):
+                try:
+                    file_object = RecordWriter(open(filename, mode='xb'))
+                    break
+                except FileExistsError: pass
+            if self.metrics: self.metrics.opened(file_object)
+            file_object.write(data)
+            if self.metrics: self.metrics.closing(file_object)
+            file_object.close()
+
+    def finish(self):
+        if self.sequence: self.sequence.finish()
+
+    def close(self):
+        if self.sequence: self.sequence.close()
+        if self.split_archive: self.split_archive.close()
+
+
+class Router(object):
+    """Writes each record to every sink whose route it matches, in a single pass through the input.
+
+    Sinks are opened for one input file: sequences of files are named with root, and input_size is used
+    to choose the width of their sequence numbers. If deleted is True, the input file contains deleted records.
+    Each record is serialized once for each format in which it is written, however many sinks it is written to.
+    """
+
+    def __init__(self, routes, root, deleted=False, input_size=None, metrics=None):
+        self.deleted = deleted
+        self.sinks = [Sink(route, root, input_size, metrics) for route in routes]
+        self.record_count = 0
+
+    def write(self, record):
+        """Write a record to the sinks whose routes it matches; returns the names of the sinks"""
+        self.record_count += 1
+        sinks = [sink for sink in self.sinks if not sink.route.other and sink.route.matches(record, self.deleted)]
+        if not sinks: sinks = [sink for sink in self.sinks if sink.route.other]
+        serialized, name = {}, None
+        for sink in sinks:
+            route = sink.route
+            key = (route.xml, route.header, route.single)
+            data = serialized.get(key)
+            if data is None:
+                data = serialized[key] = RecordWriter.encode(serialize(record, *key, deleted=self.deleted))
+            if route.single and name is None:
+                name = record.identifier() or '_NO IDENTIFIER {}'.format(str(self.record_count))
+            sink.write(data, name)
+        return [sink.route.name for sink in sinks]
+
+    def finish(self):
+        """Write the closing elements of all open files, which are left open (e.g. to report metrics)"""
+        for sink in self.sinks: sink.finish()
+
+    def close(self):
+        for sink in self.sinks: sink.close()
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def serialize(record, xml=False, header=False, single=False, deleted=False):
+    """Function to serialize a record as it is written to output files.
+
+    If single is True, the record is written to a file on its own, with the opening and closing elements of the file.
+    For files of deleted records (if deleted is True), or deleted records, only the header is written with header.
+    """
+    if not xml: return record.as_marc()
+    if header:
+        text = (METAG_HEADER if single else OAI_RECORD) + record.header(deleted=deleted)
+        if not (deleted or record.deleted):
+            text += '<metadata>{}\n</metadata>\n'.format(record.as_xml(namespace=True))
+        return text + '</record>'
+    if single: return '{}{}\n</marc:collection>'.format(XML_HEADER, record.as_xml())
+    return record.as_xml()
+
+
+def load_routes(file, output_path, xml=False, separate=()):
+    """Function to read a routes file, returning a list of Routes.
+
+    The file holds a JSON list of sinks, each an object with the keys:
+        name            name of the sink (required)
+        when            predicate or list of predicates, which must all match (required; see Predicate),
+                        or 'other' for records not written to any other sink
+        path            folder for the output files (default: a subfolder of output_path with the name of the sink)
+        format          'lex' or 'xml' (default: the format of the main output)
+        header          true to include MetAg headers in MARC XML records
+        max_size        maximum file size or number of records, as for --max_size
+        fan_out, archive, archive_size
+                        as for --fan_out, --archive and --archive_size (only with max_size 1)
+    Each sink is written to a folder of its own, which must not be output_path, the folder of another sink,
+    or any of the folders in separate.
+    """
+    try:
+        with open(file, mode='r', encoding='utf-8') as f:
+            routes = json.load(f)
+    except Exception as err:
+        exit_prompt('Error: Could not read routes file {}: {}'.format(file, err))
+    if not isinstance(routes, list) or not all(isinstance(route, dict) for route in routes):
+        exit_prompt('Error: Routes file {} must contain a list of sinks'.format(file))
+
+    results, names, folders = [], set(), {os.path.abspath(output_path)} | {os.path.abspath(path) for path in separate if path}
+    for route in routes:
+        name = route.get('name')
+        if not isinstance(name, str) or not SINK_NAME.fullmatch(name):
+            exit_prompt('Error: Sink names must contain only letters, digits, _ and -')
+        if name in names: exit_prompt('Error: More than one sink is named {}'.format(name))
+        names.add(name)
+        unknown = [key for key in route if key not in ROUTE_KEYS]
+        if unknown: exit_prompt('Error: Sink {}: {} not recognised'.format(name, ', '.join(unknown)))
+        when = route.get('when')
+        if isinstance(when, str): when = [when]
+        if not when or not all(isinstance(spec, str) for spec in when) or ('other' in when and len(when) > 1):
+            exit_prompt('Error: Sink {}: when must be a predicate, a list of predicates, or other'.format(name))
+        if when != ['other']:
+            for spec in when:
+                try: Predicate(spec)
+                except ValueError as err: exit_prompt('Error: Sink {}: {}'.format(name, err))
+        sink_format = route.get('format', 'xml' if xml else 'lex')
+        if sink_format not in ('lex', 'xml'): exit_prompt('Error: Sink {}: format must be lex or xml'.format(name))
+        header = bool(route.get('header', False))
+        if header and sink_format != 'xml': exit_prompt('Error: Sink {}: header can only be used with format xml'.format(name))
+        limit, max_size = parse_max_size(route['max_size']) if 'max_size' in route else (None, None)
+        fan_out = parse_fan_out(route['fan_out']) if 'fan_out' in route else (None, None)
+        archive = (route.get('archive'), parse_archive_size(route['archive_size']) if 'archive_size' in route else None)
+        if archive[0] and archive[0] not in ARCHIVE_FORMATS:
+            exit_prompt('Error: Sink {}: archive format must be one of {}'.format(name, ', '.join(ARCHIVE_FORMATS)))
+        if archive[1] and not archive[0]: exit_prompt('Error: Sink {}: archive_size cannot be used without archive'.format(name))
+        single = limit == 'number' and max_size == 1
+        if (fan_out[0] or archive[0]) and not single:
+            exit_prompt('Error: Sink {}: fan_out and archive can only be used with max_size 1'.format(name))
+        path = route.get('path') or os.path.join(output_path, name)
+        if os.path.abspath(path) in folders:
+            exit_prompt('Error: Sink {}: output must be saved in a folder of its own'.format(name))
+        folders.add(os.path.abspath(path))
+        if not os.path.isdir(path):
+            try: os.makedirs(path)
+            except: exit_prompt('Error: Could not parse path for sink {}'.format(name))
+        results.append(Route(name, when, path, xml=sink_format == 'xml', header=header, limit=limit, max_size=max_size,
+                             fan_out=fan_out, archive=archive))
+    if not results: exit_prompt('Error: Routes file {} does not contain any sinks'.format(file))
+    return results
+
+
+def field_predicates(routes):
+    """Function to return the predicates of routes which test the fields of records, once for each specification"""
+    predicates = OrderedDict()
+    for route in routes:
+        for predicate in route.predicates:
+            if predicate.fields(): predicates.setdefault(predicate.spec, predicate)
+    return list(predicates.values())
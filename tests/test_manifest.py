@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Tests for the manifest and change detection of incremental conversions (sami_manifest)."""
+
+# Import required modules
+import io
+import json
+import os
+import tempfile
+import unittest
+from sami.marc_data import *
+from sami.sami_manifest import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def authority(identifier, name):
+    """Return a SAMI authority record in text format"""
+    return '\t\t'.join(['XX', 'NAME', 'AUTHORIZED', '1/1/2000', 'USER  ', '1/1/2001', 'USER  ', '1/1/2002', 'BL']) + '\n' \
+        + ('  001:   |a{}\n'.format(identifier) if identifier else '') + '  100:   |a{}\n'.format(name)
+
+
+def authorities(*records):
+    """Return a SAMIReaderAuthorities for the records records, given as (identifier, name)"""
+    return SAMIReaderAuthorities(io.StringIO('\n'.join(authority(*record) for record in records)))
+
+
+def convert(changes, pipeline=False):
+    """Read the records of an IncrementalReader as the scripts do, returning a list of (identifier, change)"""
+    results = []
+    if pipeline:
+        records = record_pipeline(changes, 'authorities', 2, batch_size=2)
+    else: records = changes
+    for record in records:
+        results.append((record.identifier(), changes.change(record)))
+    return results
+
+
+# ====================
+#       Classes
+# ====================
+
+
+class IncrementalReaderTest(unittest.TestCase):
+
+    RECORDS = [('A1', 'Handel'), ('A2', 'Wright'), ('A3', 'Corea')]
+
+    def setUp(self):
+        self.first = IncrementalReader(authorities(*self.RECORDS))
+        convert(self.first)
+
+    def test_first_run(self):
+        self.assertEqual(sorted(self.first.records), ['A1', 'A2', 'A3'])
+        self.assertEqual(self.first.counts, {'new': 3, 'changed': 0, 'unchanged': 0})
+        self.assertEqual(self.first.vanished(), [])
+
+    def test_unchanged(self):
+        for skip_unchanged in (False, True):
+            changes = IncrementalReader(authorities(*self.RECORDS), self.first.records, skip_unchanged=skip_unchanged)
+            self.assertEqual(convert(changes), [] if skip_unchanged else [('A1', None), ('A2', None), ('A3', None)])
+            self.assertEqual(changes.records, self.first.records)
+            self.assertEqual(changes.counts, {'new': 0, 'changed': 0, 'unchanged': 3})
+            self.assertEqual(changes.vanished(), [])
+
+    def test_new_changed_vanished(self):
+        records = [('A1', 'Handel'), ('A3', 'Corea, Chick'), ('A4', 'Watford')]
+        for skip_unchanged in (False, True):
+            for pipeline in (False, True):
+                changes = IncrementalReader(authorities(*records), self.first.records, skip_unchanged=skip_unchanged)
+                results = convert(changes, pipeline=pipeline)
+                self.assertEqual(results, ([] if skip_unchanged else [('A1', None)]) + [('A3', 'changed'), ('A4', 'new')])
+                self.assertEqual(sorted(changes.records), ['A1', 'A3', 'A4'])
+                self.assertEqual(changes.records['A1'], self.first.records['A1'])
+                self.assertNotEqual(changes.records['A3'], self.first.records['A3'])
+                self.assertEqual(changes.counts, {'new': 1, 'changed': 1, 'unchanged': 1})
+                self.assertEqual(changes.vanished(), ['A2'])
+                self.assertEqual(str(changes), '1 new, 1 changed, 1 unchanged, 1 vanished records')
+
+    def test_keys(self):
+        records = [('A1', 'Handel'), (None, 'Wright'), ('A1', 'Corea'), (None, 'Watford'), ('A1', 'Corea')]
+        first = IncrementalReader(authorities(*records))
+        convert(first)
+        self.assertEqual(sorted(first.records), ['A1', 'A1_DUPLICATE 1', 'A1_DUPLICATE 2', '_NO IDENTIFIER 1', '_NO IDENTIFIER 2'])
+        # Records skipped as unchanged take their keys from the manifest; each record read has a key of its own
+        records[1], records[2] = ('A1', 'Wright'), ('A1', 'Handel')
+        changes = IncrementalReader(authorities(*records), first.records, skip_unchanged=True)
+        self.assertEqual(convert(changes), [('A1', 'changed'), ('A1', 'changed'), ('A1', 'new')])
+        self.assertEqual(sorted(changes.records), ['A1', 'A1_DUPLICATE 1', 'A1_DUPLICATE 2', 'A1_DUPLICATE 3', '_NO IDENTIFIER 2'])
+        self.assertEqual(changes.records['A1'], first.records['A1'])
+        self.assertEqual(changes.records['A1_DUPLICATE 2'], first.records['A1'])
+        self.assertEqual(changes.records['A1_DUPLICATE 3'], first.records['A1_DUPLICATE 1'])
+        self.assertEqual(changes.counts, {'new': 1, 'changed': 2, 'unchanged': 2})
+        self.assertEqual(changes.vanished(), ['_NO IDENTIFIER 1'])
+        # The records are unchanged when they are read again in the same order
+        again = IncrementalReader(authorities(*records), changes.records, skip_unchanged=True)
+        self.assertEqual(convert(again), [])
+        self.assertEqual(again.records, changes.records)
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.path = self.temp.name
+        self.input = os.path.join(self.path, 'input.txt')
+        with open(self.input, mode='w', encoding='utf-8') as f:
+            f.write(authority('A1', 'Handel'))
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def test_save(self):
+        manifest = Manifest(self.path, {'xml': True, 'routes': []})
+        self.assertEqual(manifest.files, {})
+        self.assertFalse(manifest.unchanged(self.path, 'input.txt'))
+        manifest.files['input.txt'] = file_entry(self.input, {'A1': '0123'})
+        manifest.save()
+        self.assertFalse(os.path.exists(manifest.path + '.tmp'))
+
+        manifest = Manifest(self.path, {'xml': True, 'routes': []})
+        self.assertFalse(manifest.changed_options)
+        self.assertEqual(manifest.files['input.txt']['records'], {'A1': '0123'})
+        self.assertEqual(manifest.files['input.txt']['hash'], file_hash(self.input))
+        self.assertTrue(manifest.unchanged(self.path, 'input.txt'))
+
+        # A file which has been changed is no longer unchanged
+        with open(self.input, mode='a', encoding='utf-8') as f:
+            f.write(authority('A2', 'Wright'))
+        self.assertFalse(manifest.unchanged(self.path, 'input.txt'))
+
+    def test_options(self):
+        manifest = Manifest(self.path, {'xml': True})
+        manifest.files['input.txt'] = file_entry(self.input, {'A1': '0123'})
+        manifest.save()
+        # With different options, records are kept but full outputs are out of date
+        manifest = Manifest(self.path, {'xml': False})
+        self.assertTrue(manifest.changed_options)
+        self.assertEqual(manifest.files['input.txt']['records'], {'A1': '0123'})
+        self.assertFalse(manifest.unchanged(self.path, 'input.txt'))
+        self.assertTrue(manifest.unchanged(self.path, 'input.txt', full=False))
+
+    def test_invalid(self):
+        path = os.path.join(self.path, MANIFEST_FILE)
+        for content in ('{', json.dumps({'version': MANIFEST_VERSION + 1, 'options': {}, 'files': {'input.txt': {}}})):
+            with open(path, mode='w', encoding='utf-8') as f:
+                f.write(content)
+            self.assertEqual(Manifest(self.path, {}).files, {})
+
+
+class DeltaWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp.name, 'delta')
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def test_write(self):
+        records = list(authorities(('A1', 'Handel'), ('A2', 'Wright'), ('A3', 'Corea')))
+        delta = DeltaWriter(self.path, 'input', xml=True)
+        self.assertFalse(os.path.exists(self.path))
+        delta.write('new', records[0])
+        delta.write('new', records[2])
+        delta.write('changed', records[1])
+        delta.write_vanished(['A4', 'A5'])
+        delta.write_vanished([])
+        delta.finish()
+        delta.close()
+        self.assertEqual(sorted(os.listdir(self.path)), ['input_changed.xml', 'input_new.xml', 'input_vanished.txt'])
+        with open(os.path.join(self.path, 'input_new.xml'), mode='r', encoding='utf-8') as f:
+            text = f.read()
+        self.assertEqual(text.count('<marc:record'), 2)
+        self.assertTrue(text.startswith(XML_HEADER))
+        self.assertTrue(text.endswith('</marc:collection>'))
+        with open(os.path.join(self.path, 'input_vanished.txt'), mode='r', encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'A4\nA5\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
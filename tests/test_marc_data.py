@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Tests for MARC records and fields (marc_data)."""
+
+# Import required modules
+import io
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+from sami.marc_data import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def marc_record(*fields):
+    """Return a MARCRecord with the fields fields, added with add_ordered_field"""
+    # Records decoded from MARC 21 are always marked as Unicode
+    record = MARCRecord(leader=' ' * 9 + 'a' + ' ' * 14)
+    record.add_ordered_field(*fields)
+    return record
+
+
+def data_field(tag, *subfields):
+    return Field(tag=tag, indicators=[' ', ' '], subfields=list(subfields))
+
+
+def legacy_ordered(fields, field):
+    """Insert a field into a list of fields as MARCRecord.add_ordered_field did before sort keys were cached"""
+    if len(fields) == 0 or not field.tag.isdigit():
+        fields.append(field)
+        return
+    tag, last_tag = int(field.tag), 0
+    for i, f in enumerate(fields):
+        if not f.tag.isdigit() and f.tag not in ALEPH_CONTROL_FIELDS:
+            fields.insert(i, field)
+            return
+        if f.tag not in ALEPH_CONTROL_FIELDS: last_tag = int(f.tag)
+        if last_tag > tag:
+            fields.insert(i, field)
+            return
+    fields.append(field)
+
+
+def legacy_get_fields(fields, *args):
+    """Return the fields with the tags args, as MARCRecord.get_fields did before fields were indexed by tag"""
+    if len(args) == 0: return fields
+    return [f for f in fields if f.tag.upper() in args]
+
+
+def random_fields(rng, n):
+    """Return n fields with tags chosen at random, including ALEPH control fields and other non-numeric tags"""
+    tags = ('001', '008', '100', '245', '245', '500', '650', '700', '999', 'SYS', 'DB ', 'FMT', 'CAT', 'cat')
+    return [data_field(rng.choice(tags), 'a', str(i)) for i in range(n)]
+
+
+def legacy_as_xml(record, namespace=False):
+    """Return a MARCRecord as MARC XML, as MARCRecord.as_xml did before MARCXMLSerializer was used"""
+    xml = [MARCXML_RECORD_NS if namespace else MARCXML_RECORD,
+           '\n\t\t<marc:leader>{}</marc:leader>'.format(record.as_marc()[:LEADER_LENGTH].decode('utf-8'))]
+    for field in record.fields:
+        if field.is_control_field():
+            xml.append('\n\t\t<marc:controlfield tag="{}">{}</marc:controlfield>'.format(field.tag, clean_text(field.data)))
+            continue
+        xml.append('\n\t\t<marc:datafield tag="{}" ind1="{}" ind2="{}">'.format(field.tag, *field.indicators))
+        for code, value in zip(field.subfields[::2], field.subfields[1::2]):
+            xml.append('\n\t\t\t<marc:subfield code="{}">{}</marc:subfield>'.format(code, clean_text(value.strip())))
+        xml.append('\n\t\t</marc:datafield>')
+    xml.append('\n\t</marc:record>')
+    return ''.join(xml)
+
+
+def random_record(rng):
+    """Return a MARCRecord with fields with text chosen at random, including text which must be escaped or cleaned"""
+    values = ('Title', 'Café', '中文', 'a & b', '&amp;', '&#233;', '<i>', '"quoted"', 'x\x01y', '  padded  ', '',
+              ' ', 'a' * 200)
+    tags = ('001', '005', '008', '100', '245', '650', '999', 'SYS', 'CAT')
+    fields = []
+    for i in range(rng.randint(1, 12)):
+        tag = rng.choice(tags)
+        if tag < '010' or tag in ALEPH_CONTROL_FIELDS:
+            fields.append(Field(tag=tag, data=rng.choice(values)))
+        else:
+            subfields = []
+            for j in range(rng.randint(1, 4)): subfields.extend([rng.choice('abc0'), rng.choice(values)])
+            fields.append(Field(tag=tag, indicators=[rng.choice(' 01'), rng.choice(' 4')], subfields=subfields))
+    return marc_record(*fields)
+
+
+# ====================
+#       Classes
+# ====================
+
+
+class OrderedFieldTest(unittest.TestCase):
+
+    def test_order(self):
+        # Fields are inserted in the same positions as before, whether or not the record is in tag order
+        for seed in range(200):
+            rng = random.Random(seed)
+            record, expected = MARCRecord(), []
+            for field in random_fields(rng, rng.randint(1, 40)):
+                if rng.random() < 0.1:
+                    record.add_field(field)
+                    expected.append(field)
+                else:
+                    record.add_ordered_field(field)
+                    legacy_ordered(expected, field)
+                self.assertEqual(record.fields, expected, 'seed {}'.format(seed))
+
+    def test_repeated_tags(self):
+        record = marc_record(data_field('245', 'a', '1'), data_field('100', 'a', '2'), data_field('245', 'a', '3'))
+        record.add_ordered_field(data_field('245', 'a', '4'), data_field('100', 'a', '5'))
+        self.assertEqual([f['a'] for f in record.fields], ['2', '5', '1', '3', '4'])
+
+    def test_fields_changed_directly(self):
+        # Sort keys are rebuilt if the list of fields has been changed directly
+        record = marc_record(data_field('100', 'a', '1'), data_field('700', 'a', '2'))
+        record.fields.insert(0, data_field('500', 'a', '3'))
+        record.add_ordered_field(data_field('600', 'a', '4'))
+        self.assertEqual([f.tag for f in record.fields], ['500', '100', '600', '700'])
+        record.fields[:] = [data_field('900', 'a', '5'), data_field('200', 'a', '6')]
+        record.changed()
+        record.add_ordered_field(data_field('300', 'a', '7'))
+        self.assertEqual([f.tag for f in record.fields], ['300', '900', '200'])
+
+
+class TagIndexTest(unittest.TestCase):
+
+    LOOKUPS = [('245',), ('100',), ('SYS',), ('CAT',), ('cat',), ('123',), ('245', '100'), ('700', '100', '245'),
+               ('650', '650'), ('SYS', '001'), ('CAT', '999', 'DB ')]
+
+    def assertLookups(self, record, message=None):
+        for tags in self.LOOKUPS:
+            expected = legacy_get_fields(record.fields, *tags)
+            self.assertEqual(record.get_fields(*tags), expected, message)
+            if len(tags) == 1:
+                self.assertEqual(tags[0] in record, len(expected) > 0, message)
+                self.assertIs(record[tags[0]], expected[0] if expected else None, message)
+
+    def test_inserts(self):
+        # The index is kept up to date as fields are added, whether or not the record is in tag order
+        for seed in range(200):
+            rng = random.Random(seed)
+            record = MARCRecord()
+            for field in random_fields(rng, rng.randint(1, 40)):
+                if rng.random() < 0.1: record.add_field(field)
+                else: record.add_ordered_field(field)
+                if rng.random() < 0.3: self.assertLookups(record, 'seed {}'.format(seed))
+            self.assertLookups(record, 'seed {}'.format(seed))
+
+    def test_copies(self):
+        # Changing the list returned by get_fields does not change the index
+        record = marc_record(data_field('245', 'a', '1'))
+        record.get_fields('245').append(data_field('245', 'a', '2'))
+        self.assertEqual(len(record.get_fields('245')), 1)
+
+    def test_fields_changed_directly(self):
+        record = marc_record(data_field('100', 'a', '1'), data_field('245', 'a', '2'))
+        self.assertIn('245', record)
+        record.fields.append(data_field('650', 'a', '3'))
+        self.assertEqual(record['650']['a'], '3')
+        record.fields[1] = data_field('246', 'a', '4')
+        record.changed()
+        self.assertNotIn('245', record)
+        self.assertEqual(record.get_fields('246', '100'), [record.fields[0], record.fields[1]])
+
+
+class SerializationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.record = marc_record(Field(tag='001', data='1'), data_field('245', 'a', 'Title'))
+
+    def assertSerializations(self, *values):
+        """Check that the MARC 21 and MARC XML serializations, and a record decoded from MARC 21, all contain values"""
+        marc, xml = self.record.as_marc(), self.record.as_xml()
+        decoded = MARCRecord(marc)
+        self.assertEqual(decoded.as_marc(), marc)
+        self.assertEqual(decoded.as_xml(), xml)
+        for value in values:
+            self.assertIn(value.encode('utf-8'), marc)
+            self.assertIn(value, xml)
+
+    def test_add(self):
+        self.assertSerializations('Title')
+        self.record.add_ordered_field(data_field('100', 'a', 'Author'))
+        self.assertSerializations('Title', 'Author')
+        self.record['245'].add_subfield('b', 'Subtitle')
+        self.assertSerializations('Title', 'Author', 'Subtitle')
+        self.record.leader = self.record.leader[:6] + 'j' + self.record.leader[7:]
+        self.assertEqual(self.record.as_marc()[6:7], b'j')
+        self.assertIn('<marc:leader>00095 j', self.record.as_xml())
+
+    def test_changed(self):
+        self.assertSerializations('Title')
+        self.record['245'].subfields = ('a', 'Another title')
+        self.record.changed()
+        self.assertSerializations('Another title')
+        self.record.fields[1] = data_field('246', 'a', 'Variant title')
+        self.record.changed()
+        self.assertSerializations('Variant title')
+        self.assertIsNone(self.record['245'])
+        self.assertEqual(self.record['246'].get_subfields('a'), ['Variant title'])
+        self.record.fields[0].data = '2'
+        self.record.changed()
+        self.assertIn(b'2\x1e', self.record.as_marc())
+        self.assertIn('<marc:controlfield tag="001">2</marc:controlfield>', self.record.as_xml())
+        # A field put in the list of fields directly belongs to the record once changed() has been called
+        self.record['246'].add_subfield('b', 'Subtitle')
+        self.assertSerializations('Variant title', 'Subtitle')
+
+    def test_other_records(self):
+        # Changes to one record leave the serializations of other records cached
+        other = marc_record(Field(tag='001', data='2'), data_field('245', 'a', 'Other title'))
+        marc, xml = other.as_marc(), other.as_xml()
+        self.record['245'].add_subfield('b', 'Subtitle')
+        self.record.changed()
+        data_field('245', 'a', 'Title').add_subfield('b', 'Subtitle')
+        self.assertIs(other.as_marc(), marc)
+        self.assertIs(other.as_xml(), xml)
+        self.assertSerializations('Title', 'Subtitle')
+
+
+class XMLSerializationTest(unittest.TestCase):
+
+    def test_legacy(self):
+        # Records are serialized as they were before, whether or not the MARC 21 serialization is cached
+        for seed in range(300):
+            rng = random.Random(seed)
+            record = random_record(rng)
+            if seed % 2: record.as_marc()
+            for namespace in (False, True):
+                self.assertEqual(record.as_xml(namespace=namespace), legacy_as_xml(record, namespace=namespace), 'seed {}'.format(seed))
+
+    def test_round_trip(self):
+        # A record decoded from its MARC 21 serialization has the same MARC XML serialization
+        for seed in range(300):
+            record = random_record(random.Random(seed))
+            decoded = MARCRecord(record.as_marc())
+            self.assertEqual(decoded.as_marc(), record.as_marc(), 'seed {}'.format(seed))
+            self.assertEqual(decoded.as_xml(), record.as_xml(), 'seed {}'.format(seed))
+
+    def test_fields(self):
+        serializer = MARCXMLSerializer()
+        fields = random_record(random.Random(1)).fields + random_record(random.Random(2)).fields
+        fields.append(Field(tag='245', indicators=['é', '0'], subfields=['a', 'Café', 'b', 'x']))
+        for field in fields:
+            xml = []
+            size = serializer.field(field, xml)
+            self.assertEqual(''.join(xml), '\n' + field.as_xml())
+            self.assertEqual(size, len(field.as_marc()))
+            self.assertEqual(''.join(xml), legacy_as_xml(marc_record(field)).split('</marc:leader>')[1][:-len('\n\t</marc:record>')])
+
+
+class MARCReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.records = []
+        for i in range(20):
+            record = marc_record(Field(tag='001', data='ID{}'.format(i)), data_field('245', 'a', 'Title {}'.format(i), 'b', 'é'),
+                                 data_field('650', 'a', 'Music'))
+            if i % 5 == 0: record.add_field(data_field('SYS', 'a', str(i)))
+            self.records.append(record)
+        self.marc = b''.join(record.as_marc() for record in self.records)
+        self.temp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.temp.name, 'records.lex')
+        with open(self.filename, mode='wb') as f:
+            f.write(self.marc)
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def read(self, lazy=False):
+        reader = MARCReader(open(self.filename, mode='rb'), lazy=lazy)
+        self.assertIsNotNone(reader._map)
+        records = list(reader)
+        return reader, records
+
+    def test_memory_mapped(self):
+        for lazy in (False, True):
+            reader, records = self.read(lazy)
+            self.assertEqual([record.as_marc() for record in records], [record.as_marc() for record in self.records])
+            self.assertEqual([record.as_xml() for record in records], [record.as_xml() for record in self.records])
+            del records
+            reader.close()
+
+    def test_lazy(self):
+        reader, records = self.read(lazy=True)
+        record = records[3]
+        self.assertTrue(all(isinstance(field, LazyField) and field._raw is not None for field in record.fields))
+        # Records are written as they were read without decoding their fields
+        self.assertEqual(record.as_marc(), self.records[3].as_marc())
+        self.assertTrue(all(field._raw is not None for field in record.fields))
+        # Fields are decoded when they are first used, and are then like any other field
+        self.assertEqual(record['245'].get_subfields('a', 'b'), ['Title 3', 'é'])
+        self.assertEqual(record['001'].data, 'ID3')
+        self.assertIsNone(record['245']._raw)
+        self.assertIsNotNone(record['650']._raw)
+        record['650'].add_subfield('x', 'History')
+        self.assertIn(b'\x1fxHistory', record.as_marc())
+        del records, record
+        reader.close()
+
+    def test_file_object(self):
+        # Files which cannot be memory-mapped are read from the file object
+        for lazy in (False, True):
+            reader = MARCReader(io.BytesIO(self.marc), lazy=lazy)
+            self.assertIsNone(reader._map)
+            self.assertEqual([record.as_marc() for record in reader], [record.as_marc() for record in self.records])
+
+    def test_identifiers_and_tags(self):
+        with open(self.filename, mode='rb') as f:
+            self.assertEqual(list(MARCReader(f).identifiers()), ['ID{}'.format(i) for i in range(20)])
+        with open(self.filename, mode='rb') as f:
+            self.assertEqual(list(MARCReader(f).tags()), [[field.tag for field in record.fields] for record in self.records])
+
+    def test_invalid(self):
+        # Fields with invalid UTF-8 are decoded (skipping the subfields which cannot be decoded) before they are written
+        record = marc_record(Field(tag='001', data='1'), data_field('245', 'a', 'Title', 'b', 'x'))
+        marc = record.as_marc().replace(b'\x1fbx', b'\x1fb\xff')
+        with open(self.filename, mode='wb') as f:
+            f.write(marc + b'012')
+        for lazy in (False, True):
+            reader = MARCReader(open(self.filename, mode='rb'), lazy=lazy)
+            with mock.patch('builtins.print'):
+                record = next(reader)
+                self.assertEqual(record['245'].get_subfields(), ['Title'])
+            self.assertNotIn(b'\xff', record.as_marc())
+            # A record length which is cut short is reported
+            with self.assertRaises(RecordLengthError): next(reader)
+            del record
+            reader.close()
+
+    def test_empty(self):
+        with open(self.filename, mode='wb'): pass
+        reader = MARCReader(open(self.filename, mode='rb'), lazy=True)
+        self.assertIsNone(reader._map)
+        self.assertEqual(list(reader), [])
+        reader.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Tests for the readers of SAMI files (marc_data)."""
+
+# Import required modules
+import io
+import unittest
+from sami.marc_data import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#     Constants
+# ====================
+
+
+AUTHORITIES = '\n'.join([
+    '$$ Authority export',
+    'XX0        \t\tNAME\t\tAUTHORIZED\t\t20/5/2013\t\tADMIN  \t\t27/12/2010\t\tJCOLLIER  \t\t27/8/2014\t\tBL',
+    '  001:   |aXX0',
+    '  100:   |aquartet, 1920',
+    '  500:   |ademo fireworks Watford recording with a note which is long enough',
+    '      to be continued on a second line',
+    '',
+    '   ',
+    '.end',
+    'XX1        \t\tNAME\t\tAUTHORIZED\t\t19/4/1990\t\tIDAVIS  \t\t6/7/1995\t\tJCOLLIER  \t\t5/10/2009\t\tBL',
+    '  001:   |aXX1',
+    '  100:   |ainterviews, 1900',
+    '.end',
+    '',
+    'XX2        \t\tNAME\t\tAUTHORIZED\t\t1/1/2000\t\tADMIN  \t\t1/1/2001\t\tADMIN  \t\t1/1/2002\t\tBL',
+    '  001:   |aXX2',
+])
+
+TEXT = '\n'.join([
+    '*** DOCUMENT BOUNDARY ***',
+    'FORM=WORK',
+    '.000. |aam  0c a',
+    '.001. |aCKEY0',
+    '.245. 10|atape interviews|bfireworks',
+    '*** DOCUMENT BOUNDARY ***',
+    '*** DOCUMENT BOUNDARY ***',
+    'FORM=WORK',
+    '.001. |aCKEY1',
+    '.245. 10|a' + 'orchestra symphony ' * 20,
+    '*** DOCUMENT BOUNDARY ***',
+    'FORM=WORK',
+    '.001. |aCKEY2',
+]) + '\n'
+
+PRN = '\n'.join([
+    '<?xml version="1.0" encoding="UTF-8"?>',
+    '<report>',
+    '<title>Catalog report</title>',
+    '<dateCreated>2018-05-10T10:00:00</dateCreated>',
+    '<dateFormat>YYYYMMDD</dateFormat>',
+    '<catalog>',
+    '    <marc>',
+    '        <marcEntry tag="245" label="Title" ind="10">|asymphony orchestra|btape</marcEntry>',
+    '        <marcEntry tag="001" label="Record control no." ind="  ">|aCKEY0</marcEntry>',
+    '    </marc>',
+    '    <call>',
+    '        <item>',
+    '            <dateCreated>2018-05-01</dateCreated>',
+    '        </item>',
+    '    </call>',
+    '</catalog>',
+    '<catalog>',
+    '    <marc>',
+    '        <marcEntry tag="001" label="Record control no." ind="  ">|aCKEY1</marcEntry>',
+    '    </marc>',
+    '</catalog>',
+    '</report>',
+]) + '\n'
+
+PRN_RECORD = '\n'.join([
+    '    <marc>',
+    '        <marcEntry tag="000" label="Leader" ind="  ">|aam     a</marcEntry>',
+    '        <marcEntry tag="008" label="Fixed field data" ind="  ">180214n   000 0 eng u</marcEntry>',
+    '        <marcEntry tag="245" label="Title" ind="10">|asymphony &amp; orchestra|btape|</marcEntry>',
+    '        <marcEntry tag="001" label="Record control no." ind="  ">|aCKEY0</marcEntry>',
+    '    </marc>',
+    '    <call>',
+    '        <callNumber>   C822/0 S1 C1</callNumber>',
+    '        <library>WORKS-FILE</library>',
+    '        <item>',
+    '            <copyNumber>1</copyNumber>',
+    '            <itemID>0-1001</itemID>',
+    '            <library>SOUND</library>',
+    '            <location>STORE+E</location>',
+    '            <homeLocation>STORE+E</homeLocation>',
+    '            <category1>POP</category1>',
+    '            <type>RECORDING</type>',
+    '            <dateCreated>2018-05-01</dateCreated>',
+    '        </item>',
+    '        <item>',
+    '            <itemID>0-1002</itemID>',
+    '            <category2>',
+    '                LOAN</category2>',
+    '            <dateCreated>2018-05-02</dateCreated>',
+    '            <dateModified>2019-01-16</dateModified>',
+    '        </item>',
+    '    </call>',
+    '    <call>',
+    '        <item>',
+    '            <copyNumber>2</copyNumber>',
+    '        </item>',
+    '    </call>',
+]) + '\n'
+
+XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<ListRecords>
+<record xmlns:marc="http://www.loc.gov/MARC21/slim">
+<header>
+    <identifier>oai:1</identifier>
+    <datestamp>2020-01-28</datestamp>
+</header>
+<metadata>
+    <marc:record>
+        <marc:datafield tag="245" ind1="1" ind2="">
+            <marc:subfield code="a">Symphony &amp; Caf&#233;</marc:subfield>
+            <marc:subfield
+                code="b">first line
+second line</marc:subfield>
+            <marc:subfield code="c"><![CDATA[x < y]]></marc:subfield>
+            <marc:subfield code="">no code</marc:subfield>
+            <marc:subfield code="d"/>
+        </marc:datafield>
+        <marc:controlfield tag="001">CKEY1</marc:controlfield>
+    </marc:record>
+</metadata>
+</record>
+<record><header status="deleted"><identifier>oai:2</identifier><datestamp>2020-01-29</datestamp></header></record>
+</ListRecords>
+</OAI-PMH>
+<?xml version="1.0" encoding="UTF-8"?>
+<collection xmlns="http://www.loc.gov/MARC21/slim">
+<record>
+    <controlfield tag='001'>CKEY3</controlfield>
+    <datafield tag='650' ind1=' ' ind2='0'><subfield code='a'>Music &gt; History</subfield></datafield>
+</record>
+</collection>
+'''
+DELETED = '''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<ListRecords>
+<record>
+<header status="deleted">
+    <identifier>oai:1</identifier>
+    <datestamp>2020-01-08</datestamp>
+</header>
+</record>
+<record><header status="deleted"><identifier>oai:2
+</identifier><datestamp>2020-01-09</datestamp></header></record>
+<record>
+<header status="deleted">
+    <identifier>oai:3</identifier>
+    <datestamp>2020-01-10</datestamp>
+    <setSpec>music</setSpec>
+</header>
+</record>
+<record>
+<header>
+    <identifier>oai:4</identifier>
+</header>
+<metadata><marc:record xmlns:marc="http://www.loc.gov/MARC21/slim"><marc:controlfield tag="001">CKEY4</marc:controlfield></marc:record></metadata>
+</record>
+</ListRecords>
+</OAI-PMH>
+'''
+
+MALFORMED = '''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<ListRecords>
+<record><header><identifier>oai:1</identifier></header><metadata><marc:record xmlns:marc="http://www.loc.gov/MARC21/slim">
+<marc:controlfield tag="001">CKEY1</marc:controlfield>
+</marc:record></metadata></record>
+<record><header><identifier>oai:2</identifier></header><metadata><marc:record xmlns:marc="http://www.loc.gov/MARC21/slim">
+<marc:datafield tag="245" ind1="0" ind2="0"><marc:subfield code="a">Bare & ampersand</marc:subfield></marc:datafield>
+</marc:record></metadata></record>
+<record><header><identifier>oai:3</identifier></header><metadata><marc:record xmlns:marc="http://www.loc.gov/MARC21/slim">
+<marc:controlfield tag="001">CKEY3</marc:controlfield>
+</marc:record></metadata></record>
+<record><header status="deleted"><identifier>oai:4</identifier><datestamp>2020-01-04</datestamp></header><metadata>
+<marc:record xmlns:marc="http://www.loc.gov/MARC21/slim"><marc:controlfield tag="001">Nbsp&nbsp;entity</marc:controlfield>
+<marc:datafield tag="245" ind1="1" ind2=""><marc:subfield code="a">Caf&eacute;
+ &amp; bar</marc:subfield><marc:subfield code="b"/></marc:datafield>
+</marc:record></metadata></record>
+<record><header><identifier>oai:5</identifier></header><metadata><marc:record xmlns:marc="http://www.loc.gov/MARC21/slim">
+<marc:controlfield tag="001">CKEY5'''
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def legacy_chunks(reader):
+    """Return the record chunks of a reader, found as SAMIReader.__next__ found them with readline()"""
+    chunks = []
+    while True:
+        chunk = ''
+        line = reader.file_handle.readline()
+        if not line: return chunks
+        while chunk == '' and line and (reader.new_record(line) or reader.while_chunk(line)):
+            line = reader.file_handle.readline()
+            if not line: break
+        while line and not reader.new_record(line):
+            chunk += line
+            line = reader.file_handle.readline()
+            if not line: break
+        if not chunk: return chunks
+        chunks.append(chunk)
+
+
+def block_chunks(reader, block_size):
+    """Return the record chunks of a reader, reading blocks of block_size characters"""
+    chunks = []
+    reader.block_size = block_size
+    while True:
+        try: chunks.append(reader.next_chunk())
+        except StopIteration: return chunks
+
+
+def field_values(record):
+    """Return the tags and values of the fields of a SAMIRecord"""
+    return [(f.tag, f.data) if f.is_control_field() else (f.tag, ''.join(f.indicators), list(f.subfields))
+            for f in record.record.fields]
+
+
+# ====================
+#       Classes
+# ====================
+
+
+class NamedText(io.StringIO):
+    """Text read from a file named name (some readers depend on the name of the file)"""
+
+    def __init__(self, text, name):
+        super().__init__(text)
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class ReaderChunkTest(unittest.TestCase):
+
+    BLOCK_SIZES = (1, 2, 3, 7, 16, 64, 100, READ_BLOCK_SIZE)
+
+    def assertChunks(self, reader_type, text, name='input', count=None):
+        expected = legacy_chunks(sami_factory(reader_type, NamedText(text, name)))
+        if count is not None: self.assertEqual(len(expected), count)
+        for block_size in self.BLOCK_SIZES:
+            self.assertEqual(block_chunks(sami_factory(reader_type, NamedText(text, name)), block_size), expected,
+                             'block size {}'.format(block_size))
+            # Input which does not end with a line break
+            self.assertEqual(block_chunks(sami_factory(reader_type, NamedText(text.rstrip('\n'), name)), block_size),
+                             legacy_chunks(sami_factory(reader_type, NamedText(text.rstrip('\n'), name))),
+                             'block size {}'.format(block_size))
+
+    def test_authorities(self):
+        self.assertChunks('authorities', AUTHORITIES, count=3)
+
+    def test_text(self):
+        self.assertChunks('txt', TEXT, count=3)
+
+    def test_prn(self):
+        self.assertChunks('prn', PRN, count=2)
+
+    def test_long_records(self):
+        # Records much longer than a block
+        text = TEXT.replace('orchestra symphony ', 'orchestra symphony ' * 500)
+        self.assertChunks('txt', text * 3, count=9)
+
+    def test_empty(self):
+        for reader_type in ('authorities', 'txt', 'prn', 'xml'):
+            self.assertEqual(block_chunks(sami_factory(reader_type, NamedText('', 'input')), 7), [])
+
+
+class XMLReaderTest(unittest.TestCase):
+
+    # Field values are taken from the raw text of the elements, with line breaks removed; control fields come first
+    FIELDS = [
+        [('001', 'CKEY1'),
+         ('245', '1 ', ['a', 'Symphony &amp; Caf&#233;', 'b', 'first linesecond line', 'c', '<![CDATA[x < y]]>', 'd', ''])],
+        [],
+        [('001', 'CKEY3'), ('650', ' 0', ['a', 'Music &gt; History'])],
+    ]
+
+    def read(self, block_size=READ_BLOCK_SIZE):
+        reader = sami_factory('xml', io.StringIO(XML))
+        reader.block_size = block_size
+        return list(reader)
+
+    def test_fields(self):
+        for block_size in (1, 7, 64, READ_BLOCK_SIZE):
+            records = self.read(block_size)
+            self.assertEqual([field_values(record) for record in records], self.FIELDS, 'block size {}'.format(block_size))
+
+    def test_headers(self):
+        records = self.read()
+        self.assertEqual([record.identifier() for record in records], ['1', 'oai:2', '3'])
+        self.assertEqual([record.datestamp() for record in records], ['2020-01-28', '2020-01-29', '[NO DATESTAMP]'])
+        self.assertEqual([record.deleted for record in records], [False, True, False])
+
+    def test_chunks(self):
+        chunks = block_chunks(sami_factory('xml', io.StringIO(XML)), 7)
+        self.assertEqual(len(chunks), 3)
+        self.assertTrue(all(chunk.startswith('<record') and chunk.endswith('</record>') for chunk in chunks))
+        self.assertIn('<marc:subfield code="a">Symphony &amp; Caf&#233;</marc:subfield>', chunks[0])
+        # A record parsed from its text has the same fields as one read from the file
+        self.assertEqual([field_values(SAMIRecordXML(chunk)) for chunk in chunks], self.FIELDS)
+
+
+class PRNRecordTest(unittest.TestCase):
+
+    def test_holdings(self):
+        # A 999 field is added for each item, with the call number and library of its call
+        record = SAMIRecordPRN(PRN_RECORD)
+        self.assertEqual(field_values(record), [
+            ('000', 'am     a'),
+            ('001', 'CKEY0'),
+            ('008', '180214n   000 0 eng u'),
+            ('245', '10', ['a', 'symphony &amp; orchestra', 'b', 'tape']),
+            ('999', '  ', ['a', '   C822/0 S1 C1', 'w', 'ALPHANUM', 'c', '1', 'i', '0-1001', 'd', '2018-05-01', 'k', 'STORE+E',
+                           'l', 'STORE+E', 'm', 'WORKS-FILE', 'r', 'Y', 's', 'Y', 't', 'RECORDING', 'u', '2018-05-01', 'x', 'POP']),
+            ('999', '  ', ['a', '   C822/0 S1 C1', 'w', 'ALPHANUM', 'i', '0-1002', 'd', '2018-05-02', 'm', 'WORKS-FILE',
+                           'r', 'Y', 's', 'Y', 'u', '2019-01-16', 'z', 'LOAN']),
+            ('999', '  ', ['a', '[NO CALL NUMBER]', 'w', 'ALPHANUM', 'c', '2', 'r', 'Y', 's', 'Y']),
+        ])
+        self.assertEqual(record.identifier(), '0')
+
+    def test_reader(self):
+        records = list(sami_factory('prn', io.StringIO(PRN)))
+        self.assertEqual([record.identifier() for record in records], ['0', '1'])
+        self.assertEqual([[f.tag for f in record.record.fields] for record in records], [['001', '245', '999'], ['001']])
+        self.assertEqual(records[0].record['999'].get_subfields('a', 'd', 'u'), ['[NO CALL NUMBER]', '2018-05-01', '2018-05-01'])
+
+
+class HeadersReaderTest(unittest.TestCase):
+
+    def assertHeaders(self, text, count):
+        expected = [(record.header(), record.header(deleted=True)) for record in sami_factory('xml', io.StringIO(text))]
+        self.assertEqual(len(expected), count)
+        for block_size in (1, 7, 64, READ_BLOCK_SIZE):
+            reader = sami_factory('headers', io.StringIO(text))
+            reader.block_size = block_size
+            records = list(reader)
+            self.assertTrue(all(isinstance(record, SAMIHeaderRecord) for record in records))
+            self.assertEqual([(record.header(), record.header(deleted=True)) for record in records], expected,
+                             'block size {}'.format(block_size))
+
+    def test_fields(self):
+        # Only the headers and fields 001 of the records are parsed
+        self.assertHeaders(XML, 3)
+
+    def test_deleted(self):
+        # Records which are just deleted headers are read from their text
+        self.assertHeaders(DELETED, 4)
+
+
+class XMLRecoveryTest(unittest.TestCase):
+
+    # Records which are not well-formed are parsed with regular expressions, with values taken from their raw text
+    FIELDS = [[('001', 'CKEY1')], [('245', '00', ['a', 'Bare & ampersand'])], [('001', 'CKEY3')],
+              [('001', 'Nbsp&nbsp;entity'), ('245', '1 ', ['a', 'Caf&eacute; &amp; bar', 'b', ''])], []]
+
+    def test_records(self):
+        # Reading carries on with the next record; only a record which is cut short is kept as its raw text
+        for block_size in (1, 7, 64, READ_BLOCK_SIZE):
+            reader = sami_factory('xml', io.StringIO(MALFORMED))
+            reader.block_size = block_size
+            records = list(reader)
+            self.assertEqual([field_values(record) for record in records], self.FIELDS)
+            self.assertEqual([record.identifier() for record in records], ['1', 'oai:2', '3', 'Nbsp\xa0entity', 'oai:5'])
+            self.assertEqual([record.deleted for record in records], [False, False, False, True, False])
+            self.assertEqual(records[3].datestamp(), '2020-01-04')
+            self.assertEqual([record.is_malformed() for record in records], [False, False, False, False, True])
+            self.assertTrue(records[4].data.startswith('<record><header><identifier>oai:5</identifier>'))
+            self.assertTrue(records[4].data.endswith('CKEY5'))
+
+    def test_chunks(self):
+        chunks = block_chunks(sami_factory('xml', io.StringIO(MALFORMED)), 7)
+        self.assertEqual([chunk.startswith('<record>') for chunk in chunks], [True] * 5)
+        records = [SAMIRecordXML(chunk) for chunk in chunks]
+        self.assertEqual([field_values(record) for record in records], self.FIELDS)
+        self.assertEqual([record.is_malformed() for record in records], [False, False, False, False, True])
+
+    def test_headers(self):
+        records = list(sami_factory('headers', io.StringIO(MALFORMED)))
+        self.assertEqual([record.identifier() for record in records], ['1', 'oai:2', '3', 'Nbsp\xa0entity', 'oai:5'])
+        self.assertEqual([record.is_malformed() for record in records], [False, False, False, False, True])
+        self.assertEqual(records[3].header(), '\n<header status="deleted">\n<identifier>Nbsp\xa0entity</identifier>\n'
+                                              '<datestamp>2020-01-04</datestamp>\n</header>\n')
+
+    def test_tolerant_parse(self):
+        # Well-formed records are parsed with regular expressions in the same way as by the parser
+        for text in (XML, DELETED, MALFORMED):
+            for chunk in block_chunks(sami_factory('xml', io.StringIO(text)), READ_BLOCK_SIZE)[:-1 if text == MALFORMED else None]:
+                for headers in (False, True):
+                    parsed, tolerant = XMLRecordParser.parse(chunk, headers=headers), XMLRecordParser.tolerant_parse(chunk, headers=headers)
+                    self.assertEqual([str(f) for f in tolerant[1]], [str(f) for f in parsed[1]])
+                    self.assertEqual(tolerant[2], parsed[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
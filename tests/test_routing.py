@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Tests for the routing of records to output sinks (sami_routing)."""
+
+# Import required modules
+import glob
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from sami.marc_data import *
+from sami.sami_routing import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def sami_record(identifier, *fields):
+    """Return a SAMIRecord with the identifier identifier and the fields fields"""
+    record = SAMIRecord(data='')
+    record.record.add_ordered_field(Field(tag='001', data=identifier))
+    for field in fields: record.record.add_ordered_field(field)
+    return record
+
+
+def oral_history(identifier):
+    return sami_record(identifier,
+                       Field(tag='653', indicators=[' ', ' '], subfields=['a', 'Oral histories']),
+                       Field(tag='975', indicators=[' ', ' '], subfields=['a', 'ark:/81055/vdc_1']))
+
+
+def count_records(filename):
+    with open(filename, mode='r', encoding='utf-8') as f:
+        return f.read().count('<marc:record')
+
+
+def sequence_counts(path, root):
+    files = glob.glob(os.path.join(path, root + '.*.xml'))
+    return [count_records(f) for f in sorted(files, key=lambda f: int(f.split('.')[-2]))]
+
+
+# ====================
+#       Classes
+# ====================
+
+
+class PredicateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.music = sami_record('1', Field(tag='650', indicators=[' ', '0'], subfields=['a', 'Music', 'x', 'History']))
+        self.other = sami_record('2', Field(tag='245', indicators=['1', '0'], subfields=['a', 'Interviews']))
+
+    def test_record_predicates(self):
+        self.assertTrue(Predicate('all')(self.music))
+        self.assertFalse(Predicate('!all')(self.music))
+        self.assertTrue(Predicate('oral_history')(oral_history('3')))
+        self.assertFalse(Predicate('oral_history')(self.music))
+        self.assertFalse(Predicate('deleted')(self.music))
+        self.assertTrue(Predicate('deleted')(self.music, deleted=True))
+        self.music.error = True
+        self.assertTrue(Predicate('bad')(self.music))
+        self.assertFalse(Predicate('!bad')(self.music))
+
+    def test_tag(self):
+        self.assertTrue(Predicate('tag:650')(self.music))
+        self.assertFalse(Predicate('tag:650')(self.other))
+        self.assertTrue(Predicate('!tag:650')(self.other))
+
+    def test_field(self):
+        self.assertTrue(Predicate('field:650~(?i)music')(self.music))
+        self.assertTrue(Predicate('field:650$a~^Music$')(self.music))
+        self.assertFalse(Predicate('field:650$x~(?i)music')(self.music))
+        # Without a subfield code, the subfields of a field are tested together
+        self.assertTrue(Predicate('field:650~Music History')(self.music))
+        self.assertFalse(Predicate('field:650~(?i)music')(self.other))
+        self.assertTrue(Predicate('field:001~^2$')(self.other))
+        self.assertFalse(Predicate('field:001$a~2')(self.other))
+
+    def test_invalid(self):
+        for spec in ('', 'everything', 'tag:65', 'tag:650~music', 'field:650', 'field:650~(', 'tag:650$a'):
+            with self.assertRaises(ValueError): Predicate(spec)
+
+
+class LoadRoutesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.path = self.temp.name
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def load(self, routes, **kwargs):
+        file = os.path.join(self.path, 'routes.json')
+        with open(file, mode='w', encoding='utf-8') as f:
+            json.dump(routes, f)
+        return load_routes(file, self.path, **kwargs)
+
+    def assertRejected(self, routes, **kwargs):
+        with mock.patch('builtins.input', return_value=''), mock.patch('builtins.print'):
+            with self.assertRaises(SystemExit): self.load(routes, **kwargs)
+
+    def test_routes(self):
+        routes = self.load([{'name': 'music', 'when': ['tag:650', '!bad'], 'format': 'xml', 'header': True, 'max_size': '5K'},
+                            {'name': 'singles', 'when': 'other', 'max_size': 1, 'fan_out': 'hash'}])
+        music, singles = routes
+        self.assertEqual(music.path, os.path.join(self.path, 'music'))
+        self.assertTrue(os.path.isdir(music.path))
+        self.assertEqual([p.spec for p in music.predicates], ['tag:650', 'bad'])
+        self.assertEqual((music.xml, music.header, music.limit, music.max_size, music.single), (True, True, 'size', 5120, False))
+        self.assertTrue(singles.other)
+        self.assertEqual(singles.predicates, [])
+        self.assertEqual((singles.xml, singles.limit, singles.max_size, singles.single), (False, 'number', 1, True))
+        self.assertEqual([p.spec for p in field_predicates(routes)], ['tag:650'])
+
+    def test_default_format(self):
+        self.assertTrue(self.load([{'name': 'all', 'when': 'all'}], xml=True)[0].xml)
+        self.assertFalse(self.load([{'name': 'all', 'when': 'all', 'format': 'lex'}], xml=True)[0].xml)
+
+    def test_rejected(self):
+        self.assertRejected([])
+        self.assertRejected({'name': 'all', 'when': 'all'})
+        self.assertRejected([{'name': 'a b', 'when': 'all'}])
+        self.assertRejected([{'name': 'all', 'when': 'all'}, {'name': 'all', 'when': 'deleted'}])
+        self.assertRejected([{'name': 'all', 'when': 'all', 'colour': 'red'}])
+        self.assertRejected([{'name': 'all', 'when': ['other', 'bad']}])
+        self.assertRejected([{'name': 'all', 'when': 'tag:6'}])
+        self.assertRejected([{'name': 'all', 'when': 'all', 'format': 'json'}])
+        self.assertRejected([{'name': 'all', 'when': 'all', 'header': True}])
+        self.assertRejected([{'name': 'all', 'when': 'all', 'fan_out': 'hash'}])
+        self.assertRejected([{'name': 'all', 'when': 'all', 'path': self.path}])
+        self.assertRejected([{'name': 'a', 'when': 'all'}, {'name': 'b', 'when': 'all', 'path': os.path.join(self.path, 'a')}])
+        self.assertRejected([{'name': 'all', 'when': 'all'}], separate=(os.path.join(self.path, 'all'),))
+
+
+class RouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.path = self.temp.name
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def route(self, name, when, **kwargs):
+        path = os.path.join(self.path, name)
+        os.makedirs(path)
+        return Route(name, when, path, xml=True, **kwargs)
+
+    def test_write(self):
+        routes = [self.route('oral', ['oral_history']), self.route('not_bad', ['!bad']), self.route('other', ['other'])]
+        router = Router(routes, 'root')
+        bad = sami_record('2')
+        bad.error = True
+        self.assertEqual(router.write(oral_history('1')), ['oral', 'not_bad'])
+        self.assertEqual(router.write(bad), ['other'])
+        self.assertEqual(router.write(sami_record('3')), ['not_bad'])
+        router.finish()
+        router.close()
+        self.assertEqual([count_records(os.path.join(route.path, 'root.xml')) for route in routes], [1, 2, 1])
+
+    def test_single(self):
+        router = Router([self.route('single', ['all'], limit='number', max_size=1)], 'root')
+        for identifier in ('1', '2', ''): router.write(sami_record(identifier) if identifier else SAMIRecord(data=''))
+        router.close()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.path, 'single'))), ['1.xml', '2.xml', '_NO IDENTIFIER 3.xml'])
+
+    def test_split_by_number(self):
+        # Sinks are split in the same way as the main output: max_size records in the first file, then max_size + 1
+        router = Router([self.route('all', ['all'], limit='number', max_size=5)], 'root')
+        for i in range(24): router.write(sami_record(str(i)))
+        router.finish()
+        router.close()
+        self.assertEqual(sequence_counts(os.path.join(self.path, 'all'), 'root'), [5, 6, 6, 6, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Tests for the functions used within samiTools (sami_functions)."""
+
+# Import required modules
+import unittest
+from sami.sami_functions import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#       Classes
+# ====================
+
+
+class CleanTextTest(unittest.TestCase):
+
+    def test_clean_text(self):
+        self.assertIsNone(clean_text(None))
+        self.assertIsNone(clean_text(''))
+        self.assertEqual(clean_text('Café'), 'Café')
+        self.assertEqual(clean_text('Café & Co.'), 'Café &amp; Co.')
+        self.assertEqual(clean_text('Café &amp; Co.'), 'Café &amp; Co.')
+        self.assertEqual(clean_text('<b>Bold</b>\x1f'), '&lt;b&gt;Bold&lt;/b&gt;')
+
+    def test_cache_info(self):
+        # Calls which return on the fast path are counted separately from the hits and misses of the cache
+        before = clean_text_cache_info()
+        for s in ('Café', '', None, 'Café'): clean_text(s)
+        for s in ('Café & Co. {}'.format(id(self)), 'Café & Co. {}'.format(id(self))): clean_text(s)
+        after = clean_text_cache_info()
+        self.assertEqual(after['fast_path'] - before['fast_path'], 4)
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['maxsize'], CLEAN_TEXT_CACHE_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
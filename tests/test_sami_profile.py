@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Tests for the per-stage timing of conversions (sami_profile)."""
+
+# Import required modules
+import io
+import json
+import unittest
+from sami.marc_data import *
+from sami.sami_profile import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#       Classes
+# ====================
+
+
+class StageProfilerTest(unittest.TestCase):
+
+    def test_stages(self):
+        profiler = StageProfiler()
+        profiler.install()
+        try:
+            records = list(SAMIReaderAuthorities(io.StringIO(
+                '\t\t'.join(['XX1', 'NAME', 'AUTHORIZED', '1/1/2000', 'USER  ', '1/1/2001', 'USER  ', '1/1/2002', 'BL'])
+                + '\n  001:   |aXX1\n  100:   |aCafé & Co.\n')))
+            records[0].as_xml()
+        finally: profiler.uninstall()
+        self.assertIs(marc_data.clean_text, clean_text)
+        result = json.loads(profiler.as_json())
+        self.assertEqual(result['stages']['parse']['calls'], 1)
+        self.assertEqual(result['stages']['as_xml']['calls'], 1)
+        self.assertGreater(result['stages']['clean_text']['calls'], 0)
+
+    def test_clean_text(self):
+        # Calls to clean_text on the fast path are reported as well as the hits and misses of its cache
+        profiler = StageProfiler()
+        clean_text('Café')
+        clean_text('Café & Co.')
+        cache = profiler.as_dict()['clean_text_cache']
+        self.assertEqual(sorted(cache), ['currsize', 'fast_path', 'hits', 'maxsize', 'misses'])
+        self.assertGreater(cache['fast_path'], 0)
+        self.assertIn('clean_text calls: {} on the fast path'.format(cache['fast_path']), str(profiler))
+        self.assertIn('{} cache hits, {} cache misses'.format(cache['hits'], cache['misses']), str(profiler))
+
+
+if __name__ == '__main__':
+    unittest.main()
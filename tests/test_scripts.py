@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Tests for the conversion scripts sami2marc_products.py and sami2marc_authorities.py."""
+
+# Import required modules
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#     Constants
+# ====================
+
+
+SCRIPTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Records in MARC XML, with or without OAI headers
+XML_RECORD = re.compile(r'<record[\s>].*?</record>|<marc:record[\s>].*?</marc:record>', re.S)
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def authority(i):
+    """Return a SAMI authority record in text format, of a length which depends on i"""
+    return '\t\t'.join(['XX{}'.format(i), 'NAME', 'AUTHORIZED', '1/1/2000', 'USER  ', '1/1/2001', 'USER  ', '1/1/2002', 'BL']) \
+        + '\n  001:   |aXX{}\n  100:   |a{}\n\n'.format(i, 'Café & Co. ' * (i % 9 + 1))
+
+
+def oai_record(i):
+    """Return a record in an OAI-PMH harvest, of a length which depends on i"""
+    return '<record><header><identifier>{0}</identifier><datestamp>2020-01-01</datestamp></header><metadata>' \
+           '<marc:record xmlns:marc="http://www.loc.gov/MARC21/slim">' \
+           '<marc:controlfield tag="001">CKEY{0}</marc:controlfield>' \
+           '<marc:datafield tag="245" ind1="1" ind2="0"><marc:subfield code="a">{1}</marc:subfield></marc:datafield>' \
+           '</marc:record></metadata></record>\n'.format(i, 'Café &amp; Co. ' * (i % 9 + 1))
+
+
+def run(script, *args):
+    """Run a script, returning the CompletedProcess"""
+    return subprocess.run([sys.executable, os.path.join(SCRIPTS, script)] + list(args), stdin=subprocess.DEVNULL,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def output_files(path, root):
+    """Return the names of the files into which the output root has been split, in order"""
+    files = [f for f in os.listdir(path) if re.fullmatch(re.escape(root) + r'\.[0-9]+\.[a-z]+', f)]
+    return [os.path.join(path, f) for f in sorted(files, key=lambda f: int(f.split('.')[-2]))]
+
+
+def read(filename):
+    with open(filename, mode='rb') as f:
+        return f.read()
+
+
+def records(data, xml):
+    """Return the records in the content of an output file"""
+    if xml: return XML_RECORD.findall(data.decode('utf-8'))
+    return [record + b'\x1d' for record in data.split(b'\x1d')[:-1]]
+
+
+# ====================
+#       Classes
+# ====================
+
+
+class SplitBySizeTest(unittest.TestCase):
+
+    MAX_SIZE = 2048
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.path = self.temp.name
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def assertSplit(self, whole, parts, xml):
+        """Check that the output files parts are no larger than MAX_SIZE, and hold the same records as whole"""
+        self.assertGreater(len(parts), 2)
+        for part in parts:
+            size = os.path.getsize(part)
+            # A file may only be larger if it holds a single record
+            if size > self.MAX_SIZE: self.assertEqual(len(records(read(part), xml)), 1, part)
+        self.assertEqual([r for part in parts for r in records(read(part), xml)], records(read(whole), xml))
+
+    def test_products(self):
+        folder = os.path.join(self.path, 'input')
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'cat.xml'), mode='w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">\n'
+                    '<ListRecords>\n' + ''.join(oai_record(i) for i in range(40)) + '</ListRecords>\n</OAI-PMH>\n')
+        for options in ([], ['-x'], ['-x', '--header']):
+            xml = '-x' in options
+            whole, parts = os.path.join(self.path, 'whole' + ''.join(options)), os.path.join(self.path, 'parts' + ''.join(options))
+            self.assertEqual(run('sami2marc_products.py', '-i', folder, '-o', whole, *options).returncode, 0)
+            self.assertEqual(run('sami2marc_products.py', '-i', folder, '-o', parts, '--max_size', '2K', *options).returncode, 0)
+            self.assertSplit(os.path.join(whole, 'cat.xml' if xml else 'cat.lex'), output_files(parts, 'cat'), xml)
+
+    def test_authorities(self):
+        source = os.path.join(self.path, 'authorities.txt')
+        with open(source, mode='w', encoding='utf-8') as f:
+            f.write(''.join(authority(i) for i in range(40)))
+        for ext in ('lex', 'xml'):
+            for options in ([], ['--header']) if ext == 'xml' else ([],):
+                name = ext + ''.join(options)
+                whole, parts = os.path.join(self.path, 'whole_' + name), os.path.join(self.path, 'parts_' + name)
+                os.makedirs(whole)
+                os.makedirs(parts)
+                self.assertEqual(run('sami2marc_authorities.py', '-i', source, '-o', os.path.join(whole, 'a.' + ext), *options).returncode, 0)
+                self.assertEqual(run('sami2marc_authorities.py', '-i', source, '-o', os.path.join(parts, 'a.' + ext),
+                                     '--max_size', '2K', *options).returncode, 0)
+                self.assertSplit(os.path.join(whole, 'a.' + ext), output_files(parts, 'a'), ext == 'xml')
+
+
+class FailedFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.path = self.temp.name
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def test_products(self):
+        # An input file which cannot be read is reported, the other files are converted, and the exit status is 1
+        folder = os.path.join(self.path, 'input')
+        os.makedirs(os.path.join(folder, 'bad.xml'))
+        with open(os.path.join(folder, 'cat.xml'), mode='w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">\n'
+                    '<ListRecords>\n' + ''.join(oai_record(i) for i in range(5)) + '</ListRecords>\n</OAI-PMH>\n')
+        for options in ([], ['--jobs', '2']):
+            output = os.path.join(self.path, 'output' + ''.join(options))
+            result = run('sami2marc_products.py', '-i', folder, '-o', output, '-x', *options)
+            self.assertEqual(result.returncode, 1)
+            self.assertIn('1 input files could not be converted: bad.xml', result.stdout)
+            self.assertEqual(os.listdir(output), ['cat.xml'])
+            self.assertEqual(len(records(read(os.path.join(output, 'cat.xml')), True)), 5)
+
+    def test_authorities(self):
+        # The records converted before the error are kept
+        source = os.path.join(self.path, 'authorities.txt')
+        with open(source, mode='w', encoding='utf-8') as f:
+            f.write(''.join(authority(i) for i in range(5)) + 'XX5\t\tNAME\n  001:   |aXX5\n')
+        names = ['XX{}.xml'.format(i) for i in range(5)]
+        for options in ([], ['--max_size', '1'], ['--max_size', '1', '--archive', 'zip']):
+            output = os.path.join(self.path, 'output' + ''.join(options))
+            os.makedirs(output)
+            result = run('sami2marc_authorities.py', '-i', source, '-o', os.path.join(output, 'a.xml'), *options)
+            self.assertEqual(result.returncode, 1)
+            self.assertIn('Error processing file', result.stdout)
+            if 'zip' in options:
+                with zipfile.ZipFile(os.path.join(output, 'a.0.zip')) as archive: self.assertEqual(archive.namelist(), names)
+            elif options: self.assertEqual(sorted(os.listdir(output)), names)
+            else: self.assertEqual(len(records(read(os.path.join(output, 'a.xml')), True)), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()